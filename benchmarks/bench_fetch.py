@@ -0,0 +1,84 @@
+"""
+Measures fetch throughput (rows/sec) across fetchmany() batch sizes, and with the
+adaptive batch sizer, against a fake cursor that charges a fixed latency for every
+round trip plus a small cost for every row, like a database across a WAN.
+
+Run it from the root of the repository with:
+
+    ipython benchmarks/bench_fetch.py
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from db import AdaptiveBatchSizer, fetch_batches
+
+
+class FakeCursor(object):
+
+    """ A cursor over generated rows that sleeps like a remote database would """
+
+    def __init__(self, rows, width=5, latency=0.002, row_cost=0.000002):
+        """
+        :param rows: how many rows the result set has
+        :param width: how many columns each row has
+        :param latency: the seconds each round trip costs
+        :param row_cost: the seconds each row costs on top of that
+        """
+
+        self.arraysize = 1
+        self.round_trips = 0
+
+        self._remaining = rows
+        self._row = tuple(['value %s' % i for i in range(width)])
+        self._latency = latency
+        self._row_cost = row_cost
+
+    def fetchmany(self, size=None):
+
+        size = min(size or self.arraysize, self._remaining)
+        self._remaining -= size
+        self.round_trips += 1
+
+        time.sleep(self._latency + size * self._row_cost)
+
+        return [self._row] * size
+
+
+def run(sizer, rows, width):
+
+    cursor = FakeCursor(rows, width)
+
+    started = time.time()
+    fetched = sum([len(batch) for batch in fetch_batches(cursor, sizer)])
+    elapsed = time.time() - started
+
+    return fetched / elapsed, cursor.round_trips, sizer.size()
+
+
+def main():
+
+    rows = 50000
+    width = 5
+
+    print("%12s %14s %12s %12s" % ('batch size', 'rows/sec', 'round trips', 'final size'))
+
+    for size in (50, 100, 500, 1000, 5000, 10000):
+        rate, round_trips, final = run(AdaptiveBatchSizer(size), rows, width)
+        print("%12s %14.0f %12s %12s" % (size, rate, round_trips, final))
+
+    rate, round_trips, final = run(AdaptiveBatchSizer(100, adaptive=True), rows, width)
+    print("%12s %14.0f %12s %12s" % ('adaptive', rate, round_trips, final))
+
+    # a tight memory ceiling keeps the adaptive batches small even though bigger is faster
+    rate, round_trips, final = run(AdaptiveBatchSizer(100, adaptive=True, max_bytes=256 * 1024), rows, width)
+    print("%12s %14.0f %12s %12s" % ('adaptive 256K', rate, round_trips, final))
+
+
+if __name__ == '__main__':
+    main()
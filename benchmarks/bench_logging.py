@@ -0,0 +1,96 @@
+"""
+Measures what the log calls of the %db magic cost, by running the shipped code paths
+against the fake backend of bench_magic.py with the root logger at WARNING and at DEBUG:
+
+- DbMagic.list_values() on a cached listing, which logs the listing with a ResultSummary
+- a %db call that fetches every row, which logs the fetched rows the same way
+
+At WARNING the messages are filtered out before they are built.  At DEBUG they are built
+and written to os.devnull, so the difference between the columns is what building them costs.
+
+Run it from the root of the repository with:
+
+    ipython benchmarks/bench_logging.py
+"""
+
+from __future__ import print_function
+
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from IPython.core.interactiveshell import InteractiveShell
+
+import db
+from bench_magic import FakeSource
+
+
+class ListingSource(FakeSource):
+
+    """ The 'bench' connection type, listing as many tables as it is told to """
+
+    tables = 0
+
+    def list(self, connection, cursor, list_value):
+        return [('table_%s' % i, 'TABLE') for i in range(self.tables)]
+
+
+def per_call(call, rows):
+    """
+    :param call: a function that runs the scenario once
+    :param rows: how many rows each call lists or fetches
+    :returns: the microseconds one call takes, at WARNING and at DEBUG level
+    """
+
+    number = max(1, 100000 // rows)
+    timings = []
+
+    for level in (logging.WARNING, logging.DEBUG):
+        logging.getLogger().setLevel(level)
+        call()
+        timings.append(timeit.timeit(call, number=number) / number * 1e6)
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    return timings
+
+
+def main():
+
+    shell = InteractiveShell.instance()
+    shell.register_magics(db.DbMagic)
+    magics = shell.magics_manager.registry['DbMagic']
+
+    driver = ListingSource()
+    db.register_driver(driver)
+
+    # the DEBUG messages are built, but not shown
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    logging.getLogger().addHandler(handler)
+
+    shell.run_line_magic('db', '-t bench latency=0 -a bench --connect')
+
+    print("%-12s %10s %16s %16s" % ('scenario', 'rows', 'WARNING (us)', 'DEBUG (us)'))
+
+    for rows in (10, 1000, 100000, 500000):
+        driver.tables = rows
+        magics.list_values('bench', 'bench', 'tables', refresh=True)
+
+        timings = per_call(lambda: magics.list_values('bench', 'bench', 'tables'), rows)
+        print("%-12s %10s %16.1f %16.1f" % ('list_values', rows, timings[0], timings[1]))
+
+    for rows in (10, 1000, 100000, 500000):
+        line = '-t bench -a bench SELECT * FROM rows_%s --fetch all' % rows
+
+        timings = per_call(lambda: shell.run_line_magic('db', line), rows)
+        print("%-12s %10s %16.1f %16.1f" % ('fetch', rows, timings[0], timings[1]))
+
+    shell.run_line_magic('db', '--cleanup')
+    logging.getLogger().removeHandler(handler)
+
+
+if __name__ == '__main__':
+    main()
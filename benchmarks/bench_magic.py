@@ -0,0 +1,253 @@
+"""
+Measures the %db and %%db magics end to end against an in-process fake backend, so that
+the cost of the magic itself can be tracked without a live DSN:
+
+- the overhead of one call (argument parsing, source lookup, logging, bookkeeping)
+- fetch throughput at several result sizes
+- a naked query (pooled connection) against the same query on an alias
+- a parameterized command run with the Client, which keeps it prepared
+- a %%db cell with several statements
+- the peak memory of the process after each scenario
+
+The fake backend is registered as the 'bench' connection type.  Its source is a connection
+string like 'latency=0.001;width=5;row_cost=0.000001' and the number of rows a command
+returns is the first number in it, so `SELECT * FROM rows_10000` returns 10000 rows.
+
+Run it from the root of the repository with:
+
+    ipython benchmarks/bench_magic.py -- --output bench_magic.json
+
+and compare the JSON files of two runs to spot regressions.
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from IPython.core.interactiveshell import InteractiveShell
+
+import db
+from bench_fetch import FakeCursor
+
+
+class FakeBackendCursor(FakeCursor):
+
+    """ A FakeCursor that also executes commands, like a DB-API cursor """
+
+    def __init__(self, settings):
+        """
+        :param settings: the latency, width and row_cost parsed from the source
+        """
+
+        FakeCursor.__init__(self, 0, **settings)
+
+        self.description = None
+        self.rowcount = -1
+
+    def execute(self, command, params=None):
+
+        match = re.search(r'(\d+)', command)
+        rows = int(match.group(1)) if match is not None else 0
+
+        time.sleep(self._latency)
+
+        self._remaining = rows
+        self.description = [('column_%s' % i, str, None, None, None, None, True) for i in range(len(self._row))]
+        self.rowcount = rows
+
+    def close(self):
+        pass
+
+
+class FakeBackendConnection(object):
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def cursor(self):
+        return FakeBackendCursor(self.settings)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeSource(db.DBMagicSource):
+
+    """ The 'bench' connection type, a stand-in backend with configurable latency and row width """
+
+    name = 'bench'
+
+    def connect(self, source, username=None, password=None):
+
+        settings = {'width' : 5, 'latency' : 0.0, 'row_cost' : 0.0}
+
+        for part in (source or '').split(';'):
+            if '=' in part:
+                key, value = part.split('=', 1)
+                settings[key.strip()] = int(value) if key.strip() == 'width' else float(value)
+
+        return FakeBackendConnection(settings)
+
+
+def peak_memory():
+    """
+    :returns: the peak resident memory of the process in kilobytes
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # macOS reports bytes, Linux reports kilobytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def measure(name, call, number, rows=0, **details):
+    """
+    Runs a call a number of times and describes how long it took.
+
+    :param name: the name of the scenario
+    :param call: a function that runs the scenario once
+    :param number: how many times to run it
+    :param rows: how many rows each call returns
+    :param details: anything else to record about the scenario
+    :returns: a dictionary with the timings of the scenario
+    """
+
+    gc.collect()
+    call()
+
+    timings = []
+    for i in range(number):
+        started = time.time()
+        call()
+        timings.append(time.time() - started)
+
+    timings.sort()
+    total = sum(timings)
+
+    result = {'name' : name, \
+              'number' : number, \
+              'rows' : rows, \
+              'mean' : total / number, \
+              'p50' : timings[len(timings) // 2], \
+              'p90' : timings[min(len(timings) - 1, int(len(timings) * 0.9))], \
+              'rows_per_second' : rows * number / total if rows and total > 0 else None, \
+              'peak_memory_kb' : peak_memory()}
+    result.update(details)
+
+    print("%-34s %8s %12.1f %12.1f %14s %12s" % (name, number, result['mean'] * 1e6, result['p50'] * 1e6, \
+            '%.0f' % result['rows_per_second'] if result['rows_per_second'] else '-', result['peak_memory_kb']))
+
+    return result
+
+
+def git_commit():
+    """
+    :returns: the commit the repository is on, if it is a git repository
+    """
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], \
+                cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except Exception:
+        return None
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the %db magics against a fake backend')
+    parser.add_argument('--output', help='Write the results as JSON to this file', default=None)
+    parser.add_argument('--latency', help='Seconds each round trip costs (default is 0)', type=float, default=0.0)
+    parser.add_argument('--row-cost', dest='row_cost', help='Seconds each row costs on top of that (default is 0)', type=float, default=0.0)
+    parser.add_argument('--width', help='Columns in each row (default is 5)', type=int, default=5)
+    parser.add_argument('--quick', help='Fewer iterations and smaller results', action='store_true')
+    options = parser.parse_args()
+
+    shell = InteractiveShell.instance()
+    shell.register_magics(db.DbMagic)
+    db.register_driver(FakeSource())
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    source = 'latency=%s;width=%s;row_cost=%s' % (options.latency, options.width, options.row_cost)
+    scale = 10 if options.quick else 1
+
+    line = lambda text: (lambda: shell.run_line_magic('db', text))
+
+    shell.run_line_magic('db', '-t bench %s -a bench --connect' % source)
+
+    print("%-34s %8s %12s %12s %14s %12s" % ('scenario', 'number', 'mean (us)', 'p50 (us)', 'rows/sec', 'peak (KB)'))
+
+    results = []
+
+    # the magic itself, with a query that returns nothing
+    magics = shell.magics_manager.registry['DbMagic']
+    results.append(measure('parse_args', lambda: magics.parse_args('-t bench -a bench SELECT 0 --fetch all'), \
+            5000 // scale))
+    results.append(measure('aliased, no rows', line('-t bench -a bench SELECT 0 --fetch all'), 2000 // scale))
+    results.append(measure('unsourced, no rows', line('-t bench SELECT 0'), 2000 // scale))
+    results.append(measure('naked, no rows', line('-t bench %s SELECT 0' % source), 2000 // scale))
+
+    # the same parameterized command, run straight through the Client on its prepared cursor
+    client = db.Client()
+    results.append(measure('client, parameterized', lambda: client.execute('bench', 'SELECT 0 WHERE id = ?', (1,)), \
+            2000 // scale))
+
+    # fetch throughput at several result sizes
+    for rows in ((100, 1000, 10000) if options.quick else (100, 10000, 100000, 1000000)):
+        number = max(3, 200000 // scale // rows)
+        results.append(measure('aliased, %s rows' % rows, line('-t bench -a bench SELECT %s --fetch all' % rows), \
+                number, rows))
+        results.append(measure('naked, %s rows' % rows, line('-t bench %s SELECT %s' % (source, rows)), \
+                number, rows))
+
+    for option in ('--columnar', '--df', '--stream'):
+        rows = 100000 // scale
+        call = line('-t bench -a bench SELECT %s %s' % (rows, option))
+        if option == '--stream':
+            call = lambda call=call: sum([1 for row in call()])
+        results.append(measure('aliased, %s rows %s' % (rows, option), call, 3, rows, option=option))
+
+    # a cell with several statements on one connection
+    cell = ';\n'.join(['SELECT %s' % (i * 10) for i in range(10)])
+    results.append(measure('cell, 10 statements', lambda: shell.run_cell_magic('db', '-t bench -a bench --fetch all', cell), \
+            500 // scale, 450))
+
+    shell.run_line_magic('db', '--cleanup')
+
+    report = {'benchmark' : 'bench_magic', \
+              'created_at' : time.time(), \
+              'commit' : git_commit(), \
+              'python' : platform.python_version(), \
+              'platform' : platform.platform(), \
+              'latency' : options.latency, \
+              'row_cost' : options.row_cost, \
+              'width' : options.width, \
+              'quick' : options.quick, \
+              'results' : results}
+
+    if options.output is not None:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        print("Wrote the results to %s" % options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Measures the cost of parsing a %db line, with and without the fast path that skips
+argparse for lines with no options (DbMagic.fast_args), on the lines people type most.
+
+Run it from the root of the repository with:
+
+    ipython benchmarks/bench_parse.py
+"""
+
+from __future__ import print_function
+
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from IPython.core.interactiveshell import InteractiveShell
+
+import db
+
+
+LINES = ['SELECT 1', \
+         'SELECT * FROM sales WHERE region = \'EU\'', \
+         'MY_DSN SELECT COUNT(*) FROM sales', \
+         '-a sales SELECT 1', \
+         '-t sqlite :memory: -a mem --connect']
+
+
+def run(magics, line, fast, number):
+    """
+    :param magics: the registered DbMagic
+    :param line: the %db line to parse
+    :param fast: use the fast path when the line allows it
+    :param number: how many times to parse the line
+    :returns: the microseconds one parse takes, the best of three runs
+    """
+
+    db.DbMagic._fast_parse = fast
+
+    return min(timeit.repeat(lambda: magics.parse_args(line), number=number, repeat=3)) / number * 1e6
+
+
+def main():
+
+    shell = InteractiveShell.instance()
+    shell.register_magics(db.DbMagic)
+    magics = shell.magics_manager.registry['DbMagic']
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    number = 2000
+
+    print("%-42s %14s %12s %8s" % ('line', 'argparse (us)', 'fast (us)', 'speedup'))
+
+    for line in LINES:
+        slow = run(magics, line, False, number)
+        fast = run(magics, line, True, number)
+        print("%-42s %14.1f %12.1f %7.1fx" % (line, slow, fast, slow / fast))
+
+    db.DbMagic._fast_parse = True
+
+
+if __name__ == '__main__':
+    main()
@@ -4,1012 +4,5979 @@ from IPython.core.magic import (Magics, magics_class, line_magic,
 
 from IPython.core.magic_arguments import (argument, magic_arguments, parse_argstring)
 
-import pyodbc
 import logging
+import time
+import threading
+import itertools
+import Queue
+import json
+import math
+import sys
+import re
+import datetime
+import decimal
+import os
+import shutil
+import cPickle
+import sqlite3
+import importlib
+import bisect
+import copy
+import hashlib
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict, deque, namedtuple
 from inspect import stack
+from contextlib import contextmanager
+
+try:
+    import pyodbc
+except ImportError:
+    pyodbc = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+DEFAULT_STREAM_BATCH = 1000
+DEFAULT_ARROW_HOLD = 10 * DEFAULT_STREAM_BATCH
+DEFAULT_FETCH_MEMORY = 64 * 1024 * 1024
+DEFAULT_FAN_OUT_WORKERS = 8
+DEFAULT_INSERT_BATCH = 10000
+DEFAULT_CACHE_TTL = 300
+DEFAULT_PERSIST_DIR = os.path.join(os.path.expanduser('~'), '.db_magic', 'persist')
+DEFAULT_CATALOG_TTL = 3600
+DEFAULT_CATALOG_FILE = os.path.join(os.path.expanduser('~'), '.db_magic', 'catalog.sqlite')
+DEFAULT_STATEMENT_CACHE = 32
 
 class DBMagicSource(object):
 
-	""" A generic wrapper for a data source """
-
-	def __init__(self, odbc_args):
-		"""
-		:param odbc_args: the arguments parsed from @magic_arguments
-		:returns: formatted string
-		"""
-	
-		pass
-	
-	def explain(self, alias, key, cmd, fetch, args, line):
-		"""
-		Explains the operations that are going to be done as part of the command line invocation
-
-		:param alias: the plain english name to associate with this connection
-		:param type: the type of connection to use
-		:param key: the key that will be used to find the correct connection.
-		:param cmd: the command that will be executed 
-		:param fetch: the argument for fetching data or not
-		:param args: all the arguments passed to the class
-		:param line: the command line used to call the class
-
-		"""
-
-		pass
-	
-	def connect_to_source(self, connection_source, username=None, password=None):
-		"""
-		Establishes a connection to a data source and removes the alias.
-
-		:param connection_source: the name of an an ODBC DSN or connection string
-		:param username: the username to use for a connection (optional)
-		:param password: connection_source: the password to use for a connection (optional)
-		:returns: formatted string
-
-		"""
-		pass
-	
-	def disconnect_from_source(self):
-		"""
-		Disconnects a particular connection to a data source and removes the alias.
-
-		"""
-
-		pass
-	
-	def execute_command(self, command, fetch):
-		"""
-		Execute a command on a remote data source
-
-		NOTE: this will not return a value, just execute the command.  Use fetch() 
-
-		:param command:  the command to execute at the connection
-
-		"""
-	
-		pass
-	
-	def fetch(self, fetch):
-		"""
-		Fetch the results from a previous command.  This is always used in conjunction
-		with the execute_command() function, either implicitly or explicitly.
-
-		:param fetch: how many records to fetch, either a positive integer or 'all'
-
-		"""
-
-		pass
-	
-	def commit(self):
-		"""
-		commit the results from a previous command.  This is always used in conjunction
-		with the execute_command() function, either implicitly or explicitly.
-
-		"""
-
-		pass
-	
-	def list_values(self, list_value):
-		"""
-		commit the results from a previous command.  This is always used in conjunction
-		with the execute_command() function, either implicitly or explicitly.
-
-		:param list_value: the thing inside the database to list
-
-		"""
-
-		pass
-	
-	def cleanup(self):
-		" shutting down all connections properly"
-		
-		pass
-	
+    """
+    The driver protocol for a type of data source.
 
-class ODBCSource(DBMagicSource):
+    A driver doesn't hold any connections itself.  It opens DB-API style connections and
+    runs everything on the connections and cursors it is handed, so the registry, the
+    pool and the async workers keep holding plain connection objects.  The defaults
+    below follow DB-API 2.0, so a driver only overrides what its module does differently,
+    and has to implement connect().
+    """
 
-    _connection = None
-    _cursor = None
-    _is_connected = False
+    __metaclass__ = ABCMeta
 
+    name = None
 
-    def explain(self, alias, key, cmd, fetch, args, line):
+    # the exceptions the driver raises, and the ones a fetch raises when there are no results
+    errors = (Exception,)
+    no_results_errors = ()
+
+    # how the driver marks the parameters in a command, see PEP 249
+    paramstyle = 'qmark'
+
+    @abstractmethod
+    def connect(self, source, username=None, password=None):
         """
-        Explains the operations that are going to be done as part of the command line invocation
+        Opens a new connection to a data source.
 
-        :param alias: the plain english name to associate with this connection
-        :param type: the type of connection to use
-        :param key: the key that will be used to find the correct connection.
-        :param cmd: the command that will be executed 
-        :param fetch: the argument for fetching data or not
-        :param args: all the arguments passed to the class
-        :param line: the command line used to call the class
+        :param source: the name of the data source, in whatever form the driver takes it
+        :param username: the username to use for a connection (optional)
+        :param password: the password to use for a connection (optional)
+        :returns: the new connection
 
         """
 
-        print("Command Line called : %%db %s" % line)
-        print("-------------------")
-        print("Args Parsed: %s" % args)
-        print("-------------------")
-        print("Data Source to Use: %s" % args.source)
-        print("Data Source Type: %s" % args.type)
-        print("Data Source Alias: %s" % alias)
-        print("Command to Execute: %s" % cmd)
-        print("Execution Notes: %s" % str(args.note))
-        print("-------------------")
-        print("Open Connections: %s" % self._conn_info)
-        print("-------------------")
-        print("Is this a Naked Query?: %s" % args.naked)
-        print("Is this a Unsourced Query?: %s" % args.unsourced)
-        print("-------------------")
-        print("Are we Connecting to DB?: %s" % (args.connect or args.naked))
-        print("Are we Commiting Transaction?: %s" % (args.commit))
-        print("Are we Fetching records?: %s" % fetch)
-        print("Are we Listing values?: %s" % args.list)
-        print("Are we Disconnecting from DB?: %s" % (args.disconnect or args.naked))
-        print("=========================================================")
+        raise NotImplementedError("The %s driver doesn't implement connect()" % self.name)
 
-    def connect_to_source(self, connection_source, username=None, password=None):
+    def is_source(self, word):
         """
-        Establishes a connection to a data source and removes the alias.
+        Tells whether the first word of a %db line names a data source of this driver, which
+        makes the line a naked query (%db <source> <cmd>) rather than a command on the default alias.
 
-        :param connection_source: the name of an an ODBC DSN or connection string
-        :param username: the username to use for a connection (optional)
-        :param password: connection_source: the password to use for a connection (optional)
-        :returns: formatted string
+        :param word: the first word of the line
+        :returns: boolean, True if the word is a data source
+        """
+
+        return True
 
+    def cursor(self, connection):
+        """
+        :param connection: a connection from connect()
+        :returns: a new cursor on the connection
         """
 
-        try:
-            logging.debug("Attempting to connect")
-            if (len(username) > 0 and len(password) > 0):
-                self._connection = pyodbc.connect(connection_source,uid=username,pwd=password)
-            else:
-                self._connection = pyodbc.connect(connection_source)
-            self._cursor = self._connection.cursor()
-            self._is_connected = True
-        except pyodbc.Error, err:
-            logging.error(self._connection)
-            logging.error(err[1])
-            raise err
+        return connection.cursor()
+
+    def execute(self, cursor, command, params=None):
+        """
+        Executes a command on a cursor, leaving any results pending.
+
+        :param cursor: the cursor to execute the command on
+        :param command: the command to execute
+        :param params: the values for the parameter markers in the command (optional)
 
-    def disconnect_from_source(self):
         """
-        Disconnects a particular connection to a data source and removes the alias.
 
+        if params is None:
+            cursor.execute(command)
+        else:
+            cursor.execute(command, params)
+
+    def executemany(self, cursor, command, rows, fast=False):
+        """
+        Executes a command once for each row of parameters.
+
+        :param cursor: the cursor to execute the command on
+        :param command: the command to execute
+        :param rows: a list of tuples of values for the parameter markers
+        :param fast: use pyodbc's fast_executemany, which sends all of the rows as one round trip
         """
 
+        fast = fast and hasattr(cursor, 'fast_executemany')
+
+        if fast:
+            cursor.fast_executemany = True
+
         try:
-            logging.debug("Attempting to disconnect")
-            cursor = self._cursor.close()
-            cnxn = self._connection.close()
-            self._is_connected = False
-        except pyodbc.Error, err:
-            logging.error(err[1])
-            raise err
+            cursor.executemany(command, rows)
+        finally:
+            if fast:
+                cursor.fast_executemany = False
 
-        logging.debug("Disconnected data source")
-        
-    def execute_command(self, command, fetch):
+    def prepare(self, cursor, command):
         """
-        Execute a command on a remote data source
+        Prepares a command on a cursor ahead of its first execute(), for drivers that can.
+        Drivers like pyodbc prepare the command in the first execute() instead, and keep it
+        prepared as long as the cursor runs the same command.
 
-        NOTE: this will not return a value, just execute the command.  Use fetch() 
+        :param cursor: the cursor that will run the command
+        :param command: the command to prepare
+        """
 
-        :param command:  the command to execute at the connection
+        if hasattr(cursor, 'prepare'):
+            cursor.prepare(command)
+
+    def close_results(self, cursor):
+        """
+        Drops the pending results of a cursor without closing it, so the connection can run a
+        command on another cursor and the command of this one stays prepared.
 
+        :param cursor: a cursor that may have pending results
         """
 
-        if len(command) > 0:
+        if cursor.description is not None and hasattr(cursor, 'nextset'):
             try:
-                logging.debug("Attempting to execute '%s'" % command)
-                self.__cursor.execute(command)
-            except pyodbc.Error, err:
-                logging.error(err[1])
-                raise err
-        else:
-                logging.debug("Skipping empty command.")
+                while cursor.nextset():
+                    pass
+            except self.errors, err:
+                logging.debug(" ---- The results of %s can't be dropped: %s", cursor, err)
 
-    def fetch(self, fetch):
+    def markers(self, count):
+        """
+        :param count: how many parameters there are
+        :returns: the parameter markers for a command, separated by commas
         """
-        Fetch the results from a previous command.  This is always used in conjunction
-        with the execute_command() function, either implicitly or explicitly.
 
-        :param fetch: how many records to fetch, either a positive integer or 'all'
+        if self.paramstyle in ('format', 'pyformat'):
+            return ', '.join(['%s'] * count)
+        elif self.paramstyle in ('numeric', 'named'):
+            return ', '.join([':%s' % (i + 1) for i in range(count)])
 
-        """
+        return ', '.join(['?'] * count)
 
-        try:
+    def fetch_batches(self, cursor, sizer, max_rows=None):
+        """
+        :param cursor: a cursor with a pending result set
+        :param sizer: an AdaptiveBatchSizer that picks the size of each round trip
+        :param max_rows: stop after this many rows (optional)
+        :returns: an iterator over the batches of rows
+        """
 
-            cursor = self._cursor
-            description = []
-
-            if (isinstance(fetch, str) or isinstance(fetch, unicode)) and 'all' in fetch:
-                logging.debug("Running cursor.fetchall()")
-                return cursor.fetchall()
-            elif (long(fetch) == 0):
-                logging.debug("Running cursor.fetchall()")
-                return cursor.fetchall()
-            elif long(fetch) > 0:
-                logging.debug("Running cursor.fetchmany(%s)" % long(fetch))
-                return cursor.fetchmany(long(fetch))
-            else:
-                logging.debug("'%s' is an invalid number of rows to fetch" % fetch)
+        return fetch_batches(cursor, sizer, max_rows)
 
-        except pyodbc.ProgrammingError, err:
-            logging.warning(err)
-            pass
-        except pyodbc.Error, err:
-            logging.error(err)
-            raise err
-                    
-    def commit(self):
+    def arrow_batches(self, cursor, sizer, max_rows=None, hold_rows=DEFAULT_ARROW_HOLD):
         """
-        commit the results from a previous command.  This is always used in conjunction
-        with the execute_command() function, either implicitly or explicitly.
+        Fetches the pending results of a cursor as Arrow record batches.
+
+        Cursors that can build Arrow data themselves (like turbodbc's fetcharrowbatches())
+        are asked for it, the rest have their rows converted one batch at a time.
 
+        :param cursor: a cursor with a pending result set
+        :param sizer: an AdaptiveBatchSizer that picks the size of each round trip
+        :param max_rows: stop after this many rows (optional)
+        :param hold_rows: the most rows to hold back waiting for the types of NULL columns, see ArrowConverter
+        :returns: an iterator over pyarrow.RecordBatch objects
         """
 
-        logging.debug("Commiting cursor")
+        if hasattr(cursor, 'fetcharrowbatches'):
+            logging.debug(" ---- Running cursor.fetcharrowbatches()")
+            return limit_record_batches(cursor.fetcharrowbatches(), max_rows)
 
-        if not self.is_connected:
-            logging.debug("This object is not connected")
-            return
-        try:
-            self._cursor.commit()
-        except pyodbc.Error, err:
-            logging.error(err)
+        return arrow_batches(cursor, sizer, max_rows, self.fetch_batches, hold_rows)
 
-    def list_values(self, list_value):
+    def fetch_arrow(self, cursor, sizer, max_rows=None):
         """
-        commit the results from a previous command.  This is always used in conjunction
-        with the execute_command() function, either implicitly or explicitly.
+        Fetches the pending results of a cursor as an Arrow table.
 
-        :param list_value: the thing inside the database to list
+        When all of the rows are wanted, cursors that return a whole table themselves (like
+        fetch_arrow_table() or turbodbc's fetchallarrow()) are asked for it.
 
+        :param cursor: a cursor with a pending result set
+        :param sizer: an AdaptiveBatchSizer that picks the size of each round trip
+        :param max_rows: stop after this many rows (optional)
+        :returns: a pyarrow.Table
         """
 
-        if not self._is_connected and list_value != 'sources':
-            logging.debug("This object is not connected")
-            return
-        try:
-            logging.debug("The list value is '%s'" % list_value)
-            results = []
-            if list_value == 'tables':
-                logging.debug("Listing tables.")
-                cursor = self._cursor
-                for row in cursor.tables():
-                    results.append(row)
-            elif list_value == 'procedures':
-                logging.debug("Listing procedures.")
-                cursor = self._conn_info[connection_alias]['cursor']
-                for row in cursor.procedures():
-                    results.append(row)
-            elif list_value == 'sources':
-                logging.debug("Listing sources")
-
-                for row in pyodbc.dataSources():
-                    results.append(row)
-            else:
-                raise Exception(stack()[0][3], "The list value provided ('%s') is not valid.  No connection made" % list_value)
+        if max_rows is None:
+            for method in ('fetch_arrow_table', 'fetchallarrow'):
+                if hasattr(cursor, method):
+                    logging.debug(" ---- Running cursor.%s()", method)
+                    return getattr(cursor, method)()
 
-        except pyodbc.Error, err:
-            logging.error(err)
-            raise err
+        # every row ends up in memory anyway, so NULL columns can wait for their types to the end
+        batches = list(self.arrow_batches(cursor, sizer, max_rows, hold_rows=None))
 
-        return results
+        if not batches:
+            return empty_table(cursor.description)
 
-    def cleanup(self):
+        return pyarrow.Table.from_batches(batches)
 
-        shutdown_had_problems = False
+    def commit(self, connection):
+        """
+        :param connection: the connection to commit
+        """
 
-        try:
-            logging.debug("Closing %s" % alias)
-            self.disconnect_from_source()
-        except Exception, err:
-            logging.warning("There was a problem shutting down")
-            shutdown_had_problems = True
-        finally:
-            if shutdown_had_problems:
-                raise Exception(stack()[0][3], "This object could not be shut down.")
+        connection.commit()
 
-    def __del__(self):
+    def rollback(self, connection):
+        """
+        :param connection: the connection to roll back
+        """
 
-        if self._is_connected:
-            self.cleanup()
+        connection.rollback()
 
-@magics_class
-class DbMagic(Magics):
+    def list(self, connection, cursor, list_value):
+        """
+        :param connection: the connection to list things about
+        :param cursor: a cursor on the connection
+        :param list_value: the thing inside the database to list, like 'tables' or 'procedures'
+        :returns: a list of rows
+        """
 
-    _most_recent_conn_alias = ''
-    _default_conn_alias = ''
-    _conn_info = {}
-    _args = {}
+        raise Exception(stack()[0][3], "The %s driver can't list %s" % (self.name, list_value))
 
-    @magic_arguments()
-    @argument('source', type=str, help='The identifier of the data source (optional)',default='', nargs='?')
-    @argument('cmd', type=str, help='A command to be executed (optional)',default='', nargs='*')
-    @argument('-src', '--source', help='The data source to use (optional).', action="store")
-    @argument('-a', '--alias', help='The key to refer to this connection with', action="store")
-    @argument('-def', '--default', help='The key to refer to this connection with', action="store")
-    @argument('-c', '--connect', '--conn', help='Connect to this database', action="store_true")
-    @argument('-d', '--disconnect', '--dis', help='Disconnect from this datbase', action="store_true")
-    @argument('-t', '--type', help='Connection type (ODBC is the default)', action="store", default="odbc")
-    @argument('-l', '--list', help='List things about the database.', action="store", nargs='?')
-    @argument('-e', '--execute', '--exec', help='Some SQL to execute', action="store_true")
-    @argument('-m', '--commit', help='Commit this transaction.', action="store_true")
-    @argument('-r', '--rollback', help='Rollback this transaction.', action="store_true")
-    @argument('-n', '--naked', help='Run a naked query (same as --connect --execute --fetch --disconnect)', action="store_true")
-    @argument('--unsourced', help='Run an unsourced query (same as --connect --execute --fetch --disconnect)', action="store_true")
-    @argument('-f', '--fetch', help='Fetch one or more records (default is all)', action="store", default=0,nargs='?')
-    @argument('-u', '--uid', '--username', help='The user name to use (optional).', action="store", default='')
-    @argument('-p', '--pwd', '--password', help='The password to use (optional).', action="store", default='')
-    @argument('-h', '--help', help='Display help.', action="store_true")
-    @argument('-v', '--verbose', help='Display debugging verbosely (same as --debug=DEBUG', action="store_true")
-    @argument('--debug', help='Output debugging info', action="store", default='WARNING',nargs='?')
-    @argument('-y', '--dry_run', '--dry', help='Make this a dry run', action="store_true")
-    @argument('--explain', help='Give an explanation on exac', action="store_true")
-    @argument('--note', help='Add a note for help with debugging', action="store", nargs="*")
-    @argument('--cleanup', help='Clean up all the connections and shut down', action="store_true")
+    def set_timeout(self, connection, seconds):
+        """
+        Has the database stop the statements on a connection that run too long, if it can.
 
-    def parse_args(self,magic_args):
+        :param connection: an open connection
+        :param seconds: the most seconds a statement can run, or None for no limit
+        :returns: boolean, True if the driver enforces the timeout itself
         """
-        parses the arguments from the ipython magic call
 
-        Everything is pretty straightforward here except for special convienence cases
-       
-        %db <source> <cmd>    [or a naked query]
-        %db <cmd>             [or an unsourced query]
+        return False
 
-       This is how most users would expect to call the function.  However, this means we
-       have to infer a hell of a lot of things based on very little information.
-       
-        There are also a few challenges here:
-          1. The cmd argument can be multiple words, or empty.
-          2. The source argument is optional, if we just have cmd then we need to find source.
-          3. The options are all optional, so we need to interpret what is really meant.
+    def cancel(self, cursor):
+        """
+        Stops the statement that is running on a cursor, from another thread.
 
-        If we have both arguments, no problem.  However, we can't really tell if this is the,
-        case except by testing to see if we already have a data source that matches what is 
-        specified.  If there is no match, then we can use the default data source unless
-        this is a new connection.
+        :param cursor: the cursor to cancel
+        """
 
-        :param magic_args: the arguments to be parsed from @magic_arguments
-        :returns: formatted string
+        if hasattr(cursor, 'cancel'):
+            cursor.cancel()
+        elif hasattr(getattr(cursor, 'connection', None), 'cancel'):
+            cursor.connection.cancel()
+        else:
+            raise Exception(stack()[0][3], "The %s driver can't cancel a running statement" % self.name)
 
+    def close(self, connection):
+        """
+        :param connection: the connection to close
         """
 
-        no_alias_provided = False
-        
-        # parse the arguments and assign them to a class-level variable
-        self._args = parse_argstring(self.parse_args, magic_args)
+        connection.close()
 
-        logging.debug(' -- The parsed arguments are: %s' % self._args)
+    def driver_name(self, connection):
+        """
+        :param connection: an open connection
+        :returns: the name of the driver or DBMS, used to work out the SQL dialect
+        """
 
-        #############################################################################
-        # the key/value store uses the alias, so if there isn't one just set it
-        # to the source so we have a uniform way of dealing with things
-        #############################################################################
-        if self._args.alias is None:
-            logging.debug(" --- No alias provided, using %s" % (self._args.source))
-            no_alias_provided = True
-            self._args.alias = self._args.source
+        return self.name
 
-        connection_alias = self._args.alias
-        connection_key = self._args.source
-        connection_cmd = ' '.join(self._args.cmd)
-        connection_fetch = self._args.fetch
+    def health_query(self, connection):
+        """
+        :param connection: an open connection
+        :returns: the cheapest query that makes a round trip to the database
+        """
 
-        ##############################################################################
-        # handling the special situation of %db <source> <cmd> (or a NAKED QUERY)
-        #
-        # We know that we:
-        #
-        # 1. Will have our positional arguments (either source and cmd or just cmd) defined.
-        # 2. Will NOT have an existing connection with the same name.
-        # 3. Will NOT have connection-specific options (like alias, connect, execute, disconnect)
-        # 4. May have record-filtering options (like fetch and skip)
-        # 5. May have incidental options(like debug, user, pass)
-        #
-        # Also, the line_magic function is set up so that if you pass multiple options, they will
-        # be executed in the correct order.  For example, if you have a call like:
-        #
-        #   %db <source> <cmd> --connect --skip 10 --fetch --disconnect
-        #
-        # we can rely on the fact that things will be handled properly.
-        ##############################################################################
+        try:
+            dialect = detect_dialect(self.driver_name(connection))
+        except self.errors, err:
+            logging.debug(" ---- The driver name can't be read, using the ANSI health query: %s", err)
+            dialect = 'ansi'
 
-        imply_naked_query =  \
-            (self._args.source is not None) and \
-            (self._args.source in \
-                self.list_values( \
-                    self._args.alias,  \
-                    self._args.type, \
-                    'sources')) and \
-            (self._args.cmd is not None) and \
-            (len(self._args.cmd) > 0) and \
-            (connection_key not in self._conn_info.keys()) and \
-            (self._args.list is None) and \
-            (no_alias_provided and \
-                not self._args.connect and \
-                not self._args.execute and \
-                not self._args.disconnect )
+        return HEALTH_QUERIES.get(dialect, HEALTH_QUERIES['ansi'])
 
-        if (self._args.naked or imply_naked_query ):
-            logging.debug(" --- This is a naked query with source '%s' and cmd '%s'" %(connection_alias, connection_cmd))
-            self._args.naked = True
-            self._args.fetch = 'all'
-            connection_fetch = 'all'
-            logging.debug(" --- Changing fetch to %s" % (self._args.fetch))
-        else:
-            logging.debug(' --- This is not a naked query')
+    def __repr__(self):
+        return "<%s '%s'>" % (self.__class__.__name__, self.name)
 
-        ##############################################################################
-        # handling the special situation of %db <cmd> (or an UNSOURCED QUERY)
-        #
-        # We know that we:
-        #
-        # 1. Will have our positional arguments (either source and cmd or just cmd) defined.
-        # 2. Will have an existing connection with the same name.
-        # 3. Will NOT have connection-specific options (like alias, connect, execute, disconnect)
-        # 4. May have record-filtering options (like fetch and skip)
-        # 5. May have incidental options(like debug, user, pass)
-        #
-        ##############################################################################
-        imply_unsourced_query =  \
-            (self._args.source is not None) and \
-            (self._args.source not in \
-                self.list_values( \
-                    self._args.alias,  \
-                    self._args.type, \
-                    'sources')) and \
-            (self._args.cmd is not None) and \
-            (self._args.list is None) and \
-            (no_alias_provided and \
-                not self._args.cleanup and \
-                not self._args.connect and \
-                not self._args.execute and \
-                not self._args.disconnect )
 
-        if (imply_unsourced_query ):
-            logging.debug(" --- This is an unsourced query with source '%s' and cmd '%s'" %(connection_alias, connection_cmd))
-            self._args.unsourced = True
-            self._args.fetch = 'all'
-            connection_fetch = 'all'
-            logging.debug(" --- Changing fetch to %s " % (self._args.fetch))
-        else:
-            logging.debug(" --- This is NOT unsourced query with source '%s' and cmd '%s'" %(connection_alias, connection_cmd))
+class ODBCSource(DBMagicSource):
 
-        if connection_key not in self._conn_info.keys() and \
-                not self._args.naked and \
-                not self._args.unsourced:
-            # this is not a new connection and not an established source, we assume 
-            # this is a command line like %db <exec> and fix the command
-            try:
-                if self._args.connect:
-                    self._args.cmd = self_args.cmd[1:]
-                    connection_cmd = ' '.join(self._args.cmd)
-                    logging.debug(" --- Removing %s from %s into '%s'" % (connection_key, self._args.cmd, connection_cmd))
-                else:
-                    self._args.cmd.insert(0,connection_key)
-                    connection_cmd = ' '.join(self._args.cmd)
-                    logging.debug(" --- Merging %s and %s into '%s'" % (connection_key, self._args.cmd, connection_cmd))
-            except:
-                pass
+    """ Data sources reached through an ODBC driver manager with pyodbc """
 
-        if self._args.unsourced:
+    name = 'odbc'
 
-            if len(self._args.cmd) > 0:
-                self._args.cmd.insert(0,connection_key)
-                connection_cmd = ' '.join(self._args.cmd)
-                logging.debug(" --- Merging %s and %s into '%s'" % (connection_key, self._args.cmd, connection_cmd))
+    def __init__(self):
 
-            logging.debug(" ---Assigning alias from the default as %s" % (self._default_conn_alias))
-            self._args.alias = self._default_conn_alias
-            connection_alias = self._args.alias
+        if pyodbc is not None:
+            self.errors = (pyodbc.Error,)
+            self.no_results_errors = (pyodbc.ProgrammingError,)
 
-            logging.debug(" ---Assigning source from the default as %s" % (self._default_conn_alias))
-            self._args.source = self._default_conn_alias
-            connection_key = self._args.source
+    def connect(self, source, username=None, password=None):
+
+        if pyodbc is None:
+            raise Exception(stack()[0][3], "ODBC connections need pyodbc, which is not installed.")
+
+        if username and password:
+            return pyodbc.connect(source, uid=username, pwd=password)
+
+        return pyodbc.connect(source)
+
+    def list(self, connection, cursor, list_value):
+
+        if list_value == 'tables':
+            return [row for row in cursor.tables()]
+        elif list_value == 'procedures':
+            return [row for row in cursor.procedures()]
+        elif list_value == 'columns':
+            return [row for row in cursor.columns()]
+
+        return DBMagicSource.list(self, connection, cursor, list_value)
+
+    def set_timeout(self, connection, seconds):
+
+        # pyodbc sets SQL_ATTR_QUERY_TIMEOUT on each statement from this, 0 is no limit
+        connection.timeout = int(math.ceil(seconds)) if seconds else 0
+
+        return True
+
+    def driver_name(self, connection):
+
+        return '%s %s' % (connection.getinfo(pyodbc.SQL_DBMS_NAME), connection.getinfo(pyodbc.SQL_DRIVER_NAME))
+
+
+class SQLiteSource(DBMagicSource):
+
+    """ SQLite databases through the sqlite3 module, no driver manager needed """
+
+    name = 'sqlite'
+    errors = (sqlite3.Error,)
+
+    def connect(self, source, username=None, password=None):
+
+        # async queries and fan outs use the connection from other threads
+        return sqlite3.connect(source or ':memory:', check_same_thread=False)
+
+    def is_source(self, word):
+
+        # connecting creates the file, so a SQL keyword must not be taken for a new database
+        return word == ':memory:' or os.path.exists(word) or \
+                re.search(r'\.(db|db3|sqlite|sqlite3)$', word, re.IGNORECASE) is not None
+
+    def list(self, connection, cursor, list_value):
+
+        if list_value == 'tables':
+            cursor.execute("SELECT name, type FROM sqlite_master WHERE type IN ('table', 'view') ORDER BY name")
+            return cursor.fetchall()
+        elif list_value == 'columns':
+            cursor.execute("SELECT m.name AS table_name, c.name AS column_name, c.type AS type_name, " \
+                    "NOT c.\"notnull\" AS nullable, c.pk AS primary_key " \
+                    "FROM sqlite_master m JOIN pragma_table_info(m.name) c " \
+                    "WHERE m.type IN ('table', 'view') ORDER BY m.name, c.cid")
+            return cursor.fetchall()
+
+        return DBMagicSource.list(self, connection, cursor, list_value)
+
+    def cancel(self, cursor):
+
+        cursor.connection.interrupt()
+
+
+class DBAPISource(DBMagicSource):
+
+    """
+    Any DB-API 2.0 module, used with --type dbapi:<module>.
+
+    The source is passed to module.connect() as it is, with user and password keywords if
+    they are given.  That fits most native drivers (psycopg2, pymysql, cx_Oracle,
+    teradatasql and so on) without going through an ODBC driver manager.
+    """
+
+    def __init__(self, module_name):
+        """
+        :param module_name: the name of the module to import
+        """
+
+        try:
+            self.module = importlib.import_module(module_name)
+        except ImportError:
+            raise Exception(stack()[0][3], "The DB-API module '%s' is not installed." % module_name)
+
+        self.name = 'dbapi:%s' % module_name
+        self.paramstyle = getattr(self.module, 'paramstyle', 'qmark')
+        self.errors = (getattr(self.module, 'Error', Exception),)
+
+        if hasattr(self.module, 'ProgrammingError'):
+            self.no_results_errors = (self.module.ProgrammingError,)
+
+    def connect(self, source, username=None, password=None):
+
+        keywords = {}
+        if username:
+            keywords['user'] = username
+        if password:
+            keywords['password'] = password
+
+        return self.module.connect(source, **keywords)
+
+    def is_source(self, word):
+
+        # connection strings have key=value pairs or are URLs (or, for file databases, are a
+        # path that is already there), a bare word is more likely SQL
+        return '=' in word or '://' in word or os.path.exists(word)
+
+    def list(self, connection, cursor, list_value):
+
+        if list_value == 'tables':
+            cursor.execute("SELECT table_catalog, table_schema, table_name, table_type FROM information_schema.tables")
+            return cursor.fetchall()
+        elif list_value == 'procedures':
+            cursor.execute("SELECT routine_catalog, routine_schema, routine_name, routine_type FROM information_schema.routines")
+            return cursor.fetchall()
+        elif list_value == 'columns':
+            cursor.execute("SELECT table_catalog, table_schema, table_name, column_name, data_type, is_nullable " \
+                    "FROM information_schema.columns ORDER BY table_schema, table_name, ordinal_position")
+            return cursor.fetchall()
+
+        return DBMagicSource.list(self, connection, cursor, list_value)
+
+    def driver_name(self, connection):
+
+        return self.module.__name__
+
+
+DRIVERS = {}
+
+def register_driver(driver, *names):
+    """
+    Makes a driver available to --type.
+
+    :param driver: a DBMagicSource
+    :param names: the names to register it under (the default is driver.name)
+    """
+
+    for name in (names or (driver.name,)):
+        DRIVERS[name.lower()] = driver
+
+def get_driver(connection_type):
+    """
+    :param connection_type: the --type of a connection, like 'odbc', 'sqlite' or 'dbapi:psycopg2'
+    :returns: the DBMagicSource for the type
+    """
+
+    key = (connection_type or 'odbc').lower()
+
+    if key not in DRIVERS and key.startswith('dbapi:'):
+        register_driver(DBAPISource(connection_type[len('dbapi:'):]), key)
+
+    if key not in DRIVERS:
+        raise Exception(stack()[0][3], \
+                "The type provided ('%s') is not valid, the types are %s" % (connection_type, sorted(DRIVERS.keys())))
+
+    return DRIVERS[key]
+
+register_driver(ODBCSource())
+register_driver(SQLiteSource(), 'sqlite', 'sqlite3')
+
+class ResultSummary(object):
+
+    """
+    Describes a result set in a log message by its size and a short preview.
+
+    The description is only built if the message is actually emitted, so logging a
+    500k row fetch at WARNING level costs nothing.
+    """
+
+    def __init__(self, results, preview=3, width=200):
+        """
+        :param results: whatever a list or fetch returned
+        :param preview: how many rows to show
+        :param width: the most characters to show of the preview
+        """
+
+        self.results = results
+        self.preview = preview
+        self.width = width
+
+    def __str__(self):
+
+        results = self.results
+
+        if isinstance(results, (list, tuple)):
+            preview = repr(list(results[:self.preview]))
+            if len(preview) > self.width:
+                preview = preview[:self.width] + '...'
+            return "%s rows, starting with %s" % (len(results), preview)
+
+        description = repr(results)
+        if len(description) > self.width:
+            description = description[:self.width] + '...'
+
+        return description
+
+class SourceCatalog(object):
+
+    """
+    A cached view of the data sources known to the ODBC driver manager.
+
+    Enumerating pyodbc.dataSources() can be slow on hosts with large odbc.ini files, and
+    every %db call needs to know whether its first word is a DSN.  The catalog is loaded
+    at most once per TTL window and answers membership tests against a set.
+    """
+
+    def __init__(self, ttl=300):
+        """
+        :param ttl: how many seconds the cached sources stay valid (None never expires)
+        """
+
+        self.ttl = ttl
+        self.refresh_count = 0
+        self._sources = {}
+        self._names = frozenset()
+        self._loaded_at = None
+
+    def is_stale(self):
+        """
+        :returns: boolean, True if the sources need to be enumerated again
+        """
+
+        if self._loaded_at is None:
+            return True
+
+        return self.ttl is not None and (time.time() - self._loaded_at) > self.ttl
+
+    def refresh(self):
+        """
+        Enumerates the data sources from the driver manager and replaces the cache.
+
+        """
+
+        logging.debug(" --- Refreshing the data source catalog")
+
+        if pyodbc is None:
+            # without pyodbc there is no driver manager, so there are no DSNs
+            sources = {}
+        else:
+            try:
+                sources = dict(pyodbc.dataSources())
+            except pyodbc.Error, err:
+                logging.error(err)
+                raise err
+
+        self._sources = sources
+        self._names = frozenset(sources.keys())
+        self._loaded_at = time.time()
+        self.refresh_count += 1
+
+    def invalidate(self):
+        """
+        Forces the next lookup to enumerate the data sources again.
+
+        """
+
+        self._loaded_at = None
+
+    def sources(self):
+        """
+        :returns: a dictionary of DSN names to driver names
+        """
+
+        if self.is_stale():
+            self.refresh()
+
+        return self._sources
+
+    def names(self, refresh=True):
+        """
+        :param refresh: enumerate the data sources again if the cache is stale
+        :returns: a list of the DSN names
+        """
+
+        if not refresh:
+            return list(self._names)
+
+        return list(self.sources().keys())
+
+    def driver(self, name):
+        """
+        :param name: the DSN to look up
+        :returns: the name of the driver for the DSN, or None if it is unknown
+        """
+
+        return self.sources().get(name)
+
+    def __contains__(self, name):
+
+        if self.is_stale():
+            self.refresh()
+
+        return name in self._names
+
+# the columns that hold the catalog, schema and name of an object, in the order they are
+# looked for, across ODBC catalog functions, information_schema and sqlite_master
+CATALOG_FIELDS = {'catalog' : ('table_cat', 'procedure_cat', 'table_catalog', 'routine_catalog'), \
+                  'schema' : ('table_schem', 'procedure_schem', 'table_schema', 'routine_schema'), \
+                  'name' : ('table_name', 'procedure_name', 'routine_name', 'name')}
+
+CATALOG_KINDS = ('tables', 'procedures', 'columns')
+
+def catalog_key(entry):
+    """
+    The catalog is cached per source and login rather than per alias, so aliases that connect
+    the same way share one listing, but logins with different grants never see each other's.
+
+    :param entry: a ConnectionEntry
+    :returns: the name the catalog of its source is cached under, without any password
+    """
+
+    return '%s:%s@%s' % (entry.type, entry.username or '', re.sub(r'(?i)(pwd|password)=[^;]*;?', '', entry.source or ''))
+
+def like_pattern(value):
+    """
+    :param value: a pattern with % or * for any characters and _ or ? for one
+    :returns: a compiled regular expression that matches the whole of a value, ignoring case
+    """
+
+    regex = ''.join(['.*' if c in '%*' else '.' if c in '_?' else re.escape(c) for c in value])
+
+    return re.compile(regex + '$', re.IGNORECASE)
+
+
+class CatalogListing(object):
+
+    """ The tables, procedures or columns of one data source, as they were listed """
+
+    def __init__(self, names, rows, loaded_at=None):
+        """
+        :param names: the names of the columns of the rows
+        :param rows: a list of rows
+        :param loaded_at: the time.time() the rows were listed (the default is now)
+        """
+
+        self.names = list(names) or ['column_%s' % i for i in range(len(rows[0]) if rows else 0)]
+        self.loaded_at = loaded_at if loaded_at is not None else time.time()
+
+        # named tuples keep attribute access, like row.table_name, without holding the cursor
+        lowered = [str(name).lower() for name in self.names]
+        row_type = namedtuple('CatalogRow', lowered, rename=True)
+        self.rows = [row_type(*row) for row in rows]
+
+        self._fields = {}
+        for part, candidates in CATALOG_FIELDS.items():
+            for candidate in candidates:
+                if candidate in lowered:
+                    self._fields[part] = lowered.index(candidate)
+                    break
+
+        self._matches = {}
+
+    def field(self, name):
+        """
+        :param name: the name of a column of the rows, like 'column_name'
+        :returns: the position of the column, or None if the rows don't have it
+        """
+
+        lowered = [str(column).lower() for column in self.names]
+
+        return lowered.index(name) if name in lowered else None
+
+    def parts(self, row):
+        """
+        :param row: one of the rows
+        :returns: a tuple of the (catalog, schema, name) of the object, with None for what is missing
+        """
+
+        return tuple([row[self._fields[part]] if part in self._fields else None for part in ('catalog', 'schema', 'name')])
+
+    def age(self):
+        """
+        :returns: how many seconds ago the rows were listed
+        """
+
+        return time.time() - self.loaded_at
+
+    def match(self, pattern=None):
+        """
+        :param pattern: [[catalog.]schema.]name, see like_pattern() (optional)
+        :returns: the rows that match the pattern, all of them if there is no pattern
+        """
+
+        if not pattern:
+            return self.rows
+
+        matches = self._matches.get(pattern)
+
+        if matches is None:
+            parts = pattern.split('.')
+            tests = [(self._fields[part], like_pattern(value)) \
+                    for part, value in zip(('catalog', 'schema', 'name')[-len(parts):], parts[-3:]) \
+                    if part in self._fields]
+
+            matches = [row for row in self.rows \
+                    if all([regex.match(str(row[index] or '')) for index, regex in tests])]
+            self._matches[pattern] = matches
+
+        return matches
+
+
+class CatalogCache(object):
+
+    """
+    A cached view of the tables, procedures and columns of each data source.
+
+    Listing the catalog of a large warehouse can take many seconds, so each kind is listed
+    once per TTL window and filtered in memory, with the filtered rows remembered by pattern.
+    The listings can also be kept in a SQLite file, so that a new kernel starts warm.
+    """
+
+    def __init__(self, ttl=DEFAULT_CATALOG_TTL, path=None):
+        """
+        :param ttl: how many seconds a listing stays valid (None never expires)
+        :param path: the SQLite file to keep the listings in (optional)
+        """
+
+        self.ttl = ttl
+        self.path = None
+        self.hits = 0
+        self.misses = 0
+
+        self._listings = {}
+        self._lock = threading.RLock()
+
+        if path is not None:
+            self.attach(path)
+
+    def attach(self, path):
+        """
+        Keeps the listings in a SQLite file from now on.
+
+        :param path: the file to use, created if it doesn't exist
+        """
+
+        path = os.path.abspath(os.path.expanduser(path))
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        connection = sqlite3.connect(path)
+        try:
+            connection.execute("CREATE TABLE IF NOT EXISTS catalog (source TEXT, kind TEXT, loaded_at REAL, " \
+                    "names TEXT, rows BLOB, PRIMARY KEY (source, kind))")
+            connection.commit()
+        finally:
+            connection.close()
+
+        logging.debug(" --- Keeping the catalog cache in %s", path)
+        self.path = path
+
+    def listing(self, source, kind):
+        """
+        :param source: the data source the listing is for
+        :param kind: what is listed, one of CATALOG_KINDS
+        :returns: the CatalogListing in memory, or None, without listing anything
+        """
+
+        with self._lock:
+            return self._listings.get((source, kind))
+
+    def is_stale(self, listing):
+        """
+        :param listing: a CatalogListing, or None
+        :returns: boolean, True if it needs to be listed again
+        """
+
+        return listing is None or (self.ttl is not None and listing.age() > self.ttl)
+
+    def get(self, source, kind, loader, pattern=None, refresh=False):
+        """
+        :param source: the data source the listing is for, like 'odbc:MY_DSN'
+        :param kind: what is listed, one of CATALOG_KINDS
+        :param loader: a function that lists the kind from the database, returning (names, rows)
+        :param pattern: only return the rows whose [[catalog.]schema.]name matches this (optional)
+        :param refresh: list the kind from the database even if it is cached
+        :returns: a list of rows
+        """
+
+        with self._lock:
+            listing = None if refresh else self._listings.get((source, kind))
+
+            if listing is None and not refresh and self.path is not None:
+                listing = self._read(source, kind)
+                if listing is not None:
+                    self._listings[(source, kind)] = listing
+
+        if not self.is_stale(listing):
+            self.hits += 1
+            return listing.match(pattern)
+
+        # the database is asked outside of the lock, so other sources aren't held up
+        self.misses += 1
+        logging.debug(" --- Listing the %s of %s from the database", kind, source)
+
+        names, rows = loader()
+        listing = CatalogListing(names, rows)
+
+        with self._lock:
+            self._listings[(source, kind)] = listing
+            if self.path is not None:
+                self._write(source, kind, listing)
+
+        return listing.match(pattern)
+
+    def invalidate(self, source=None):
+        """
+        Forces the next lookups to list the catalog again.
+
+        :param source: the data source to forget (the default is all of them)
+        """
+
+        with self._lock:
+            for key in list(self._listings.keys()):
+                if source is None or key[0] == source:
+                    del self._listings[key]
+
+            if self.path is not None:
+                connection = sqlite3.connect(self.path)
+                try:
+                    if source is None:
+                        connection.execute("DELETE FROM catalog")
+                    else:
+                        connection.execute("DELETE FROM catalog WHERE source = ?", (source,))
+                    connection.commit()
+                finally:
+                    connection.close()
+
+    def stats(self):
+        """
+        :returns: a dictionary of counters for the cache
+        """
+
+        with self._lock:
+            return {'listings' : len(self._listings), \
+                    'rows' : sum([len(listing.rows) for listing in self._listings.values()]), \
+                    'hits' : self.hits, \
+                    'misses' : self.misses, \
+                    'path' : self.path}
+
+    def _read(self, source, kind):
+
+        connection = sqlite3.connect(self.path)
+        try:
+            row = connection.execute("SELECT loaded_at, names, rows FROM catalog WHERE source = ? AND kind = ?", \
+                    (source, kind)).fetchone()
+        finally:
+            connection.close()
+
+        if row is None:
+            return None
+
+        logging.debug(" --- Read the %s of %s from %s", kind, source, self.path)
+
+        return CatalogListing(json.loads(row[1]), cPickle.loads(str(row[2])), row[0])
+
+    def _write(self, source, kind, listing):
+
+        rows = cPickle.dumps([tuple(row) for row in listing.rows], cPickle.HIGHEST_PROTOCOL)
+
+        connection = sqlite3.connect(self.path)
+        try:
+            connection.execute("INSERT OR REPLACE INTO catalog VALUES (?, ?, ?, ?, ?)", \
+                    (source, kind, listing.loaded_at, json.dumps(listing.names), sqlite3.Binary(rows)))
+            connection.commit()
+        finally:
+            connection.close()
+
+class ConnectionPool(object):
+
+    """
+    A keyed pool of open connections that naked queries check out and give back.
+
+    Connections are keyed by (connection source, username, connection type, password hash)
+    so that a naked query only reuses a connection that was made with the same credentials.
+    """
+
+    def __init__(self, max_size=4, max_idle=2, idle_timeout=600, health_check=True, health_query=None, wait_timeout=30):
+        """
+        :param max_size: the most connections (idle and checked out) kept for one key
+        :param max_idle: the most idle connections kept for one key
+        :param idle_timeout: seconds an idle connection is kept before it is closed (None keeps it forever)
+        :param health_check: check that an idle connection still works before handing it out
+        :param health_query: a command to run as the health check (optional, the default is the driver's health_query())
+        :param wait_timeout: seconds to wait for a connection when a key is at max_size
+        """
+
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self.health_query = health_query
+        self.wait_timeout = wait_timeout
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._health_queries = {}
+        self._idle = {}
+        self._in_use = {}
+        self._lock = threading.Condition()
+
+    @staticmethod
+    def make_key(connection_source, username, connection_type, password=None):
+        """
+        :param connection_source: the name of an an ODBC DSN or connection string
+        :param username: the username used for the connection
+        :param connection_type: the type of connection to use
+        :param password: the password used for the connection (only a hash of it is kept)
+        :returns: the key the connection is pooled under
+        """
+
+        # a wrong password must not get a connection that was opened with the right one
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        secret = hashlib.sha256(password).hexdigest() if password else None
+
+        return (connection_source, username, connection_type.lower(), secret)
+
+    def checkout(self, key, factory):
+        """
+        Hands out an idle connection for the key, or makes a new one with factory().
+
+        :param key: a key from make_key()
+        :param factory: a function that opens a new connection
+        :returns: an open connection
+        """
+
+        self.evict_idle()
+
+        deadline = time.time() + self.wait_timeout
+
+        while True:
+
+            candidate = None
+
+            with self._lock:
+                idle = self._idle.get(key)
+
+                if idle:
+                    # counted as in use while it is checked, so other checkouts can't go over max_size
+                    candidate, returned_at = idle.pop()
+                    self._in_use[key] = self._in_use.get(key, 0) + 1
+                elif self._in_use.get(key, 0) + len(self._idle.get(key, [])) < self.max_size:
+                    self._in_use[key] = self._in_use.get(key, 0) + 1
+                    self.misses += 1
+                    break
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Exception(stack()[0][3], \
+                                "There are already %s connections checked out for '%s'" % (self.max_size, key[0]))
+                    logging.debug(" ---- Waiting for a pooled connection to '%s'", key[0])
+                    self._lock.wait(remaining)
+                    continue
+
+            # check the candidate outside of the lock, this can mean a round trip
+            if self._is_healthy(key, candidate):
+                with self._lock:
+                    self.hits += 1
+                logging.debug(" ---- Reusing a pooled connection to '%s'", key[0])
+                return candidate
+
+            logging.debug(" ---- Discarding a broken pooled connection to '%s'", key[0])
+            self._close(candidate)
+
+            with self._lock:
+                self._in_use[key] -= 1
+                self.evictions += 1
+                self._lock.notify_all()
+
+        try:
+            logging.debug(" ---- Opening a new pooled connection to '%s'", key[0])
+            return factory()
+        except:
+            with self._lock:
+                self._in_use[key] -= 1
+                self._lock.notify_all()
+            raise
+
+    def checkin(self, key, cnxn, discard=False):
+        """
+        Gives a connection back to the pool.
+
+        :param key: the key the connection was checked out with
+        :param cnxn: the connection to give back
+        :param discard: close the connection instead of keeping it (after an error, for example)
+        """
+
+        with self._lock:
+            self._in_use[key] = max(self._in_use.get(key, 0) - 1, 0)
+            idle = self._idle.setdefault(key, [])
+
+            keep = not discard and len(idle) < self.max_idle
+
+            if keep:
+                idle.append((cnxn, time.time()))
+
+            self._lock.notify_all()
+
+        if not keep:
+            self._close(cnxn)
+
+    def evict_idle(self):
+        """
+        Closes the connections that have been idle for longer than idle_timeout.
+
+        """
+
+        if self.idle_timeout is None:
+            return
+
+        expired = []
+        cutoff = time.time() - self.idle_timeout
+
+        with self._lock:
+            for key, idle in self._idle.items():
+                fresh = [(cnxn, returned_at) for (cnxn, returned_at) in idle if returned_at >= cutoff]
+                expired.extend([cnxn for (cnxn, returned_at) in idle if returned_at < cutoff])
+                self._idle[key] = fresh
+            self.evictions += len(expired)
+
+        for cnxn in expired:
+            self._close(cnxn)
+
+    def drain(self):
+        """
+        Closes every idle connection in the pool.
+
+        """
+
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+
+        for key, connections in idle.items():
+            logging.debug(" --- Draining %s pooled connections to '%s'", len(connections), key[0])
+            for cnxn, returned_at in connections:
+                self._close(cnxn)
+
+    def stats(self):
+        """
+        :returns: a dictionary of counters for the pool
+        """
+
+        with self._lock:
+            return {'hits' : self.hits, \
+                    'misses' : self.misses, \
+                    'evictions' : self.evictions, \
+                    'idle' : sum([len(idle) for idle in self._idle.values()]), \
+                    'in_use' : sum(self._in_use.values()) }
+
+    def _is_healthy(self, key, cnxn):
+
+        if not self.health_check:
+            return True
+
+        try:
+            if getattr(cnxn, 'closed', False):
+                return False
+
+            # opening a cursor doesn't reach the database with most drivers, a query has to
+            query = self.health_query or self._health_queries.get(key)
+            if query is None:
+                query = self._health_queries[key] = get_driver(key[2]).health_query(cnxn)
+
+            cursor = cnxn.cursor()
+            cursor.execute(query)
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception, err:
+            logging.debug(" ---- The health check failed with %s", err)
+            return False
+
+    def _close(self, cnxn):
+
+        try:
+            cnxn.close()
+        except Exception, err:
+            logging.debug(" ---- There was a problem closing a pooled connection: %s", err)
+
+class StatementCache(object):
+
+    """
+    The cursors of one connection that keep its recent parameterized commands prepared.
+
+    Drivers like pyodbc and cx_Oracle keep the last command prepared on each cursor, so a
+    command that runs again with new parameters on the same cursor isn't prepared again.
+    Each command gets a cursor of its own, and once there are more than the size of the
+    cache, the least recently used cursor is handed back to be closed.
+    """
+
+    def __init__(self, size=DEFAULT_STATEMENT_CACHE):
+        """
+        :param size: how many commands to keep prepared (0 turns the cache off)
+        """
+
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+        # drivers like pyodbc prepare a command in its first execute(), so that is what is timed
+        self.first_run_seconds = 0.0
+
+        self._cursors = OrderedDict()
+
+    def get(self, command):
+        """
+        :param command: a parameterized command
+        :returns: the cursor the command is prepared on, or None if it isn't cached
+        """
+
+        cursor = self._cursors.pop(command, None)
+
+        if cursor is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._cursors[command] = cursor
+
+        return cursor
+
+    def add(self, command, cursor):
+        """
+        :param command: a parameterized command
+        :param cursor: the cursor the command will be prepared on
+        :returns: a list of the cursors that no longer fit, to be closed
+        """
+
+        self._cursors[command] = cursor
+
+        evicted = []
+        while len(self._cursors) > self.size:
+            evicted.append(self._cursors.popitem(last=False)[1])
+
+        return evicted
+
+    def clear(self):
+        """
+        Forgets all of the commands.
+
+        :returns: a list of their cursors, to be closed
+        """
+
+        cursors = self._cursors.values()
+        self._cursors.clear()
+
+        return cursors
+
+    def stats(self):
+        """
+        :returns: a dictionary of counters for the cache
+        """
+
+        lookups = self.hits + self.misses
+
+        return {'statements' : len(self._cursors), \
+                'statement_hits' : self.hits, \
+                'statement_misses' : self.misses, \
+                'statement_hit_rate' : float(self.hits) / lookups if lookups else None, \
+                'first_run_seconds' : self.first_run_seconds}
+
+    def __len__(self):
+        return len(self._cursors)
+
+
+class ConnectionEntry(object):
+
+    """ The state of one registered connection """
+
+    __slots__ = ('alias', 'type', 'driver', 'source', 'username', 'connection', 'cursor', 'base_cursor', 'statements', \
+                 'pool_key', 'opener', 'dialect', 'stream', 'in_flight', 'cancelled', 'created_at', 'last_used', 'metrics')
+
+    def __init__(self, alias, connection_type, source, connection, cursor, pool_key=None, driver=None, \
+                 statement_cache=DEFAULT_STATEMENT_CACHE, opener=None, username=None):
+        """
+        :param alias: the plain english name to associate with this connection
+        :param connection_type: the type of connection
+        :param source: the name of an an ODBC DSN or connection string
+        :param connection: the open connection
+        :param cursor: the cursor commands are run on
+        :param pool_key: the pool key, if the connection was checked out of the pool
+        :param driver: the DBMagicSource for the type (the default is looked up from the type)
+        :param statement_cache: how many parameterized commands to keep prepared, each on a cursor of its own
+        :param opener: a function that opens another connection to the source with the same credentials (optional)
+        :param username: the username the connection was made with (optional)
+        """
+
+        self.alias = alias
+        self.type = connection_type
+        self.driver = driver if driver is not None else get_driver(connection_type)
+        self.source = source
+        self.username = username
+        self.connection = connection
+        self.pool_key = pool_key
+        self.opener = opener
+
+        # the cursor with the results of the last command, which is either the base cursor
+        # or, for a parameterized command, the cursor that keeps that command prepared
+        self.cursor = cursor
+        self.base_cursor = cursor
+        self.statements = StatementCache(statement_cache)
+
+        self.dialect = None
+
+        # the open result state: a stream tied to the cursor, the cursor that is busy
+        # running a command or fetching its results, and whether it has been cancelled
+        self.stream = None
+        self.in_flight = None
+        self.cancelled = False
+
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.metrics = {'commands' : 0, 'fetches' : 0, 'rows' : 0, 'errors' : 0, 'seconds' : 0.0}
+
+    @property
+    def pooled(self):
+        return self.pool_key is not None
+
+    @contextmanager
+    def use(self, cursor=None):
+        """
+        Marks the connection as busy with a cursor for the length of a with block.
+
+        :param cursor: the cursor that is busy (the default is the cursor of the entry)
+        """
+
+        self.in_flight = cursor if cursor is not None else self.cursor
+        self.last_used = time.time()
+
+        try:
+            yield self.in_flight
+        finally:
+            self.in_flight = None
+            self.last_used = time.time()
+
+    def cancel(self):
+        """
+        Stops the statement running on the connection.  Called from another thread.
+
+        """
+
+        self.cancelled = True
+        self.driver.cancel(self.in_flight if self.in_flight is not None else self.cursor)
+
+    def reset(self):
+        """
+        Cleans up after a cancelled statement so the connection can be used again: the open
+        stream is closed, the transaction is rolled back and the cursor is replaced.
+
+        """
+
+        if self.stream is not None:
+            self.stream.close()
+
+        cleanups = [lambda: self.driver.rollback(self.connection), self.base_cursor.close]
+        cleanups.extend([cursor.close for cursor in self.statements.clear()])
+
+        for cleanup in cleanups:
+            try:
+                cleanup()
+            except self.driver.errors, err:
+                logging.debug(" ---- There was a problem cleaning up '%s': %s", self.alias, err)
+
+        self.base_cursor = self.driver.cursor(self.connection)
+        self.cursor = self.base_cursor
+        self.in_flight = None
+        self.cancelled = False
+
+    def execute(self, command, params=None, timeout=None):
+        """
+        Runs a command on the connection, replacing any pending results.
+
+        A command with parameters runs on the cursor kept for it in the statement cache, so
+        the driver only prepares it the first time.  The other commands run on the base cursor.
+
+        :param command: the command to execute
+        :param params: the values for the parameter markers in the command (optional)
+        :param timeout: cancel the command if it runs for more than this many seconds (optional)
+        """
+
+        self._settle()
+
+        cursor = self.base_cursor
+        prepared = True
+
+        if params is not None and self.statements.size > 0:
+            cursor = self.statements.get(command)
+            prepared = cursor is not None
+
+            if cursor is None:
+                logging.debug(" --- Preparing '%s' on a new cursor of '%s'", command, self.alias)
+                cursor = self.driver.cursor(self.connection)
+                for evicted in self.statements.add(command, cursor):
+                    evicted.close()
+
+        self._switch(cursor)
+
+        # the watchdog is only needed if the driver can't enforce the timeout itself
+        native = timeout is not None and self.driver.set_timeout(self.connection, timeout)
+
+        try:
+            logging.debug(" --- Attempting to execute '%s' on '%s'", command, self.alias)
+            started = time.time()
+            with Watchdog(self, None if native else timeout), self.use(cursor):
+                if not prepared:
+                    self.driver.prepare(cursor, command)
+                self.driver.execute(cursor, command, params)
+            if not prepared:
+                self.statements.first_run_seconds += time.time() - started
+        finally:
+            if native:
+                self.driver.set_timeout(self.connection, None)
+
+    def execute_many(self, command, rows, fast=False, timeout=None):
+        """
+        Runs a command once for each row of parameters on the base cursor, replacing any
+        pending results like execute().
+
+        :param command: the command to execute
+        :param rows: a list of tuples of values for the parameter markers
+        :param fast: use pyodbc's fast_executemany, which sends all of the rows as one round trip
+        :param timeout: cancel the command if it runs for more than this many seconds (optional)
+        """
+
+        self._settle()
+        self._switch(self.base_cursor)
+
+        native = timeout is not None and self.driver.set_timeout(self.connection, timeout)
+
+        try:
+            with Watchdog(self, None if native else timeout), self.use(self.base_cursor):
+                self.driver.executemany(self.base_cursor, command, rows, fast)
+        finally:
+            if native:
+                self.driver.set_timeout(self.connection, None)
+
+    def _settle(self):
+
+        # a new command replaces the pending results of an open stream
+        if self.stream is not None:
+            logging.debug(" --- Closing the open stream on '%s'", self.alias)
+            self.stream.close()
+
+        # a cancelled statement leaves the cursor in an unknown state
+        if self.cancelled:
+            logging.debug(" --- Resetting '%s' after a cancelled statement", self.alias)
+            self.reset()
+
+    def _switch(self, cursor):
+
+        # the connection may only allow one result set to be pending at a time
+        if cursor is not self.cursor:
+            self.driver.close_results(self.cursor)
+            self.cursor = cursor
+
+    def open_stream(self, batch_size, sizer=None, arrow=False):
+        """
+        Ties a RowStream to the cursor until it is exhausted or closed.
+
+        :param batch_size: how many records to fetch with each round trip
+        :param sizer: an AdaptiveBatchSizer that picks the size of each round trip instead (optional)
+        :param arrow: stream Arrow record batches instead of rows
+        :returns: a RowStream (or an ArrowStream)
+        """
+
+        if batch_size <= 0:
+            raise Exception(stack()[0][3], "'%s' is an invalid number of rows to stream" % batch_size)
+
+        if arrow:
+            new_stream = ArrowStream(self.cursor, batch_size, sizer, self.driver.arrow_batches)
+        else:
+            new_stream = RowStream(self.cursor, batch_size, sizer, self.driver.fetch_batches)
+
+        def release(closed_stream):
+            if self.stream is closed_stream:
+                logging.debug(" ---- The stream on '%s' is closed after %s rows", self.alias, closed_stream.rows_fetched)
+                self.stream = None
+
+        new_stream.on_close(release)
+        self.stream = new_stream
+
+        return new_stream
+
+    def close(self, pool, discard=False):
+        """
+        Closes the stream and the cursor, and closes the connection or gives it back to the pool.
+
+        :param pool: the ConnectionPool the connection was checked out of, if it is pooled
+        :param discard: close a pooled connection instead of giving it back (after an error)
+        """
+
+        if self.stream is not None:
+            logging.debug(" --- Closing the open stream on '%s'", self.alias)
+            self.stream.close()
+
+        for cursor in [self.base_cursor] + self.statements.clear():
+            cursor.close()
+
+        if self.pooled:
+            pool.checkin(self.pool_key, self.connection, discard=discard)
+        else:
+            self.driver.close(self.connection)
+
+    def record(self, timing):
+        """
+        :param timing: a QueryTiming for a call on this connection
+        """
+
+        metrics = self.metrics
+        metrics['commands'] += 1
+        metrics['seconds'] += timing.total()
+
+        if 'fetch' in timing.timings:
+            metrics['fetches'] += 1
+            metrics['rows'] += timing.rows
+
+        if timing.error is not None:
+            metrics['errors'] += 1
+
+    def stats(self):
+        """
+        :returns: a dictionary describing the connection and its metrics
+        """
+
+        stats = dict(self.metrics)
+        stats.update(self.statements.stats())
+        stats.update({'type' : self.type, \
+                      'driver' : self.driver.name, \
+                      'pooled' : self.pooled, \
+                      'dialect' : self.dialect, \
+                      'busy' : self.in_flight is not None, \
+                      'streaming' : self.stream is not None, \
+                      'idle' : time.time() - self.last_used})
+
+        return stats
+
+    def __repr__(self):
+        return "<ConnectionEntry '%s' on %s%s>" % (self.alias, self.source, ' (pooled)' if self.pooled else '')
+
+
+class ConnectionRegistry(object):
+
+    """
+    The registered connections, by alias, with the default and most recent aliases.
+
+    Every change goes through one lock, so the async workers, the fan out threads and the
+    naked queries using pooled connections can register and drop aliases at the same time.
+    """
+
+    def __init__(self):
+
+        self.default_alias = ''
+        self.most_recent_alias = ''
+
+        self._entries = {}
+        self._lock = threading.RLock()
+
+    def register(self, entry):
+        """
+        :param entry: the ConnectionEntry to add
+        """
+
+        with self._lock:
+            if entry.alias in self._entries:
+                raise Exception(stack()[0][3], "There is already a connection with the alias %s" % entry.alias)
+
+            self._entries[entry.alias] = entry
+
+            # pooled connections only live for one naked query, so they never become the default
+            if not entry.pooled:
+                self.default_alias = entry.alias
+
+    def get(self, alias):
+        """
+        :param alias: the alias to look up
+        :returns: the ConnectionEntry, or None if the alias isn't registered
+        """
+
+        return self._entries.get(alias)
+
+    def pop(self, alias):
+        """
+        Removes an alias, picking a new default if it was the default.
+
+        :param alias: the alias to remove
+        :returns: the ConnectionEntry, or None if the alias isn't registered
+        """
+
+        with self._lock:
+            entry = self._entries.pop(alias, None)
+
+            if entry is None:
+                return None
+
+            if alias == self.default_alias or alias == self.most_recent_alias:
+                # fall back to the connection that was used last
+                remaining = [other for other in self._entries.values() if not other.pooled]
+                replacement = max(remaining, key=lambda other: other.last_used).alias if remaining else ''
+
+                if alias == self.default_alias:
+                    self.default_alias = replacement
+                    logging.debug(" --- Setting the default alias to '%s'", replacement)
+
+                if alias == self.most_recent_alias:
+                    self.most_recent_alias = replacement
+
+            return entry
+
+    def rename(self, alias, new_alias):
+        """
+        Moves a pooled connection to a new alias, freeing the old one.
+
+        :param alias: the alias to move
+        :param new_alias: the alias to register the connection under instead
+        :returns: the new alias
+        """
+
+        with self._lock:
+            if new_alias in self._entries:
+                raise Exception(stack()[0][3], "There is already a connection with the alias %s" % new_alias)
+
+            entry = self._entries[alias]
+            if not entry.pooled:
+                raise Exception(stack()[0][3], "Only the pooled connection of a naked query can be renamed")
+
+            del self._entries[alias]
+            entry.alias = new_alias
+            self._entries[new_alias] = entry
+
+            return new_alias
+
+    def aliases(self, pooled=True):
+        """
+        :param pooled: include the aliases of naked queries on pooled connections
+        :returns: a list of the registered aliases
+        """
+
+        with self._lock:
+            return [alias for alias, entry in self._entries.items() if pooled or not entry.pooled]
+
+    def entries(self):
+        """
+        :returns: a list of the registered entries
+        """
+
+        with self._lock:
+            return self._entries.values()
+
+    def stats(self):
+        """
+        :returns: a dictionary of alias to the stats of its connection
+        """
+
+        return dict([(entry.alias, entry.stats()) for entry in self.entries()])
+
+    def __contains__(self, alias):
+        return alias in self._entries
+
+    def __getitem__(self, alias):
+        return self._entries[alias]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "<ConnectionRegistry %s (default '%s', most recent '%s')>" % \
+                (sorted(self._entries.keys()), self.default_alias, self.most_recent_alias)
+
+
+class Watchdog(object):
+
+    """
+    Cancels the statement running on a connection if it is still running after a timeout.
+
+    The timer runs on a thread of its own, so it can stop a statement that is blocking the
+    thread that started it.  When it fires, the connection is reset and the block raises,
+    unless the statement finished before the cancel could reach it.
+    """
+
+    def __init__(self, entry, seconds=None):
+        """
+        :param entry: the ConnectionEntry running the statement
+        :param seconds: the most seconds the statement can run (the default is no limit)
+        """
+
+        self.entry = entry
+        self.seconds = seconds
+        self.fired = False
+
+        self._timer = None
+        self._finished = False
+        self._lock = threading.Lock()
+
+    def fire(self):
+        """
+        Cancels the statement.  Called on the timer thread.
+
+        """
+
+        # the timer can go off after the block is done, but before __exit__() stops it
+        with self._lock:
+            if self._finished:
+                return
+
+            logging.warning(" --- Cancelling the statement on '%s' after %s seconds", self.entry.alias, self.seconds)
+            self.fired = True
+
+            try:
+                self.entry.cancel()
+            except Exception, err:
+                logging.warning(err)
+
+    def __enter__(self):
+
+        if self.seconds:
+            self._timer = threading.Timer(self.seconds, self.fire)
+            self._timer.daemon = True
+            self._timer.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        # waits for a cancel that is under way
+        with self._lock:
+            self._finished = True
+
+        if self._timer is not None:
+            self._timer.cancel()
+
+        if self.fired and exc_type is None:
+            # the statement finished before the cancel reached it, so there is nothing to clean up
+            logging.debug(" --- The statement on '%s' finished as it was cancelled", self.entry.alias)
+            self.entry.cancelled = False
+            return
+
+        if self.fired:
+            self.entry.reset()
+            raise Exception(stack()[0][3], "The statement on '%s' was cancelled after running for %s seconds" % \
+                    (self.entry.alias, self.seconds))
+
+
+class AdaptiveBatchSizer(object):
+
+    """
+    Picks how many rows to ask for with each fetchmany() round trip.
+
+    A fixed sizer always asks for the same number of rows.  An adaptive one measures
+    the rows per second of each full batch and keeps doubling (or halving) the size
+    while that gets better, turns around when it gets worse and holds when it stops
+    changing.  The size never goes over what fits in max_bytes at the measured row width.
+    """
+
+    def __init__(self, size=DEFAULT_STREAM_BATCH, adaptive=False, minimum=100, maximum=100000, \
+            max_bytes=DEFAULT_FETCH_MEMORY, tolerance=0.25):
+        """
+        :param size: how many rows to start with
+        :param adaptive: change the size based on the measured throughput
+        :param minimum: the fewest rows an adaptive sizer asks for
+        :param maximum: the most rows an adaptive sizer asks for
+        :param max_bytes: the most memory one adaptive batch should take
+        :param tolerance: how much the throughput has to change before the size follows it
+        """
+
+        if size <= 0:
+            raise Exception(stack()[0][3], "'%s' is an invalid number of rows to fetch at a time" % size)
+
+        self.adaptive = adaptive
+        self.minimum = min(minimum, size)
+        self.maximum = max(maximum, size)
+        self.max_bytes = max_bytes
+        self.tolerance = tolerance
+
+        self.rows = 0
+        self.batches = 0
+        self.elapsed = 0.0
+        self.width = None
+
+        self._size = size
+        self._rate = None
+        self._direction = 1
+
+    def size(self):
+        """
+        :returns: how many rows to ask for with the next round trip
+        """
+
+        return self._size
+
+    def record(self, batch, elapsed):
+        """
+        :param batch: the rows returned by the last round trip
+        :param elapsed: how many seconds the round trip took
+        """
+
+        self.rows += len(batch)
+        self.batches += 1
+        self.elapsed += elapsed
+
+        if self.width is None and len(batch) > 0:
+            sample = batch[:10]
+            self.width = sum([sys.getsizeof(row) + sum([sys.getsizeof(value) for value in row]) \
+                    for row in sample]) // len(sample)
+
+        # a short batch is the end of the results, which says nothing about the size
+        if not self.adaptive or elapsed <= 0 or len(batch) < self._size:
+            return
+
+        rate = len(batch) / elapsed
+
+        if self._rate is not None:
+            if rate < self._rate * (1 - self.tolerance):
+                self._direction = -self._direction
+            elif rate <= self._rate * (1 + self.tolerance):
+                self._rate = rate
+                return
+
+        self._rate = rate
+        self.resize(self._size * 2 if self._direction > 0 else self._size // 2)
+
+    def resize(self, size):
+        """
+        :param size: the new number of rows, which is kept within the limits
+        """
+
+        ceiling = self.maximum
+        if self.width:
+            ceiling = max(self.minimum, min(ceiling, self.max_bytes // self.width))
+
+        size = max(self.minimum, min(ceiling, size))
+
+        if size != self._size:
+            logging.debug(" ---- Fetching %s rows at a time instead of %s", size, self._size)
+            self._size = size
+
+    def stats(self):
+        """
+        :returns: a dictionary with the current size, the rows and batches fetched and the rows per second
+        """
+
+        return {'size' : self._size, \
+                'adaptive' : self.adaptive, \
+                'rows' : self.rows, \
+                'batches' : self.batches, \
+                'row_width' : self.width, \
+                'rows_per_second' : self.rows / self.elapsed if self.elapsed > 0 else None}
+
+    def __repr__(self):
+        return "<AdaptiveBatchSizer %s rows at a time, %s rows in %s batches>" % (self._size, self.rows, self.batches)
+
+
+def fetch_batches(cursor, sizer, max_rows=None):
+    """
+    Fetches the pending results of a cursor batch by batch, letting the sizer pick each size.
+
+    :param cursor: a cursor with a pending result set
+    :param sizer: an AdaptiveBatchSizer
+    :param max_rows: stop after this many rows (optional)
+    :returns: an iterator over the batches of rows
+    """
+
+    fetched = 0
+
+    while max_rows is None or fetched < max_rows:
+
+        size = sizer.size()
+        if max_rows is not None:
+            size = min(size, max_rows - fetched)
+
+        # drivers that prefetch (like cx_Oracle) use arraysize for the size of their round trips
+        cursor.arraysize = size
+
+        logging.debug(" ---- Running cursor.fetchmany(%s)", size)
+        started = time.time()
+        batch = cursor.fetchmany(size)
+        sizer.record(batch, time.time() - started)
+
+        if not batch:
+            break
+
+        fetched += len(batch)
+
+        yield batch
+
+
+def arrow_type(column):
+    """
+    :param column: a column of a cursor.description
+    :returns: the pyarrow type of the Python type the driver reports for the column, or None
+              if it has to be inferred from the values (sqlite and most DB-API drivers)
+    """
+
+    type_code = column[1]
+
+    if not isinstance(type_code, type):
+        return None
+    elif issubclass(type_code, bool):
+        return pyarrow.bool_()
+    elif issubclass(type_code, (int, long)):
+        return pyarrow.int64()
+    elif issubclass(type_code, float):
+        return pyarrow.float64()
+    elif issubclass(type_code, unicode):
+        return pyarrow.string()
+    elif issubclass(type_code, bytearray):
+        return pyarrow.binary()
+    elif issubclass(type_code, datetime.datetime):
+        return pyarrow.timestamp('us')
+    elif issubclass(type_code, datetime.date):
+        return pyarrow.date32()
+    elif issubclass(type_code, datetime.time):
+        return pyarrow.time64('us')
+    elif issubclass(type_code, decimal.Decimal) and len(column) > 5 and \
+            isinstance(column[4], (int, long)) and 0 < column[4] <= 38:
+        return pyarrow.decimal128(column[4], column[5] or 0)
+
+    return None
+
+
+def record_batch(rows, names, types=None):
+    """
+    Turns a batch of rows into an Arrow record batch, one array per column.
+
+    :param rows: a list of rows
+    :param names: the names of the columns
+    :param types: the pyarrow type of each column, None to infer it from the values (optional)
+    :returns: a pyarrow.RecordBatch
+    """
+
+    columns = [list(values) for values in zip(*rows)] or [[] for name in names]
+    types = types or [None] * len(names)
+
+    arrays = [pyarrow.array(values) if kind is None else pyarrow.array(values, type=kind) \
+            for values, kind in zip(columns, types)]
+
+    return pyarrow.RecordBatch.from_arrays(arrays, names)
+
+
+class ArrowConverter(object):
+
+    """
+    Converts the batches of rows of a result set into Arrow record batches that all have
+    the same schema.
+
+    The types come from cursor.description when the driver reports Python types there, and
+    are inferred from the first values that aren't NULL otherwise.  A column that has only
+    been NULL so far has no type yet, so batches are held back until every column has one,
+    and then the NULL columns of the held batches get the types that turned up.  After
+    hold_rows rows, a column that is still all NULL is stored as text from then on.
+    """
+
+    def __init__(self, description, hold_rows=DEFAULT_ARROW_HOLD):
+        """
+        :param description: the cursor.description of the result set
+        :param hold_rows: the most rows to hold back waiting for types (None holds them all)
+        """
+
+        self.names = [column[0] for column in description]
+        self.schema = None
+        self.hold_rows = hold_rows
+
+        self._types = [arrow_type(column) for column in description]
+        self._text = set()
+        self._held = []
+        self._held_rows = 0
+
+    def convert(self, rows):
+        """
+        :param rows: the next batch of rows
+        :returns: a list of the record batches that are ready, in order
+        """
+
+        if self.schema is not None:
+            return [self._record_batch(rows)]
+
+        converted = record_batch(rows, self.names, self._types)
+
+        for position, field in enumerate(converted.schema):
+            if self._types[position] is None and field.type != pyarrow.null():
+                self._types[position] = field.type
+
+        self._held.append(converted)
+        self._held_rows += len(rows)
+
+        if None in self._types and (self.hold_rows is None or self._held_rows < self.hold_rows):
+            return []
+
+        return self.finish()
+
+    def finish(self):
+        """
+        Settles the schema and releases the held batches.
+
+        :returns: a list of the record batches that were held back, in order
+        """
+
+        if self.schema is None:
+            for position, kind in enumerate(self._types):
+                if kind is None:
+                    logging.debug(" ---- The column '%s' is all NULL, storing it as text", self.names[position])
+                    self._types[position] = pyarrow.string()
+                    self._text.add(position)
+
+            self.schema = pyarrow.schema([pyarrow.field(name, kind) for name, kind in zip(self.names, self._types)])
+
+        held = [self._settle(batch) for batch in self._held]
+        self._held = []
+        self._held_rows = 0
+
+        return held
+
+    def _record_batch(self, rows):
+
+        if self._text:
+            rows = [[unicode(value) if position in self._text and value is not None else value \
+                    for position, value in enumerate(row)] for row in rows]
+
+        return record_batch(rows, self.names, self._types)
+
+    def _settle(self, batch):
+
+        if batch.schema.equals(self.schema):
+            return batch
+
+        arrays = [column if column.type == field.type else pyarrow.array([None] * len(batch), type=field.type) \
+                for column, field in zip(batch.columns, self.schema)]
+
+        return pyarrow.RecordBatch.from_arrays(arrays, self.names)
+
+
+def arrow_batches(cursor, sizer, max_rows=None, batches=fetch_batches, hold_rows=DEFAULT_ARROW_HOLD):
+    """
+    Converts the batches of rows of a cursor into Arrow record batches as they are fetched.
+
+    :param cursor: a cursor with a pending result set
+    :param sizer: an AdaptiveBatchSizer
+    :param max_rows: stop after this many rows (optional)
+    :param batches: the function that fetches the batches, like a driver's fetch_batches()
+    :param hold_rows: the most rows to hold back waiting for the types of NULL columns, see ArrowConverter
+    :returns: an iterator over pyarrow.RecordBatch objects
+    """
+
+    converter = None
+
+    for batch in batches(cursor, sizer, max_rows):
+
+        if converter is None:
+            converter = ArrowConverter(cursor.description, hold_rows)
+
+        for converted in converter.convert(batch):
+            yield converted
+
+    if converter is not None:
+        for converted in converter.finish():
+            yield converted
+
+
+def limit_record_batches(results, max_rows=None):
+    """
+    Splits the Arrow data a driver returns into record batches, stopping after max_rows.
+
+    :param results: an iterator over pyarrow Tables or RecordBatches
+    :param max_rows: stop after this many rows (optional)
+    :returns: an iterator over pyarrow.RecordBatch objects
+    """
+
+    fetched = 0
+
+    for result in results:
+
+        batches = result.to_batches() if isinstance(result, pyarrow.Table) else [result]
+
+        for batch in batches:
+            if max_rows is not None and fetched + batch.num_rows > max_rows:
+                batch = batch.slice(0, max_rows - fetched)
+
+            fetched += batch.num_rows
+
+            if batch.num_rows > 0:
+                yield batch
+
+            if max_rows is not None and fetched >= max_rows:
+                return
+
+
+def empty_table(description):
+    """
+    :param description: the cursor.description of a result set with no rows (optional)
+    :returns: a pyarrow.Table with a column for each column of the result set, null if its type isn't known
+    """
+
+    fields = [pyarrow.field(column[0], arrow_type(column) or pyarrow.null()) for column in description or []]
+
+    return pyarrow.Table.from_batches([], schema=pyarrow.schema(fields))
+
+
+class RowStream(object):
+
+    """
+    A lazy iterator over the rows of a result set.
+
+    Rows are pulled from the cursor with fetchmany() one batch at a time, so memory is
+    bounded by the batch size rather than by the size of the result.  The cursor stays
+    tied to its alias until the stream is exhausted or closed.
+    """
+
+    def __init__(self, cursor, batch_size=DEFAULT_STREAM_BATCH, sizer=None, batches=fetch_batches):
+        """
+        :param cursor: a cursor with a pending result set
+        :param batch_size: how many rows to fetch with each round trip
+        :param sizer: an AdaptiveBatchSizer that picks the size of each round trip instead (optional)
+        :param batches: the function that fetches the batches, like a driver's fetch_batches()
+        """
+
+        self.sizer = sizer if sizer is not None else AdaptiveBatchSizer(batch_size)
+        self.rows_fetched = 0
+        self.closed = False
+        self.failed = False
+
+        self._cursor = cursor
+        self._batches = batches(cursor, self.sizer)
+        self._batch = []
+        self._position = 0
+        self._close_callbacks = []
+
+    @property
+    def batch_size(self):
+        return self.sizer.size()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+
+        if self._position >= len(self._batch):
+            batch = self.next_batch()
+            if not batch:
+                raise StopIteration
+            self._batch = batch
+            self._position = 0
+
+        row = self._batch[self._position]
+        self._position += 1
+
+        return row
+
+    __next__ = next
+
+    def next_batch(self):
+        """
+        Fetches the next batch of rows straight from the cursor.
+
+        :returns: a list of rows, empty when the result set is exhausted
+        """
+
+        if self.closed:
+            return []
+
+        # hand back whatever is left of a partially consumed batch first
+        if self._position < len(self._batch):
+            batch = self._batch[self._position:]
+            self._batch = []
+            self._position = 0
+            return batch
+
+        try:
+            batch = next(self._batches, [])
+        except:
+            self.failed = True
+            self.close()
+            raise
+
+        if not batch:
+            self.close()
+            return []
+
+        self.rows_fetched += len(batch)
+
+        return batch
+
+    def batches(self):
+        """
+        :returns: an iterator over the remaining batches of rows
+        """
+
+        batch = self.next_batch()
+        while batch:
+            yield batch
+            batch = self.next_batch()
+
+    def on_close(self, callback):
+        """
+        :param callback: a function called with this stream when it is exhausted or closed
+        """
+
+        self._close_callbacks.append(callback)
+
+    def close(self):
+        """
+        Stops the stream and releases the cursor.  Rows that have not been fetched are dropped.
+
+        """
+
+        if self.closed:
+            return
+
+        self.closed = True
+        self._batch = []
+        self._position = 0
+
+        callbacks = self._close_callbacks
+        self._close_callbacks = []
+
+        for callback in callbacks:
+            callback(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return "<%s %s, %s rows fetched in batches of %s>" % \
+                (self.__class__.__name__, 'closed' if self.closed else 'open', self.rows_fetched, self.batch_size)
+
+
+class ArrowStream(RowStream):
+
+    """
+    A lazy iterator over the Arrow record batches of a result set.
+
+    Each step hands back a whole pyarrow.RecordBatch instead of a row, so the batches can go
+    to pandas, Polars or a Parquet writer without ever becoming Python objects.
+    """
+
+    def next(self):
+
+        batch = self.next_batch()
+        if not batch:
+            raise StopIteration
+
+        return batch
+
+    __next__ = next
+
+    def read_all(self):
+        """
+        :returns: the remaining record batches as a pyarrow.Table
+        """
+
+        batches = list(self.batches())
+
+        if not batches:
+            return empty_table(self._cursor.description)
+
+        return pyarrow.Table.from_batches(batches)
+
+class DictionaryArray(object):
+
+    """ A dictionary-encoded string column: integer codes into a list of distinct values """
+
+    def __init__(self, codes, dictionary):
+        """
+        :param codes: a NumPy int32 array of positions in dictionary, -1 for NULL
+        :param dictionary: the list of distinct values
+        """
+
+        self.codes = codes
+        self.dictionary = dictionary
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        code = self.codes[index]
+        return None if code < 0 else self.dictionary[code]
+
+    def decode(self):
+        """
+        :returns: a NumPy object array of the values
+        """
+
+        values = numpy.empty(len(self.dictionary) + 1, dtype=object)
+        values[:-1] = self.dictionary
+        values[-1] = None
+
+        # -1 picks up the trailing None
+        return values[self.codes]
+
+    def __repr__(self):
+        return "<DictionaryArray %s values, %s distinct>" % (len(self.codes), len(self.dictionary))
+
+
+class ColumnBuilder(object):
+
+    """
+    Converts the values of one result column into typed NumPy chunks, batch by batch.
+
+    The type of the column comes from cursor.description when the driver reports a Python
+    type there, like pyodbc.  Other drivers (sqlite, and DB-API drivers that report codes)
+    have it inferred from the values that aren't NULL, and checked again with every batch.
+    """
+
+    _kinds = {int : 'int', long : 'int', \
+              float : 'float', decimal.Decimal : 'float', \
+              bool : 'bool', \
+              datetime.datetime : 'datetime', datetime.date : 'date', \
+              str : 'string', unicode : 'string' }
+
+    _dtypes = {'int' : 'int64', 'float' : 'float64', 'bool' : 'bool', \
+               'datetime' : 'datetime64[us]', 'date' : 'datetime64[D]', 'object' : 'object'}
+
+    def __init__(self, name, type_code):
+        """
+        :param name: the name of the column
+        :param type_code: the type from cursor.description
+        """
+
+        self.name = name
+        self.kind = self._kinds.get(type_code, 'object') if isinstance(type_code, type) else None
+        self.inferred = self.kind is None
+        self.chunks = []
+        self.dictionary = []
+        self._codes = {}
+        self._nulls = 0
+
+    def convert(self, values):
+        """
+        Converts one batch of values, widening the column type if the values don't fit.
+
+        :param values: a sequence with the values of this column for one batch
+        :returns: a NumPy array for the batch (codes for string columns), or None while an
+                  inferred column has only had NULLs, which are then part of the next array
+        """
+
+        if self.inferred:
+            self._infer(values)
+
+            if self.kind is None:
+                self._nulls += len(values)
+                return None
+
+            if self._nulls:
+                values = [None] * self._nulls + list(values)
+                self._nulls = 0
+
+        if self.kind == 'string':
+            return self._encode(values)
+
+        has_nulls = None in values
+
+        if has_nulls and self.kind == 'int':
+            self._widen('float')
+        elif has_nulls and self.kind == 'bool':
+            self._widen('object')
+
+        if self.kind == 'float':
+            return numpy.fromiter((numpy.nan if v is None else float(v) for v in values), \
+                    dtype='float64', count=len(values))
+
+        if self.kind == 'int':
+            try:
+                return numpy.array(values, dtype='int64')
+            except OverflowError:
+                self._widen('object')
+
+        chunk = numpy.empty(len(values), dtype=self._dtypes[self.kind])
+        chunk[:] = values
+
+        return chunk
+
+    def append(self, values):
+        """
+        :param values: a sequence with the values of this column for one batch
+        """
+
+        # convert() can widen the column and replace the earlier chunks
+        chunk = self.convert(values)
+        if chunk is not None:
+            self.chunks.append(chunk)
+
+    def flush(self):
+        """
+        Settles the type of an inferred column that has only had NULLs.
+
+        :returns: a NumPy array with the NULLs that haven't been converted yet, or None
+        """
+
+        if self.kind is not None:
+            return None
+
+        self.kind = 'object'
+        nulls, self._nulls = self._nulls, 0
+
+        return numpy.array([None] * nulls, dtype='object')
+
+    def finish(self):
+        """
+        :returns: the whole column as one NumPy array, or a DictionaryArray for strings
+        """
+
+        chunk = self.flush()
+        if chunk is not None:
+            self.chunks.append(chunk)
+
+        if self.kind == 'string':
+            dtype = 'int32'
+        else:
+            dtype = self._dtypes[self.kind]
+
+        if len(self.chunks) == 0:
+            column = numpy.empty(0, dtype=dtype)
+        elif len(self.chunks) == 1:
+            column = self.chunks[0]
+        else:
+            column = numpy.concatenate(self.chunks)
+
+        self.chunks = []
+
+        if self.kind == 'string':
+            return DictionaryArray(column, self.dictionary)
+
+        return column
+
+    def _encode(self, values):
+
+        codes = self._codes
+        dictionary = self.dictionary
+        chunk = numpy.empty(len(values), dtype='int32')
+
+        for i, value in enumerate(values):
+            if value is None:
+                chunk[i] = -1
+                continue
+            code = codes.get(value)
+            if code is None:
+                code = codes[value] = len(dictionary)
+                dictionary.append(value)
+            chunk[i] = code
+
+        return chunk
+
+    def _infer(self, values):
+
+        kinds = set([self._kinds.get(type(value), 'object') for value in values if value is not None])
+
+        if self.kind is not None:
+            kinds.add(self.kind)
+
+        if len(kinds) == 0:
+            return
+        elif len(kinds) == 1:
+            kind = kinds.pop()
+        elif kinds == set(['int', 'float']):
+            kind = 'float'
+        else:
+            kind = 'object'
+
+        if self.kind is None:
+            logging.debug(" ---- Inferred column '%s' as %s", self.name, kind)
+            self.kind = kind
+        elif kind != self.kind:
+            self._widen(kind)
+
+    def _widen(self, kind):
+
+        logging.debug(" ---- Widening column '%s' from %s to %s", self.name, self.kind, kind)
+
+        # string chunks hold codes into the dictionary, where -1 (the last value here) is NULL
+        if self.kind == 'string':
+            strings = numpy.array(self.dictionary + [None], dtype='object')
+            self.chunks = [strings[chunk] for chunk in self.chunks]
+
+        self.kind = kind
+        self.chunks = [chunk.astype(self._dtypes[kind]) for chunk in self.chunks]
+
+
+class ColumnarResult(object):
+
+    """
+    A lightweight column store for a result set.
+
+    Each column is held as one typed NumPy array (or a DictionaryArray for strings)
+    instead of a pyodbc.Row per record and a Python object per value.
+    """
+
+    def __init__(self, names, columns):
+        """
+        :param names: the column names, in order
+        :param columns: the column arrays, in the same order
+        """
+
+        self.names = list(names)
+        self._columns = dict(zip(self.names, columns))
+
+    @classmethod
+    def from_cursor(cls, cursor, batch_size=DEFAULT_STREAM_BATCH, max_rows=None, progress=None, sizer=None, batches=fetch_batches):
+        """
+        Fetches a pending result set batch by batch straight into typed column arrays.
+
+        :param cursor: a cursor with a pending result set
+        :param batch_size: how many rows to fetch with each round trip
+        :param max_rows: stop after this many rows (optional)
+        :param progress: a function called with the number of rows fetched so far (optional)
+        :param sizer: an AdaptiveBatchSizer that picks the size of each round trip instead (optional)
+        :param batches: the function that fetches the batches, like a driver's fetch_batches()
+        :returns: a ColumnarResult
+        """
+
+        if numpy is None:
+            raise Exception(stack()[0][3], "Columnar results need NumPy, which is not installed.")
+
+        if cursor.description is None:
+            raise Exception(stack()[0][3], "There is no result set to fetch.")
+
+        builders = [ColumnBuilder(column[0], column[1]) for column in cursor.description]
+        fetched = 0
+
+        if sizer is None:
+            sizer = AdaptiveBatchSizer(batch_size)
+
+        for batch in batches(cursor, sizer, max_rows):
+
+            fetched += len(batch)
+
+            for builder, values in zip(builders, zip(*batch)):
+                builder.append(values)
+
+            if progress is not None:
+                progress(fetched)
+
+        return cls([builder.name for builder in builders], [builder.finish() for builder in builders])
+
+    def __len__(self):
+
+        if len(self.names) == 0:
+            return 0
+
+        return len(self._columns[self.names[0]])
+
+    def column(self, name):
+        """
+        :param name: the name of the column
+        :returns: the stored array for the column, without copying it
+        """
+
+        return self._columns[name]
+
+    def to_pandas(self, downcast=False, categorize=1.0):
+        """
+        :param downcast: store integer columns in the smallest integer type that fits
+        :param categorize: make string columns with at most this ratio of distinct values to rows
+                           into categoricals, the rest become objects (None for no categoricals)
+        :returns: a pandas DataFrame
+        """
+
+        try:
+            import pandas
+        except ImportError:
+            raise Exception(stack()[0][3], "DataFrame results need pandas, which is not installed.")
+
+        data = OrderedDict()
+        rows = len(self)
+
+        for name in self.names:
+            column = self._columns[name]
+            if isinstance(column, DictionaryArray):
+                if categorize is not None and len(column.dictionary) <= categorize * max(rows, 1):
+                    column = pandas.Categorical.from_codes(column.codes, column.dictionary)
+                else:
+                    column = column.decode()
+            elif downcast and column.dtype.kind == 'i':
+                column = self._downcast(column)
+            data[name] = column
+
+        return pandas.DataFrame(data)
+
+    @staticmethod
+    def _downcast(column):
+
+        if len(column) == 0:
+            return column
+
+        low = column.min()
+        high = column.max()
+
+        for dtype in ('int8', 'int16', 'int32'):
+            limits = numpy.iinfo(dtype)
+            if limits.min <= low and high <= limits.max:
+                return column.astype(dtype)
+
+        return column
+
+    def __repr__(self):
+        return "<ColumnarResult %s rows x %s columns: %s>" % (len(self), len(self.names), ', '.join(self.names))
+
+class ColumnFileWriter(object):
+
+    """
+    Writes a result set to a directory with one raw file per column, batch by batch.
+
+    Numbers and dates are appended as flat NumPy buffers that can be memory-mapped back,
+    strings as int32 codes plus a dictionary, and anything else is pickled one batch at
+    a time.  The directory only gets its final name once the last batch is written, so
+    an interrupted pull never looks complete.
+    """
+
+    def __init__(self, path, description):
+        """
+        :param path: the directory to write the columns to
+        :param description: the cursor.description of the result set
+        """
+
+        if numpy is None:
+            raise Exception(stack()[0][3], "Persisted results need NumPy, which is not installed.")
+
+        self.path = path
+        self.rows = 0
+
+        self._partial = path + '.partial'
+        self._builders = [ColumnBuilder(column[0], column[1]) for column in description]
+        self._kinds = [None] * len(self._builders)
+        self._files = [None] * len(self._builders)
+
+        if os.path.exists(self._partial):
+            shutil.rmtree(self._partial)
+        os.makedirs(self._partial)
+
+    def write(self, batch):
+        """
+        :param batch: a list of rows
+        """
+
+        for index, values in enumerate(zip(*batch)):
+            self._write(index, self._builders[index].convert(values))
+
+        self.rows += len(batch)
+
+    def close(self):
+        """
+        Writes the column descriptions and gives the directory its final name.
+
+        :returns: the path of the directory
+        """
+
+        for index, builder in enumerate(self._builders):
+            self._write(index, builder.flush())
+
+        self._close_files()
+
+        columns = []
+        for index, builder in enumerate(self._builders):
+            if builder.kind == 'string':
+                with open(self._file(index, 'dict'), 'wb') as dictionary:
+                    cPickle.dump(builder.dictionary, dictionary, 2)
+            columns.append({'name' : builder.name, 'kind' : builder.kind})
+
+        with open(os.path.join(self._partial, 'meta.json'), 'w') as meta:
+            json.dump({'format' : 'columns', 'rows' : self.rows, 'columns' : columns}, meta)
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self._partial, self.path)
+
+        return self.path
+
+    def abort(self):
+        """
+        Throws away whatever was written so far.
+
+        """
+
+        self._close_files()
+        shutil.rmtree(self._partial, ignore_errors=True)
+
+    def _file(self, index, extension):
+        return os.path.join(self._partial, '%s.%s' % (index, extension))
+
+    def _write(self, index, chunk):
+
+        # an inferred column that has only had NULLs has nothing to write yet
+        if chunk is None:
+            return
+
+        # a batch can widen the column, so the rows already on disk have to follow
+        if self._builders[index].kind != self._kinds[index]:
+            self._rewrite(index, self._builders[index].kind)
+
+        self._append(index, chunk)
+
+    def _append(self, index, chunk):
+
+        kind = self._kinds[index]
+
+        if self._files[index] is None:
+            self._files[index] = open(self._file(index, 'pickle' if kind == 'object' else 'bin'), 'ab')
+
+        if kind == 'object':
+            cPickle.dump(chunk, self._files[index], 2)
+        else:
+            chunk.tofile(self._files[index])
+
+    def _rewrite(self, index, kind):
+
+        previous = self._kinds[index]
+        self._kinds[index] = kind
+
+        if previous is None or self._files[index] is None:
+            return
+
+        logging.debug(" ---- Rewriting %s rows of column %s as %s", self.rows, index, kind)
+
+        self._files[index].close()
+        self._files[index] = None
+
+        path = self._file(index, 'bin')
+
+        if previous == 'string':
+            strings = numpy.array(self._builders[index].dictionary + [None], dtype='object')
+            values = strings[numpy.fromfile(path, dtype='int32')]
+        else:
+            values = numpy.fromfile(path, dtype=ColumnBuilder._dtypes[previous]).astype(ColumnBuilder._dtypes[kind])
+        os.remove(path)
+
+        self._append(index, values)
+
+    def _close_files(self):
+
+        for index, handle in enumerate(self._files):
+            if handle is not None:
+                handle.close()
+                self._files[index] = None
+
+
+class ArrowFileWriter(object):
+
+    """ Writes a result set to an Arrow IPC file, one record batch per fetched batch """
+
+    def __init__(self, path, description):
+        """
+        :param path: the file to write the batches to
+        :param description: the cursor.description of the result set
+        """
+
+        self.path = path
+        self.rows = 0
+
+        self._partial = path + '.partial'
+        self._description = description
+        self._converter = ArrowConverter(description)
+        self._sink = None
+        self._writer = None
+
+    def write(self, batch):
+        """
+        :param batch: a list of rows
+        """
+
+        self._write(self._converter.convert(batch))
+        self.rows += len(batch)
+
+    def close(self):
+        """
+        :returns: the path of the file
+        """
+
+        self._write(self._converter.finish())
+
+        if self._writer is None:
+            self._open(empty_table(self._description).schema)
+
+        self._writer.close()
+        self._sink.close()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self._partial, self.path)
+
+        return self.path
+
+    def abort(self):
+        """
+        Throws away whatever was written so far.
+
+        """
+
+        if self._sink is not None:
+            self._sink.close()
+
+        if os.path.exists(self._partial):
+            os.remove(self._partial)
+
+    def _write(self, batches):
+
+        for converted in batches:
+            if self._writer is None:
+                self._open(converted.schema)
+
+            self._writer.write_batch(converted)
+
+    def _open(self, schema):
+
+        self._sink = pyarrow.OSFile(self._partial, 'wb')
+        self._writer = pyarrow.RecordBatchFileWriter(self._sink, schema)
+
+
+class ResultStore(object):
+
+    """
+    A directory of result sets persisted by name, so they outlive the kernel.
+
+    Results are written as Arrow IPC files when pyarrow is installed, otherwise as a
+    directory of raw column files.  Either way they are memory-mapped when loaded, so a
+    result never has to fit in memory to be written or read back.
+    """
+
+    def __init__(self, directory=DEFAULT_PERSIST_DIR, format=None):
+        """
+        :param directory: where the results are kept
+        :param format: 'arrow' or 'columns' (the default is 'arrow' if pyarrow is installed)
+        """
+
+        if format is None:
+            format = 'arrow' if pyarrow is not None else 'columns'
+
+        self.directory = directory
+        self.format = format
+
+    def path(self, name):
+        """
+        :param name: the name of the persisted result
+        :returns: the path the result is written to in the current format
+        """
+
+        if not re.match(r'^[\w.-]+$', name):
+            raise Exception(stack()[0][3], "'%s' is not a valid name for a persisted result" % name)
+
+        if self.format == 'arrow':
+            return os.path.join(self.directory, name + '.arrow')
+
+        return os.path.join(self.directory, name)
+
+    def writer(self, name, description):
+        """
+        :param name: the name to persist the result as
+        :param description: the cursor.description of the result set
+        :returns: a writer with write(batch), close() and abort()
+        """
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        logging.debug(" ---- Persisting '%s' as %s in %s", name, self.format, self.directory)
+
+        if self.format == 'arrow':
+            return ArrowFileWriter(self.path(name), description)
+
+        return ColumnFileWriter(self.path(name), description)
+
+    def names(self):
+        """
+        :returns: the names of the persisted results
+        """
+
+        if not os.path.isdir(self.directory):
+            return []
+
+        names = set()
+        for entry in os.listdir(self.directory):
+            if entry.endswith('.partial'):
+                continue
+            if entry.endswith('.arrow'):
+                entry = entry[:-len('.arrow')]
+            names.add(entry)
+
+        return sorted(names)
+
+    def load(self, name, dataframe=False, downcast=False, categorize=None):
+        """
+        Memory-maps a persisted result back, without touching the database.
+
+        :param name: the name the result was persisted as
+        :param dataframe: return a pandas DataFrame
+        :param downcast: store DataFrame integer columns in the smallest integer type that fits
+        :param categorize: the ratio of distinct values under which DataFrame strings are categorical (optional)
+        :returns: a pyarrow Table for Arrow files, a ColumnarResult otherwise (or a DataFrame)
+        """
+
+        self.path(name)
+
+        arrow_path = os.path.join(self.directory, name + '.arrow')
+        columns_path = os.path.join(self.directory, name)
+
+        if os.path.isfile(arrow_path):
+            if pyarrow is None:
+                raise Exception(stack()[0][3], "'%s' was persisted with Arrow, which is not installed." % name)
+
+            logging.debug(" ---- Mapping the Arrow file %s", arrow_path)
+            table = pyarrow.RecordBatchFileReader(pyarrow.memory_map(arrow_path, 'r')).read_all()
+
+            return table.to_pandas() if dataframe else table
+        elif os.path.isdir(columns_path):
+            logging.debug(" ---- Mapping the column files in %s", columns_path)
+            result = self.read_columns(columns_path)
+
+            return result.to_pandas(downcast=downcast, categorize=categorize) if dataframe else result
+
+        raise Exception(stack()[0][3], \
+                "There is no persisted result named '%s', the persisted results are %s" % (name, self.names()))
+
+    @staticmethod
+    def read_columns(path):
+        """
+        :param path: a directory written by a ColumnFileWriter
+        :returns: a ColumnarResult over memory-mapped arrays
+        """
+
+        if numpy is None:
+            raise Exception(stack()[0][3], "Persisted results need NumPy, which is not installed.")
+
+        with open(os.path.join(path, 'meta.json')) as meta:
+            meta = json.load(meta)
+
+        rows = meta['rows']
+        names = []
+        columns = []
+
+        for index, column in enumerate(meta['columns']):
+            kind = column['kind']
+            file_path = os.path.join(path, '%s.%s' % (index, 'pickle' if kind == 'object' else 'bin'))
+
+            if kind == 'object':
+                chunks = []
+                if os.path.exists(file_path):
+                    with open(file_path, 'rb') as pickled:
+                        while True:
+                            try:
+                                chunks.append(cPickle.load(pickled))
+                            except EOFError:
+                                break
+                values = numpy.concatenate(chunks) if chunks else numpy.empty(0, dtype=object)
+            else:
+                dtype = 'int32' if kind == 'string' else ColumnBuilder._dtypes[kind]
+                if rows == 0:
+                    # an empty file can't be mapped
+                    values = numpy.empty(0, dtype=dtype)
+                else:
+                    values = numpy.memmap(file_path, dtype=dtype, mode='r', shape=(rows,))
+
+            if kind == 'string':
+                with open(os.path.join(path, '%s.dict' % index), 'rb') as dictionary:
+                    values = DictionaryArray(values, cPickle.load(dictionary))
+
+            names.append(column['name'])
+            columns.append(values)
+
+        return ColumnarResult(names, columns)
+
+
+class AsyncQuery(object):
+
+    """
+    A handle on a command running in the background on the worker thread of its alias.
+
+    """
+
+    def __init__(self, query_id, alias, command):
+        """
+        :param query_id: the number used to refer to this query with --wait
+        :param alias: the alias the query runs on
+        :param command: the command being run
+        """
+
+        self.id = query_id
+        self.alias = alias
+        self.command = command
+        self.state = 'pending'
+        self.rows_fetched = 0
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        self._result = None
+        self._error = None
+        self._cancel_hook = None
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+
+    def run(self, job):
+        """
+        Runs the job on the current thread and records the outcome.  Called by the AliasWorker.
+
+        :param job: a function that takes this handle and returns the results
+        """
+
+        with self._lock:
+            if self.state != 'pending':
+                return
+            self.state = 'running'
+            self.started_at = time.time()
+
+        try:
+            result = job(self)
+            error = None
+        except Exception, err:
+            logging.warning(" - Async query %s on '%s' failed: %s", self.id, self.alias, err)
+            result = None
+            error = err
+
+        with self._lock:
+            self._result = result
+            self._error = error
+            self._cancel_hook = None
+            if self.state == 'running':
+                self.state = 'failed' if error is not None else 'done'
+            self.finished_at = time.time()
+
+        self._finished.set()
+
+    def watch(self, cancel_hook):
+        """
+        :param cancel_hook: a function that stops the running statement, like cursor.cancel
+        """
+
+        self._cancel_hook = cancel_hook
+
+    def update(self, rows_fetched):
+        """
+        :param rows_fetched: how many records have been fetched so far
+        """
+
+        self.rows_fetched = rows_fetched
+
+    def done(self):
+        """
+        :returns: boolean, True once the query has finished, failed or been cancelled
+        """
+
+        return self._finished.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the query and returns its results, raising its error if it failed.
+
+        :param timeout: the most seconds to wait (optional)
+        :returns: the results of the query
+        """
+
+        if not self._finished.wait(timeout):
+            raise Exception(stack()[0][3], "Async query %s on '%s' is still %s" % (self.id, self.alias, self.state))
+
+        if self._error is not None:
+            raise self._error
+
+        if self.state == 'cancelled':
+            raise Exception(stack()[0][3], "Async query %s on '%s' was cancelled" % (self.id, self.alias))
+
+        return self._result
+
+    def cancel(self):
+        """
+        Cancels the query, dropping it if it hasn't started or cancelling the running statement.
+
+        :returns: boolean, True if there was something to cancel
+        """
+
+        with self._lock:
+            if self.state == 'pending':
+                self.state = 'cancelled'
+                self.finished_at = time.time()
+                self._finished.set()
+                return True
+            elif self.state != 'running':
+                return False
+
+            self.state = 'cancelled'
+            cancel_hook = self._cancel_hook
+
+        if cancel_hook is not None:
+            logging.debug(" --- Cancelling async query %s on '%s'", self.id, self.alias)
+            cancel_hook()
+
+        return True
+
+    def progress(self):
+        """
+        :returns: a dictionary with the state, timings and records fetched so far
+        """
+
+        now = time.time()
+
+        return {'id' : self.id, \
+                'alias' : self.alias, \
+                'command' : self.command, \
+                'state' : self.state, \
+                'rows_fetched' : self.rows_fetched, \
+                'queued' : (self.started_at or self.finished_at or now) - self.submitted_at, \
+                'elapsed' : (self.finished_at or now) - self.started_at if self.started_at else 0.0 }
+
+    def __repr__(self):
+        return "<AsyncQuery %s on '%s' %s, %s rows fetched>" % (self.id, self.alias, self.state, self.rows_fetched)
+
+
+class AliasWorker(threading.Thread):
+
+    """
+    A thread that owns the connection of one alias and runs its async queries in order.
+
+    Keeping every statement for an alias on one thread means a connection is never
+    used by two threads at once.
+    """
+
+    def __init__(self, alias):
+        """
+        :param alias: the alias this worker runs queries for
+        """
+
+        threading.Thread.__init__(self, name="db_magic-%s" % alias)
+        self.daemon = True
+        self.alias = alias
+        self._jobs = Queue.Queue()
+        self._queries = []
+        self._lock = threading.Lock()
+
+    def submit(self, query, job):
+        """
+        :param query: the AsyncQuery handle for the job
+        :param job: a function that takes the handle and returns the results
+        """
+
+        with self._lock:
+            self._queries.append(query)
+
+        self._jobs.put((query, job))
+
+    def stop(self):
+        """
+        Stops the worker once the queries already submitted have run.
+
+        """
+
+        self._jobs.put(None)
+
+    def is_busy(self):
+        """
+        :returns: boolean, True while there are queries waiting or running
+        """
+
+        # a query is done as soon as its results are ready, a little before the job is
+        # marked as done in the queue, so --wait can be followed right away by another call
+        with self._lock:
+            self._queries = [query for query in self._queries if not query.done()]
+            return len(self._queries) > 0
+
+    def run(self):
+
+        while True:
+            item = self._jobs.get()
+            try:
+                if item is None:
+                    return
+                query, job = item
+                query.run(job)
+            finally:
+                self._jobs.task_done()
+
+class FanOutResult(object):
+
+    """
+    The combined results of one command run against several aliases.
+
+    Every row starts with the alias it came from.  Aliases that failed are reported
+    in errors instead of stopping the others.
+    """
+
+    def __init__(self, columns, rows, errors, timings):
+        """
+        :param columns: the column names, starting with 'alias'
+        :param rows: the rows of every alias, each starting with its alias
+        :param errors: a dictionary of alias to the error it raised
+        :param timings: a dictionary of alias to the seconds it took
+        """
+
+        self.columns = columns
+        self.rows = rows
+        self.errors = errors
+        self.timings = timings
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, index):
+        return self.rows[index]
+
+    def to_pandas(self):
+        """
+        :returns: a pandas DataFrame with an alias column
+        """
+
+        try:
+            import pandas
+        except ImportError:
+            raise Exception(stack()[0][3], "DataFrame results need pandas, which is not installed.")
+
+        return pandas.DataFrame.from_records(self.rows, columns=self.columns)
+
+    def __repr__(self):
+        return "<FanOutResult %s rows from %s aliases, %s errors: %s>" % \
+                (len(self.rows), len(self.timings), len(self.errors), self.rows if len(self.rows) <= 10 else '...')
+
+def split_statements(text):
+    """
+    Splits a script into statements on the semicolons that are outside of quotes and comments.
+
+    Line comments (-- ...) are dropped, since the magic runs statements as a single line.
+    Block comments (/* ... */) are kept so that optimizer hints still reach the database.
+
+    :param text: the script to split
+    :returns: a list of statements, without their semicolons
+    """
+
+    statements = []
+    current = []
+    has_code = False
+    i = 0
+    length = len(text)
+
+    while i < length:
+        char = text[i]
+
+        if char in ("'", '"'):
+            # quoted strings and identifiers, a doubled quote is an escaped quote
+            end = i + 1
+            while end < length:
+                if text[end] == char:
+                    if end + 1 < length and text[end + 1] == char:
+                        end += 2
+                        continue
+                    break
+                end += 1
+            current.append(text[i:end + 1])
+            has_code = True
+            i = end + 1
+        elif text.startswith('--', i):
+            end = text.find('\n', i)
+            if end < 0:
+                end = length
+            i = end
+        elif text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            end = length if end < 0 else end + 2
+            current.append(text[i:end])
+            i = end
+        elif char == ';':
+            if has_code:
+                statements.append(''.join(current).strip())
+            current = []
+            has_code = False
+            i += 1
+        else:
+            current.append(char)
+            if not char.isspace():
+                has_code = True
+            i += 1
+
+    if has_code:
+        statements.append(''.join(current).strip())
+
+    return statements
+
+
+class StatementResult(object):
+
+    """ The outcome of one statement in a multi-statement cell """
+
+    def __init__(self, statement, results=None, rowcount=-1, elapsed=0.0, error=None):
+        """
+        :param statement: the statement that was run
+        :param results: the records it returned, or None if it had no result set
+        :param rowcount: the number of records affected, as reported by the cursor
+        :param elapsed: how many seconds it took to execute and fetch
+        :param error: the error it raised, if any
+        """
+
+        self.statement = statement
+        self.results = results
+        self.rowcount = rowcount
+        self.elapsed = elapsed
+        self.error = error
+
+    def __repr__(self):
+
+        if self.error is not None:
+            outcome = "failed: %s" % self.error
+        elif self.results is not None:
+            outcome = "%s rows" % len(self.results)
+        else:
+            outcome = "%s rows affected" % self.rowcount
+
+        return "<StatementResult %r %s in %.3fs>" % (self.statement[:60], outcome, self.elapsed)
+
+def estimate_size(results):
+    """
+    Estimates how much memory a result takes, without walking all of it.
+
+    :param results: whatever a fetch returned
+    :returns: a tuple of (number of rows, estimated bytes)
+    """
+
+    if results is None or isinstance(results, RowStream):
+        return 0, 0
+
+    if pyarrow is not None and isinstance(results, pyarrow.Table):
+        return results.num_rows, results.nbytes
+
+    if isinstance(results, ColumnarResult):
+        size = 0
+        for name in results.names:
+            column = results.column(name)
+            if isinstance(column, DictionaryArray):
+                column = column.codes
+            size += column.nbytes
+        return len(results), size
+    elif hasattr(results, 'memory_usage'):
+        return len(results), int(results.memory_usage(index=False).sum())
+    elif isinstance(results, list):
+        # size a sample of the rows rather than walking the whole result set
+        sample = results[:100]
+        if not sample:
+            return 0, 0
+        width = sum([sum([sys.getsizeof(value) for value in row]) for row in sample]) / float(len(sample))
+        return len(results), int(width * len(results)) + sys.getsizeof(results)
+
+    return 0, sys.getsizeof(results)
+
+
+def copy_results(results):
+    """
+    Copies the outside of a result, so that changing the result of one query doesn't change
+    what the cache hands out for the next.  The rows, the arrays of a ColumnarResult and
+    Arrow tables (which can't be changed) are shared.
+
+    :param results: whatever a fetch returned
+    :returns: the copy
+    """
+
+    if isinstance(results, list):
+        return list(results)
+    elif isinstance(results, ColumnarResult):
+        return ColumnarResult(results.names, [results.column(name) for name in results.names])
+    elif hasattr(results, 'memory_usage'):
+        return results.copy()
+
+    return results
+
+
+def normalize_command(command):
+    """
+    Collapses whitespace and lower-cases a command outside of its quoted strings, so that
+    commands that only differ in layout or keyword case share a cache key.
+
+    :param command: the command to normalize
+    :returns: the normalized command
+    """
+
+    parts = re.split(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""", command)
+
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r'\s+', ' ', parts[i]).lower()
+
+    return ''.join(parts).strip()
+
+
+# the first pattern that matches the driver (or DBMS) name picks the dialect
+DIALECT_PATTERNS = [(r'teradata', 'teradata'), \
+                    (r'netezza', 'netezza'), \
+                    (r'sql ?server|sqlncli|sqlsrv|msodbcsql|tds|sybase', 'tsql'), \
+                    (r'oracle', 'oracle'), \
+                    (r'db2|iseries|as/?400', 'db2'), \
+                    (r'mysql|maria', 'mysql'), \
+                    (r'sqlite', 'sqlite'), \
+                    (r'snowflake', 'snowflake'), \
+                    (r'hive|impala|spark|databricks', 'hive')]
+
+# how each dialect limits the rows of a query, and how it keeps a random fraction of them
+DIALECT_LIMITS = {'limit' : "SELECT * FROM (%(command)s) preview_query LIMIT %(rows)d", \
+                  'top' : "SELECT TOP %(rows)d * FROM (%(command)s) preview_query", \
+                  'fetch_first' : "SELECT * FROM (%(command)s) preview_query FETCH FIRST %(rows)d ROWS ONLY"}
+
+DIALECTS = {'ansi' : ('limit', "SELECT * FROM (%(command)s) sample_query WHERE RANDOM() < %(fraction)r"), \
+            'teradata' : ('top', "SELECT * FROM (%(command)s) sample_query SAMPLE %(fraction)r"), \
+            'netezza' : ('limit', "SELECT * FROM (%(command)s) sample_query WHERE RANDOM() < %(fraction)r"), \
+            'tsql' : ('top', "SELECT * FROM (%(command)s) sample_query WHERE RAND(CHECKSUM(NEWID())) < %(fraction)r"), \
+            'oracle' : ('fetch_first', "SELECT * FROM (%(command)s) sample_query WHERE DBMS_RANDOM.VALUE < %(fraction)r"), \
+            'db2' : ('fetch_first', "SELECT * FROM (%(command)s) sample_query WHERE RAND() < %(fraction)r"), \
+            'mysql' : ('limit', "SELECT * FROM (%(command)s) sample_query WHERE RAND() < %(fraction)r"), \
+            'sqlite' : ('limit', "SELECT * FROM (%(command)s) sample_query WHERE ABS(RANDOM() %% 1000000) < %(fraction)r * 1000000"), \
+            'snowflake' : ('limit', "SELECT * FROM (%(command)s) sample_query SAMPLE (%(percent)r)"), \
+            'hive' : ('limit', "SELECT * FROM (%(command)s) sample_query WHERE RAND() < %(fraction)r")}
+
+
+# a query that only makes a round trip, for the pool's health check
+HEALTH_QUERIES = {'ansi' : "SELECT 1", \
+                  'oracle' : "SELECT 1 FROM DUAL", \
+                  'db2' : "SELECT 1 FROM SYSIBM.SYSDUMMY1"}
+
+
+def detect_dialect(driver):
+    """
+    :param driver: the name of an ODBC driver or DBMS (can be None)
+    :returns: the name of the SQL dialect, 'ansi' if the driver isn't recognized
+    """
+
+    if driver:
+        for pattern, dialect in DIALECT_PATTERNS:
+            if re.search(pattern, driver, re.IGNORECASE):
+                return dialect
+
+    return 'ansi'
+
+
+def top_level(command):
+    """
+    :param command: a SQL command
+    :returns: the command with its quoted strings and everything inside parentheses blanked
+              out, so that what is left (at the same positions) is the outermost statement
+    """
+
+    blanked = []
+    depth = 0
+    quote = None
+
+    for c in command:
+        if quote is not None:
+            quote = None if c == quote else quote
+            blanked.append(' ')
+        elif c in '\'"[`':
+            quote = ']' if c == '[' else c
+            blanked.append(' ')
+        elif c == '(':
+            depth += 1
+            blanked.append(' ')
+        elif c == ')':
+            depth = max(depth - 1, 0)
+            blanked.append(' ')
+        else:
+            blanked.append(' ' if depth > 0 else c)
+
+    return ''.join(blanked)
+
+
+def derived_table_problem(command, dialect):
+    """
+    Looks for what stops a query from being wrapped in SELECT ... FROM (<query>), which is
+    how the database is asked for a preview or a sample.
+
+    :param command: the query
+    :param dialect: the SQL dialect from detect_dialect()
+    :returns: why the query can't be wrapped, or None if it can
+    """
+
+    outer = top_level(command)
+
+    if dialect == 'tsql':
+        if re.match(r'\s*with\b', outer, re.IGNORECASE):
+            return "it starts with a WITH clause, which T-SQL doesn't allow in a derived table"
+        if re.search(r'\border\s+by\b', outer, re.IGNORECASE) and \
+                not re.match(r'\s*select\s+(distinct\s+)?top\b', outer, re.IGNORECASE):
+            return "it has an ORDER BY without TOP, which T-SQL doesn't allow in a derived table"
+
+    # the columns of a derived table need distinct names
+    select = re.search(r'\bselect\s+((distinct|all)\s+)?(top\s+\d+\s+(percent\s+)?)?', outer, re.IGNORECASE)
+    if select is None:
+        return None
+
+    end = re.compile(r'\b(from|where|group|having|order|union|intersect|except|limit)\b', re.IGNORECASE).search(outer, select.end())
+    end = end.start() if end is not None else len(outer)
+    joined = end < len(outer) and re.search(r'^\s*from\b[^;]*?(\bjoin\b|,)', outer[end:], re.IGNORECASE) is not None
+
+    names = []
+    commas = [match.start() for match in re.finditer(',', outer) if select.end() <= match.start() < end]
+
+    for left, right in zip([select.end()] + [comma + 1 for comma in commas], commas + [end]):
+        column = command[left:right].strip()
+
+        if column == '*' or column.endswith('.*'):
+            if joined:
+                return "it selects * from more than one table, which can give two columns the same name"
+            continue
+
+        # the name is known for a plain column (a.id) or an alias (... AS id), the database
+        # makes up the names of the other expressions
+        name = re.search(r'(^|\.|\bas\s+)(\w+|"[^"]+"|\[[^\]]+\]|`[^`]+`)$', column, re.IGNORECASE)
+        if name is not None and (name.group(1) or re.match(r'^[\w"\[\]`]+$', column)):
+            names.append(name.group(2).strip('"[]`').lower())
+
+    duplicates = sorted(set([name for name in names if names.count(name) > 1]))
+    if duplicates:
+        return "it returns more than one column named %s" % ', '.join(duplicates)
+
+    return None
+
+
+def limit_command(command, dialect, rows=None, percent=None):
+    """
+    Wraps a query so that the database only returns a preview or a random sample of it.
+
+    :param command: the query to wrap
+    :param dialect: the SQL dialect from detect_dialect()
+    :param rows: return at most this many rows (optional)
+    :param percent: keep about this percentage of the rows (optional)
+    :returns: the wrapped query, or None if a preview has to be limited on the client instead
+              because the query can't be wrapped (see derived_table_problem())
+    """
+
+    command = command.strip().rstrip(';').strip()
+
+    if not re.match(r'^[\s(]*(select|with)\b', command, re.IGNORECASE):
+        raise Exception(stack()[0][3], "Only queries can be previewed or sampled, not '%s'" % command)
+
+    problem = derived_table_problem(command, dialect)
+
+    if problem is not None:
+        if percent is not None:
+            raise Exception(stack()[0][3], "The query can't be sampled because %s" % problem)
+        logging.debug(" --- Previewing on the client because %s", problem)
+        return None
+
+    limit, sample = DIALECTS.get(dialect, DIALECTS['ansi'])
+
+    if percent is not None:
+        if not 0 < percent <= 100:
+            raise Exception(stack()[0][3], "'%s' is an invalid percentage to sample" % percent)
+        command = sample % {'command' : command, 'percent' : percent, 'fraction' : percent / 100.0}
+
+    if rows is not None:
+        if rows <= 0:
+            raise Exception(stack()[0][3], "'%s' is an invalid number of rows to preview" % rows)
+        command = DIALECT_LIMITS[limit] % {'command' : command, 'rows' : rows}
+
+    return command
+
+
+class ResultCache(object):
+
+    """
+    An LRU cache of fetched results, bounded by their estimated size in bytes.
+
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        """
+        :param max_bytes: the most estimated bytes of results to keep
+        """
+
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: the key the results were stored under
+        :returns: a copy of the cached results (see copy_results()), or None if they are missing or expired
+        """
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            results, expires_at, size = entry
+
+            if expires_at is not None and expires_at < time.time():
+                self.total_bytes -= size
+                self.misses += 1
+                return None
+
+            # put it back at the most recently used end
+            self._entries[key] = entry
+            self.hits += 1
+
+        return copy_results(results)
+
+    def put(self, key, results, ttl=None):
+        """
+        :param key: the key to store the results under
+        :param results: the results to cache, a copy is kept (see copy_results())
+        :param ttl: how many seconds the results stay valid (None never expires)
+        """
+
+        results = copy_results(results)
+        rows, size = estimate_size(results)
+
+        if size > self.max_bytes:
+            logging.debug(" --- Not caching %s bytes of results, the cache only holds %s", size, self.max_bytes)
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous[2]
+
+            expires_at = None if ttl is None else time.time() + ttl
+            self._entries[key] = (results, expires_at, size)
+            self.total_bytes += size
+
+            while self.total_bytes > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= evicted[2]
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Forgets every cached result.
+
+        """
+
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """
+        :returns: a dictionary of counters for the cache
+        """
+
+        with self._lock:
+            return {'entries' : len(self._entries), \
+                    'bytes' : self.total_bytes, \
+                    'hits' : self.hits, \
+                    'misses' : self.misses, \
+                    'evictions' : self.evictions }
+
+
+class QueryTiming(object):
+
+    """ The timings of the phases of one %db call, along with what it fetched """
+
+    phases = ('connect', 'execute', 'fetch', 'commit', 'rollback', 'disconnect')
+
+    def __init__(self, alias, command):
+        """
+        :param alias: the alias the call ran on
+        :param command: the command that was executed
+        """
+
+        self.alias = alias
+        self.command = command
+        self.started_at = time.time()
+        self.timings = {}
+        self.rows = 0
+        self.bytes_estimated = 0
+        self.error = None
+
+    def record(self, phase, started):
+        """
+        :param phase: the phase that just finished
+        :param started: the time.time() when the phase started
+        """
+
+        self.timings[phase] = self.timings.get(phase, 0.0) + (time.time() - started)
+
+    def measure(self, results):
+        """
+        Records how many rows were fetched and estimates how much memory they take.
+
+        :param results: whatever the fetch returned
+        """
+
+        self.rows, self.bytes_estimated = estimate_size(results)
+
+    def total(self):
+        """
+        :returns: the seconds spent in all of the phases
+        """
+
+        return sum(self.timings.values())
+
+    def as_dict(self):
+        """
+        :returns: a dictionary that can be written out as JSON
+        """
+
+        record = {'alias' : self.alias, \
+                  'command' : self.command, \
+                  'started_at' : self.started_at, \
+                  'total' : self.total(), \
+                  'rows' : self.rows, \
+                  'bytes_estimated' : self.bytes_estimated, \
+                  'error' : None if self.error is None else str(self.error) }
+
+        for phase in self.phases:
+            record[phase] = self.timings.get(phase)
+
+        return record
+
+    def __repr__(self):
+        return "<QueryTiming '%s' %.3fs, %s rows: %s>" % (self.alias, self.total(), self.rows, \
+                ', '.join(["%s=%.3fs" % (phase, self.timings[phase]) for phase in self.phases if phase in self.timings]))
+
+
+class QueryStats(object):
+
+    """
+    A bounded, in-memory ring buffer of QueryTiming records.
+
+    Exporters are functions called with each record as it is added, for example
+    QueryStats.file_exporter(path) to keep a JSON lines log of every call.
+    """
+
+    def __init__(self, max_records=1000):
+        """
+        :param max_records: how many of the most recent records to keep
+        """
+
+        self.records = deque(maxlen=max_records)
+        self.exporters = []
+
+    def add(self, timing):
+        """
+        :param timing: a finished QueryTiming
+        """
+
+        self.records.append(timing)
+
+        for exporter in self.exporters:
+            try:
+                exporter(timing)
+            except Exception, err:
+                logging.warning(" - A stats exporter failed: %s", err)
+
+    def add_exporter(self, exporter):
+        """
+        :param exporter: a function called with every new QueryTiming
+        """
+
+        self.exporters.append(exporter)
+
+    @staticmethod
+    def file_exporter(path):
+        """
+        :param path: the file to append JSON lines to
+        :returns: an exporter for add_exporter()
+        """
+
+        lock = threading.Lock()
+
+        def export(timing):
+            with lock:
+                with open(path, 'a') as out:
+                    out.write(json.dumps(timing.as_dict()) + '\n')
+
+        return export
+
+    def clear(self):
+        """
+        Forgets every record.
+
+        """
+
+        self.records.clear()
+
+    def summary(self, recent=10):
+        """
+        :param recent: how many of the most recent records to include
+        :returns: a dictionary of per-alias percentiles and the most recent records
+        """
+
+        records = list(self.records)
+        by_alias = OrderedDict()
+
+        for timing in records:
+            by_alias.setdefault(timing.alias, []).append(timing)
+
+        aliases = OrderedDict()
+
+        for alias, timings in by_alias.items():
+            totals = sorted([timing.total() for timing in timings])
+            stats = {'count' : len(timings), \
+                     'errors' : len([timing for timing in timings if timing.error is not None]), \
+                     'rows' : sum([timing.rows for timing in timings]), \
+                     'p50' : self.percentile(totals, 50), \
+                     'p90' : self.percentile(totals, 90), \
+                     'p99' : self.percentile(totals, 99) }
+
+            for phase in QueryTiming.phases:
+                values = sorted([timing.timings[phase] for timing in timings if phase in timing.timings])
+                if values:
+                    stats[phase + '_p50'] = self.percentile(values, 50)
+
+            aliases[alias] = stats
+
+        return {'aliases' : aliases, 'recent' : records[-recent:]}
+
+    @staticmethod
+    def percentile(values, percent):
+        """
+        :param values: a sorted list of numbers
+        :param percent: the percentile to find, from 0 to 100
+        :returns: the nearest-rank percentile, or None if there are no values
+        """
+
+        if not values:
+            return None
+
+        rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+
+        return values[min(max(rank, 0), len(values) - 1)]
+
+SQL_KEYWORDS = ('SELECT', 'FROM', 'WHERE', 'GROUP BY', 'ORDER BY', 'HAVING', 'LIMIT', 'OFFSET', 'DISTINCT', \
+                'JOIN', 'INNER JOIN', 'LEFT JOIN', 'RIGHT JOIN', 'FULL OUTER JOIN', 'CROSS JOIN', 'ON', 'USING', \
+                'UNION', 'UNION ALL', 'INTERSECT', 'EXCEPT', 'AS', 'AND', 'OR', 'NOT', 'IN', 'EXISTS', 'BETWEEN', \
+                'LIKE', 'IS NULL', 'IS NOT NULL', 'CASE', 'WHEN', 'THEN', 'ELSE', 'END', 'WITH', 'INSERT INTO', \
+                'VALUES', 'UPDATE', 'SET', 'DELETE FROM', 'CREATE TABLE', 'CREATE VIEW', 'DROP TABLE', \
+                'ALTER TABLE', 'COUNT', 'SUM', 'AVG', 'MIN', 'MAX', 'CAST', 'COALESCE', 'OVER', 'PARTITION BY')
+
+def catalog_loader(entry, kind, connect=None):
+    """
+    :param entry: the ConnectionEntry to list the catalog of
+    :param kind: what to list, one of CATALOG_KINDS
+    :param connect: a function returning another connection to list on, for listing from a
+                    thread that doesn't own the connection of the entry (optional)
+    :returns: a function that lists the kind from the database, returning (names, rows)
+    """
+
+    def listing():
+
+        if connect is None:
+            with entry.use() as cursor:
+                rows = entry.driver.list(entry.connection, cursor, kind)
+                return [column[0] for column in cursor.description or []], rows
+
+        connection = connect()
+        cursor = entry.driver.cursor(connection)
+        try:
+            rows = entry.driver.list(connection, cursor, kind)
+            return [column[0] for column in cursor.description or []], rows
+        finally:
+            cursor.close()
+
+    return listing
+
+
+class PrefixIndex(object):
+
+    """
+    Words kept in a sorted array, so the words that start with a prefix are found with a
+    binary search instead of a scan.  Lookups ignore case.
+    """
+
+    def __init__(self, words=()):
+        """
+        :param words: the words to index
+        """
+
+        pairs = sorted(set([(word.lower(), word) for word in words if word]))
+
+        self._keys = [key for key, word in pairs]
+        self._words = [word for key, word in pairs]
+
+    def complete(self, prefix, limit=None):
+        """
+        :param prefix: the start of a word
+        :param limit: the most words to return (optional)
+        :returns: the words that start with the prefix, in order
+        """
+
+        key = prefix.lower()
+        start = bisect.bisect_left(self._keys, key)
+        end = bisect.bisect_left(self._keys, key + u'\uffff', start)
+
+        if limit is not None:
+            end = min(end, start + limit)
+
+        return self._words[start:end]
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class CatalogIndex(object):
+
+    """ The prefix indexes of the schemas, tables and columns of one data source """
+
+    def __init__(self, tables, columns=None):
+        """
+        :param tables: the CatalogListing of the tables
+        :param columns: the CatalogListing of the columns (optional)
+        """
+
+        self.tables = tables
+        self.columns = columns
+
+        names = set()
+        for catalog, schema, name in [tables.parts(row) for row in tables.rows]:
+            names.update([name, schema, '%s.%s' % (schema, name) if schema else None])
+
+        self._names = PrefixIndex(names)
+
+        by_table = {}
+        column_name = columns.field('column_name') if columns is not None else None
+        if column_name is not None:
+            for row in columns.rows:
+                table = columns.parts(row)[2]
+                if table:
+                    by_table.setdefault(table.lower(), []).append(row[column_name])
+
+        self._columns = PrefixIndex(set([column for table in by_table.values() for column in table]))
+        self._by_table = dict([(table, PrefixIndex(table_columns)) for table, table_columns in by_table.items()])
+
+    def complete(self, prefix, limit=None):
+        """
+        :param prefix: the start of a schema, table or column, or table.column
+        :param limit: the most words to return (optional)
+        :returns: the schemas, tables and columns that start with the prefix
+        """
+
+        if '.' in prefix:
+            table, column = prefix.rsplit('.', 1)
+            index = self._by_table.get(table.split('.')[-1].lower())
+            if index is not None:
+                return ['%s.%s' % (table, name) for name in index.complete(column, limit)]
+
+        return self._names.complete(prefix, limit) + self._columns.complete(prefix, limit)
+
+
+class SqlCompleter(object):
+
+    """
+    Completes %db and %%db lines in IPython: options, connection types, aliases, sources,
+    SQL keywords, and the schemas, tables and columns of the alias being used.
+
+    Nothing is asked of the database while a key is being pressed.  The catalog of an alias
+    is listed (through the catalog cache) and indexed on a background thread the first time
+    it is needed, and until it is ready the rest is still completed.
+    """
+
+    def __init__(self, magics, limit=200):
+        """
+        :param magics: the DbMagic class, whose registry and catalogs are used
+        :param limit: the most completions to offer of each kind
+        """
+
+        self.magics = magics
+        self.limit = limit
+
+        self._keywords = PrefixIndex(SQL_KEYWORDS)
+        self._options = None
+        self._indexes = {}
+        self._building = set()
+        self._lock = threading.Lock()
+
+    def __call__(self, shell, event):
+        """
+        The complete_command hook.
+
+        :param shell: the InteractiveShell
+        :param event: what is being completed, with the line, symbol and text_until_cursor
+        :returns: a list of completions
+        """
+
+        symbol = event.symbol or ''
+        tokens = event.text_until_cursor.split()
+
+        # the token before the one being completed says what kind of value is wanted
+        previous = tokens[-1] if symbol == '' and tokens else tokens[-2] if len(tokens) > 1 else ''
+
+        if previous in ('-a', '--alias', '-def', '--default', '--cancel', '--aliases'):
+            return self.magics._registry.aliases()
+        elif previous in ('-t', '--type'):
+            return sorted(DRIVERS.keys())
+        elif previous in ('-l', '--list'):
+            return ['sources'] + list(CATALOG_KINDS)
+        elif symbol.startswith('-'):
+            return self.options()
+
+        completions = []
+
+        alias = self.alias(event.line)
+        if alias is not None:
+            index = self.index(alias)
+            if index is not None:
+                completions.extend(index.complete(symbol, self.limit))
+
+        if len(tokens) <= 2 and not event.line.startswith('%%'):
+            completions.extend(self.magics._registry.aliases())
+            completions.extend(self.magics._source_catalog.names(refresh=False))
+
+        completions.extend(self._keywords.complete(symbol, self.limit))
+
+        return completions
+
+    def options(self):
+        """
+        :returns: the option strings of %db
+        """
+
+        if self._options is None:
+            parser = getattr(self.magics.parse_args, 'parser', None)
+            self._options = sorted(parser._option_string_actions.keys()) if parser is not None else []
+
+        return self._options
+
+    def alias(self, line):
+        """
+        :param line: the %db line, or the whole %%db cell
+        :returns: the alias the line runs on, or None if there isn't one
+        """
+
+        registry = self.magics._registry
+        words = line.split('\n', 1)[0].split()[1:]
+
+        for position, word in enumerate(words):
+            if word in ('-a', '--alias') and position + 1 < len(words):
+                return words[position + 1]
+
+        positional = [word for word in words if not word.startswith('-')]
+        if positional and positional[0] in registry:
+            return positional[0]
+
+        return registry.default_alias or None
+
+    def index(self, alias):
+        """
+        :param alias: a registered alias
+        :returns: the CatalogIndex of the source of the alias, or None if it isn't built yet
+        """
+
+        entry = self.magics._registry.get(alias)
+        if entry is None:
+            return None
+
+        catalog = self.magics._catalog_cache
+        source = catalog_key(entry)
+        tables = catalog.listing(source, 'tables')
+
+        with self._lock:
+            index = self._indexes.get(source)
+            current = index is not None and index.tables is tables and not catalog.is_stale(tables)
+
+            if not current and source not in self._building:
+                self._building.add(source)
+                builder = threading.Thread(target=self.build, args=(entry, source))
+                builder.daemon = True
+                builder.start()
+
+        return index
+
+    def build(self, entry, source):
+        """
+        Lists the catalog of a source and indexes it.  Runs on a background thread.
+
+        A connection can only be used by one thread, so the catalog is listed on a connection
+        of its own, which is only opened if the catalog cache doesn't have the listings.
+
+        :param entry: a ConnectionEntry on the source
+        :param source: the name the catalog is cached under
+        """
+
+        catalog = self.magics._catalog_cache
+        connections = []
+
+        def connect():
+            if not connections:
+                if entry.opener is None:
+                    raise Exception(stack()[0][3], "There is no way to open another connection to %s" % source)
+                connections.append(entry.opener())
+            return connections[0]
+
+        try:
+            started = time.time()
+            catalog.get(source, 'tables', catalog_loader(entry, 'tables', connect))
+
+            try:
+                catalog.get(source, 'columns', catalog_loader(entry, 'columns', connect))
+            except Exception, err:
+                logging.debug(" --- The columns of %s can't be listed for completion: %s", source, err)
+
+            index = CatalogIndex(catalog.listing(source, 'tables'), catalog.listing(source, 'columns'))
+
+            with self._lock:
+                self._indexes[source] = index
+
+            logging.debug(" --- Indexed the catalog of %s for completion in %.3fs", source, time.time() - started)
+        except Exception, err:
+            logging.debug(" --- The catalog of %s can't be indexed for completion: %s", source, err)
+        finally:
+            for connection in connections:
+                try:
+                    entry.driver.close(connection)
+                except Exception, err:
+                    logging.debug(" --- There was a problem closing the catalog connection to %s: %s", source, err)
+
+            with self._lock:
+                self._building.discard(source)
+
+
+# a line with no options, escapes or runs of whitespace, see DbMagic.fast_args()
+SIMPLE_LINE = re.compile(r'^[^\s\\-](?:[^\s\\]| (?! |-))*$')
+
+
+@magics_class
+class DbMagic(Magics):
+
+    _registry = ConnectionRegistry()
+    _source_catalog = SourceCatalog()
+    _pool = ConnectionPool()
+    _conn_lock = threading.RLock()
+    _workers = {}
+    _async_queries = OrderedDict()
+    _async_ids = itertools.count(1)
+    _stream_ids = itertools.count(1)
+    _stats = QueryStats()
+    _result_cache = ResultCache()
+    _result_store = ResultStore()
+    _catalog_cache = CatalogCache()
+    _default_args = None
+    _fast_parse = True
+    _args = {}
+
+    @magic_arguments()
+    @argument('source', type=str, help='The identifier of the data source (optional)',default='', nargs='?')
+    @argument('cmd', type=str, help='A command to be executed (optional)',default='', nargs='*')
+    @argument('-src', '--source', help='The data source to use (optional).', action="store")
+    @argument('-a', '--alias', help='The key to refer to this connection with', action="store")
+    @argument('-def', '--default', help='The key to refer to this connection with', action="store")
+    @argument('-c', '--connect', '--conn', help='Connect to this database', action="store_true")
+    @argument('-d', '--disconnect', '--dis', help='Disconnect from this datbase', action="store_true")
+    @argument('-t', '--type', help='Connection type (ODBC is the default)', action="store", default="odbc")
+    @argument('-l', '--list', help='List things about the database.', action="store", nargs='?')
+    @argument('-e', '--execute', '--exec', help='Some SQL to execute', action="store_true")
+    @argument('-m', '--commit', help='Commit this transaction.', action="store_true")
+    @argument('-r', '--rollback', help='Rollback this transaction.', action="store_true")
+    @argument('-n', '--naked', help='Run a naked query (same as --connect --execute --fetch --disconnect)', action="store_true")
+    @argument('--unsourced', help='Run an unsourced query (same as --connect --execute --fetch --disconnect)', action="store_true")
+    @argument('-f', '--fetch', help='Fetch one or more records (default is all)', action="store", default=0,nargs='?')
+    @argument('--stream', help='Return a lazy iterator that fetches N records at a time (default is %s)' % DEFAULT_STREAM_BATCH, action="store", type=int, const=DEFAULT_STREAM_BATCH, nargs='?')
+    @argument('--columnar', help='Return typed column arrays, fetching N records at a time (default is %s)' % DEFAULT_STREAM_BATCH, action="store", type=int, const=DEFAULT_STREAM_BATCH, nargs='?')
+    @argument('--df', help='Return a pandas DataFrame, fetching N records at a time (default is %s)' % DEFAULT_STREAM_BATCH, action="store", type=int, const=DEFAULT_STREAM_BATCH, nargs='?')
+    @argument('--arrow', help='Return a pyarrow Table (or record batches with --stream), fetching N records at a time (default is %s)' % DEFAULT_STREAM_BATCH, action="store", type=int, const=DEFAULT_STREAM_BATCH, nargs='?')
+    @argument('--downcast', help='Store DataFrame integer columns in the smallest type that fits', action="store_true")
+    @argument('--categorize', help='Make DataFrame string columns with at most this ratio of distinct values categorical (default is 0.5)', action="store", type=float, const=0.5, nargs='?')
+    @argument('-u', '--uid', '--username', help='The user name to use (optional).', action="store", default='')
+    @argument('-p', '--pwd', '--password', help='The password to use (optional).', action="store", default='')
+    @argument('-h', '--help', help='Display help.', action="store_true")
+    @argument('-v', '--verbose', help='Display debugging verbosely (same as --debug=DEBUG', action="store_true")
+    @argument('--debug', help='Output debugging info', action="store", default='WARNING',nargs='?')
+    @argument('-y', '--dry_run', '--dry', help='Make this a dry run', action="store_true")
+    @argument('--explain', help='Give an explanation on exac', action="store_true")
+    @argument('--note', help='Add a note for help with debugging', action="store", nargs="*")
+    @argument('--cleanup', help='Clean up all the connections and shut down', action="store_true")
+    @argument('--refresh', help='Refresh cached values (like sources) before using them', action="store_true")
+    @argument('--async', dest='async_query', help='Run the command in the background and return a handle', action="store_true")
+    @argument('--wait', help='Wait for the async query with this id and return its results', action="store", type=int)
+    @argument('--status', help='Show the progress of the async queries', action="store_true")
+    @argument('--aliases', help='Run the command on each of these comma-separated aliases', action="store")
+    @argument('--all-aliases', dest='all_aliases', help='Run the command on every registered alias', action="store_true")
+    @argument('--workers', help='How many aliases to run at once with --aliases (default is %s)' % DEFAULT_FAN_OUT_WORKERS, action="store", type=int, default=DEFAULT_FAN_OUT_WORKERS)
+    @argument('--continue', dest='continue_on_error', help='Keep running the statements of a cell after one fails', action="store_true")
+    @argument('--insert', help='Insert the records from --from into this table', action="store")
+    @argument('--from', dest='from_var', help='The variable (a DataFrame or a list of rows) to insert from', action="store")
+    @argument('--batch-size', dest='batch_size', help='How many records to send with each --insert round trip (default is %s)' % DEFAULT_INSERT_BATCH, action="store", type=int, default=DEFAULT_INSERT_BATCH)
+    @argument('--stats', help='Show the timings of recent calls, with percentiles per alias', action="store_true")
+    @argument('--cache', help='Cache the results for N seconds, or use the cached results (default is %s)' % DEFAULT_CACHE_TTL, action="store", type=float, const=DEFAULT_CACHE_TTL, nargs='?')
+    @argument('--no-cache', dest='no_cache', help='Run the command even if its results are cached (with --cache, replace them)', action="store_true")
+    @argument('--cache-clear', dest='cache_clear', help='Forget all of the cached results', action="store_true")
+    @argument('--persist', help='Write the results to disk under this name as they are fetched', action="store")
+    @argument('--load', help='Load the results persisted under this name, without running anything', action="store")
+    @argument('--preview', help='Have the database return only the first N records of the query', action="store", type=int)
+    @argument('--sample', help='Have the database return a random N percent of the records of the query', action="store", type=float)
+    @argument('--arraysize', help='How many records to fetch with each round trip (default is %s)' % DEFAULT_STREAM_BATCH, action="store", type=int)
+    @argument('--adaptive', help='Grow or shrink the records per round trip based on the measured throughput', action="store_true")
+    @argument('--timeout', help='Cancel the command if it runs for more than this many seconds', action="store", type=float)
+    @argument('--cancel', help='Cancel whatever is running on this alias and clean up its connection', action="store")
+    @argument('--like', help='With --list, only list the objects whose [[catalog.]schema.]name matches this pattern', action="store")
+    @argument('--catalog-file', dest='catalog_file', help='Keep the catalog cache in this SQLite file (default is %s)' % DEFAULT_CATALOG_FILE, action="store", const=DEFAULT_CATALOG_FILE, nargs='?')
+
+    def parse_args(self,magic_args, cell=None):
+        """
+        parses the arguments from the ipython magic call
+
+        Everything is pretty straightforward here except for special convienence cases
+       
+        %db <source> <cmd>    [or a naked query]
+        %db <cmd>             [or an unsourced query]
+
+       This is how most users would expect to call the function.  However, this means we
+       have to infer a hell of a lot of things based on very little information.
+       
+        There are also a few challenges here:
+          1. The cmd argument can be multiple words, or empty.
+          2. The source argument is optional, if we just have cmd then we need to find source.
+          3. The options are all optional, so we need to interpret what is really meant.
+
+        If we have both arguments, no problem.  However, we can't really tell if this is the,
+        case except by testing to see if we already have a data source that matches what is 
+        specified.  If there is no match, then we can use the default data source unless
+        this is a new connection.
+
+        :param magic_args: the arguments to be parsed from @magic_arguments
+        :param cell: the command from the cell of a cell magic (optional)
+        :returns: formatted string
+
+        """
+
+        no_alias_provided = False
+        
+        # parse the arguments and assign them to a class-level variable
+        self._args = self.fast_args(magic_args) if self._fast_parse else None
+        if self._args is None:
+            self._args = parse_argstring(self.parse_args, magic_args)
+
+        # the command of a cell comes after the positional arguments of its line, but it is
+        # never parsed, so options like --fetch can't swallow its first word
+        if cell is not None and cell.strip():
+            cell = cell.replace('\n', ' ').strip()
+            if self._args.source:
+                self._args.cmd = list(self._args.cmd or []) + [cell]
+            else:
+                words = cell.split(None, 1)
+                self._args.source = words[0]
+                self._args.cmd = words[1:]
+
+        # IPython splits the line without removing quotes, so a quoted source still has them
+        source = self._args.source
+        if source is not None and len(source) > 1 and source[0] == source[-1] and source[0] in '"\'':
+            self._args.source = source[1:-1]
+
+        logging.debug(' -- The parsed arguments are: %s', self._args)
+
+        #############################################################################
+        # the key/value store uses the alias, so if there isn't one just set it
+        # to the source so we have a uniform way of dealing with things
+        #############################################################################
+        if self._args.alias is None:
+            logging.debug(" --- No alias provided, using %s", self._args.source)
+            no_alias_provided = True
+            self._args.alias = self._args.source
+
+        connection_alias = self._args.alias
+        connection_key = self._args.source
+        connection_cmd = ' '.join(self._args.cmd)
+        connection_fetch = self._args.fetch
+
+        #############################################################################
+        # both of the special cases below need to know if the source is a DSN, so
+        # look it up once in the cached catalog instead of enumerating every time
+        #############################################################################
+        if self._args.refresh:
+            logging.debug(" --- Invalidating the source catalog")
+            self._source_catalog.invalidate()
+
+        # only ODBC has a catalog of sources, any other driver takes a path or connection string
+        if self._args.type.lower() == 'odbc':
+            source_is_dsn = (self._args.source is not None) and \
+                (self._args.source in self._source_catalog)
+        else:
+            source_is_dsn = (self._args.source is not None) and \
+                (len(self._args.source) > 0) and \
+                (self._args.source not in self._registry) and \
+                get_driver(self._args.type).is_source(self._args.source)
+
+        ##############################################################################
+        # handling the special situation of %db <source> <cmd> (or a NAKED QUERY)
+        #
+        # We know that we:
+        #
+        # 1. Will have our positional arguments (either source and cmd or just cmd) defined.
+        # 2. Will NOT have an existing connection with the same name.
+        # 3. Will NOT have connection-specific options (like alias, connect, execute, disconnect)
+        # 4. May have record-filtering options (like fetch and skip)
+        # 5. May have incidental options(like debug, user, pass)
+        #
+        # Also, the line_magic function is set up so that if you pass multiple options, they will
+        # be executed in the correct order.  For example, if you have a call like:
+        #
+        #   %db <source> <cmd> --connect --skip 10 --fetch --disconnect
+        #
+        # we can rely on the fact that things will be handled properly.
+        ##############################################################################
+
+        imply_naked_query =  \
+            source_is_dsn and \
+            (self._args.cmd is not None) and \
+            (len(self._args.cmd) > 0) and \
+            (connection_key not in self._registry) and \
+            (self._args.list is None) and \
+            (no_alias_provided and \
+                not self._args.connect and \
+                not self._args.execute and \
+                not self._args.disconnect )
+
+        if (self._args.naked or imply_naked_query ):
+            logging.debug(" --- This is a naked query with source '%s' and cmd '%s'", connection_alias, connection_cmd)
+            self._args.naked = True
+            self._args.fetch = 'all'
+            connection_fetch = 'all'
+            logging.debug(" --- Changing fetch to %s", self._args.fetch)
+        else:
+            logging.debug(' --- This is not a naked query')
+
+        ##############################################################################
+        # handling the special situation of %db <cmd> (or an UNSOURCED QUERY)
+        #
+        # We know that we:
+        #
+        # 1. Will have our positional arguments (either source and cmd or just cmd) defined.
+        # 2. Will have an existing connection with the same name.
+        # 3. Will NOT have connection-specific options (like alias, connect, execute, disconnect)
+        # 4. May have record-filtering options (like fetch and skip)
+        # 5. May have incidental options(like debug, user, pass)
+        #
+        ##############################################################################
+        imply_unsourced_query =  \
+            (self._args.source is not None) and \
+            not source_is_dsn and \
+            (self._args.cmd is not None) and \
+            (self._args.list is None) and \
+            (self._args.wait is None) and \
+            (self._args.cancel is None) and \
+            (not self._args.status) and \
+            (not self._args.stats) and \
+            (not self._args.cache_clear) and \
+            (self._args.load is None) and \
+            (no_alias_provided and \
+                not self._args.cleanup and \
+                not self._args.connect and \
+                not self._args.execute and \
+                not self._args.disconnect )
+
+        if (imply_unsourced_query ):
+            logging.debug(" --- This is an unsourced query with source '%s' and cmd '%s'", connection_alias, connection_cmd)
+            self._args.unsourced = True
+            self._args.fetch = 'all'
+            connection_fetch = 'all'
+            logging.debug(" --- Changing fetch to %s ", self._args.fetch)
+        else:
+            logging.debug(" --- This is NOT unsourced query with source '%s' and cmd '%s'", connection_alias, connection_cmd)
+
+        if connection_key not in self._registry and \
+                not self._args.naked and \
+                not self._args.unsourced:
+            # this is not a new connection and not an established source, we assume 
+            # this is a command line like %db <exec> and fix the command
+            try:
+                if self._args.connect:
+                    self._args.cmd = self_args.cmd[1:]
+                    connection_cmd = ' '.join(self._args.cmd)
+                    logging.debug(" --- Removing %s from %s into '%s'", connection_key, self._args.cmd, connection_cmd)
+                else:
+                    self._args.cmd.insert(0,connection_key)
+                    connection_cmd = ' '.join(self._args.cmd)
+                    logging.debug(" --- Merging %s and %s into '%s'", connection_key, self._args.cmd, connection_cmd)
+            except:
+                pass
+
+        if self._args.unsourced:
+
+            if len(self._args.cmd) > 0:
+                self._args.cmd.insert(0,connection_key)
+                connection_cmd = ' '.join(self._args.cmd)
+                logging.debug(" --- Merging %s and %s into '%s'", connection_key, self._args.cmd, connection_cmd)
+
+            logging.debug(" ---Assigning alias from the default as %s", self._registry.default_alias)
+            self._args.alias = self._registry.default_alias
+            connection_alias = self._args.alias
+
+            logging.debug(" ---Assigning source from the default as %s", self._registry.default_alias)
+            self._args.source = self._registry.default_alias
+            connection_key = self._args.source
 
         ##############################################################################
         # make it so we can make a connection, then assume that we are using the same alias
         # until we specify a different one
         ##############################################################################
         if connection_alias == '' or connection_alias is None:
-            connection_alias =  self._most_recent_conn_alias
-            logging.debug(" --- Setting current alias to %s" % (connection_alias))
+            connection_alias =  self._registry.most_recent_alias
+            logging.debug(" --- Setting current alias to %s", connection_alias)
+
+        ##############################################################################
+        # make it so that if there is a command it will be executed, regardless of interpretation.
+        ##############################################################################
+        if len(connection_cmd) > 1:
+            logging.debug(" --- Command is %s, setting execute to True", connection_cmd)
+            self._args.execute = True
+
+
+        ##############################################################################
+        # set up logging for this particular run
+        ##############################################################################
+        if self._args.debug is None or \
+                self._args.debug.lower() == 'debug' or \
+                self._args.verbose:
+            level = logging.DEBUG
+        elif self._args.debug.lower() == 'warning':
+            level = logging.WARNING
+        elif self._args.debug.lower() == 'info':
+            level = logging.INFO
+        elif self._args.debug.lower() == 'error':
+            level = logging.ERROR
+        elif self._args.debug.lower() == 'critical':
+            level = logging.CRITICAL
+        else:
+            level = None
+
+        if level is None:
+            logging.getLogger().setLevel(logging.INFO)
+            logging.debug(" --- The debug level '%s' is not valid, using INFO.", self._args.debug)
+        elif logging.getLogger().level != level:
+            logging.getLogger().setLevel(level)
+
+        return connection_alias, connection_key, connection_cmd, connection_fetch, self._args
+
+    def fast_args(self, magic_args):
+        """
+        Parses the common %db <cmd> and %db <source> <cmd> lines without argparse.
+
+        A line with no options, escapes, runs of whitespace or quoted strings with spaces in
+        them splits the same with str.split() as it does with arg_split(), so the result is
+        the same as parse_argstring() for a fraction of the cost.
+
+        :param magic_args: the arguments to be parsed
+        :returns: the parsed arguments, or None if the line needs the full parser
+        """
+
+        if not SIMPLE_LINE.match(magic_args):
+            return None
+
+        words = magic_args.split()
+
+        for word in words:
+            if word[0] in '\'"' and (len(word) < 2 or word[-1] != word[0] or word.count(word[0]) != 2):
+                return None
+
+        if DbMagic._default_args is None:
+            DbMagic._default_args = parse_argstring(self.parse_args, '')
+
+        args = copy.copy(DbMagic._default_args)
+        args.source = words[0]
+        if len(words) > 1:
+            args.cmd = words[1:]
+
+        return args
+
+    def explain(self, alias, key, cmd, fetch, args, line):
+        """
+        Explains the operations that are going to be done as part of the command line invocation
+
+        :param alias: the plain english name to associate with this connection
+        :param type: the type of connection to use
+        :param key: the key that will be used to find the correct connection.
+        :param cmd: the command that will be executed 
+        :param fetch: the argument for fetching data or not
+        :param args: all the arguments passed to the class
+        :param line: the command line used to call the class
+
+        """
+
+        print("Command Line called : %%db %s" % line)
+        print("-------------------")
+        print("Args Parsed: %s" % args)
+        print("-------------------")
+        print("Data Source to Use: %s" % args.source)
+        print("Data Source Type: %s" % args.type)
+        print("Data Source Alias: %s" % alias)
+        print("Command to Execute: %s" % cmd)
+        print("Execution Notes: %s" % str(args.note))
+        print("-------------------")
+        print("Open Connections: %s" % self._registry)
+        print("Source Catalog Refreshes: %s" % self._source_catalog.refresh_count)
+        print("Connection Pool: %s" % self._pool.stats())
+        print("-------------------")
+        print("Is this a Naked Query?: %s" % args.naked)
+        print("Is this a Unsourced Query?: %s" % args.unsourced)
+        print("-------------------")
+        print("Are we Connecting to DB?: %s" % (args.connect or args.naked))
+        print("Are we Commiting Transaction?: %s" % (args.commit))
+        print("Are we Fetching records?: %s" % fetch)
+        print("Are we Listing values?: %s" % args.list)
+        print("Are we Disconnecting from DB?: %s" % (args.disconnect or args.naked))
+        print("=========================================================")
+
+        return
+
+    def is_registered(self, alias):
+        """
+        
+        :param alias: the alias to verify as existing
+        :returns: boolean
+
+        """
+
+        return alias in self._registry
+
+    def is_connected(self, alias):
+        """
+        validates that an alias exists and has a connection
+        
+        :param alias: the alias to verify as a valid connection
+        :returns: boolean
+
+        """
+
+        entry = self._registry.get(alias)
+
+        return entry is not None and entry.connection is not None
+
+    def open_connection(self, connection_type, connection_source, username, password):
+        """
+        Opens a new connection to a data source without registering it.
+
+        :param connection_type: the type of connection to use
+        :param connection_source: the name of an an ODBC DSN or connection string
+        :param username: the username to use for a connection (optional)
+        :param password: connection_source: the password to use for a connection (optional)
+        :returns: the new connection
+
+        """
+
+        driver = get_driver(connection_type)
+
+        logging.debug(" ---- Attempting to connect to '%s' with %s", connection_source, driver)
+
+        return driver.connect(connection_source, username, password)
+
+    def connect_to_source(self, connection_alias, connection_type, connection_source,username,password,args,pooled=False):
+        """
+        Establishes a connection to a data source and removes the alias.
+
+        :param connection_alias: the plain english name to associate with this connection
+        :param connection_type: the type of connection to use
+        :param connection_source: the name of an an ODBC DSN or connection string
+        :param username: the username to use for a connection (optional)
+        :param password: connection_source: the password to use for a connection (optional)
+        :param pooled: check the connection out of the pool instead of opening a new one (naked queries)
+        :returns: formatted string
+
+        """
+
+        logging.debug(" -- Working with connection '%s' of type '%s'", connection_alias, connection_type)
+
+        if self.is_registered(connection_alias):
+            raise Exception(stack()[0][3], \
+                " --- There is already a connection with the alias %s" % connection_alias)
+
+        driver = get_driver(connection_type)
+        pool_key = None
+        new_cnxn = None
+
+        try:
+
+            logging.debug(" ---- Attempting to connect to '%s' ", connection_alias)
+
+            if pooled:
+                pool_key = self._pool.make_key(connection_source, username, connection_type, password)
+                new_cnxn = self._pool.checkout(pool_key, \
+                        lambda: self.open_connection(connection_type, connection_source, username, password))
+            else:
+                new_cnxn = self.open_connection(connection_type, connection_source, username, password)
+
+            new_cursor = driver.cursor(new_cnxn)
+            opener = lambda: self.open_connection(connection_type, connection_source, username, password)
+
+            # store the results and make this the active connection (unless it is pooled)
+            self._registry.register(ConnectionEntry(connection_alias, connection_type, connection_source, \
+                    new_cnxn, new_cursor, pool_key, driver, opener=opener, username=username))
+
+        except driver.errors, err:
+            logging.error("The connection is '%s' the available connections are ", connection_alias)
+            logging.error(self._registry)
+            logging.error(err)
+            if new_cnxn is not None and pool_key is not None and connection_alias not in self._registry:
+                self._pool.checkin(pool_key, new_cnxn, discard=True)
+            raise err
+
+        logging.debug(" --- Connected data source '%s' as type '%s'", connection_alias, connection_type)
+
+    def disconnect_from_source(self, connection_alias, connection_type, discard=False):
+        """
+        Disconnects a particular connection to a data source and removes the alias.
+
+        Pooled connections are given back to the pool instead of being closed.
+
+        :param connection_alias: the plain english name to associate with this connection
+        :param connection_type: the type of connection to use
+        :param discard: close a pooled connection instead of giving it back (after an error)
+
+        """
+
+        logging.debug(" -- Working with connection '%s' of type '%s'", connection_alias, connection_type)
+        logging.debug(" --- Attempting to disconnect from %s ", connection_alias)
+
+        # remove the entry from the registry first, so that closing an open stream
+        # doesn't try to disconnect the same alias again.  If this was the default
+        # alias, the registry makes the most recently used connection the default.
+        entry = self._registry.pop(connection_alias)
+
+        if entry is None:
+            raise Exception(stack()[0][3], "There is no connection with the alias %s" % connection_alias)
+
+        # disconnect everything
+        entry.close(self._pool, discard=discard)
+
+        logging.debug(" --- Disconnected data source '%s', the default is now '%s'", \
+                connection_alias, self._registry.default_alias)
+
+    def execute_command(self, connection_alias, connection_type, command, fetch, timeout=None, params=None):
+        """
+        Execute a command on a remote data source
+
+        NOTE: this will not return a value, just execute the command.  Use fetch() 
+
+        :param connection_alias: the plain english name to associate with this connection
+        :param connection_type: the type of connection to use
+        :param command:  the command to execute at the connection
+        :param timeout: cancel the command if it runs for more than this many seconds (optional)
+        :param params: the values for the parameter markers in the command, which keeps it prepared (optional)
+
+        """
+
+        logging.debug(" -- Working with connection '%s' of type '%s'", connection_alias, connection_type)
+
+        if self.is_registered(connection_alias):
+
+            logging.debug(" --- Executing '%s' on '%s'", command, connection_alias)
+
+            if not self.is_connected(connection_alias):
+                raise Exception(stack()[0][3], "There is no connection with the alias %s" % connection_alias)
+
+            if len(command) > 0:
+
+                entry = self._registry[connection_alias]
+
+                try:
+                    entry.execute(command, params, timeout)
+                except entry.driver.errors, err:
+                    logging.error(err)
+                    raise err
+            else:
+                    logging.debug(" --- Skipping empty command.")
+        else:
+            raise Exception(stack()[0][3], "The connection '%s' is not registered" % connection_alias)
+
+
+    def fetch(self, connection_alias, connection_type, fetch, stream=None, columnar=None, dataframe=None, downcast=False, categorize=None, persist=None, arraysize=None, adaptive=False, progress=None, arrow=None, timeout=None):
+        """
+        Fetch the results from a previous command.  This is always used in conjunction
+        with the execute_command() function, either implicitly or explicitly.
+
+        :param connection_alias: the plain english name to associate with this connection
+        :param connection_type: the type of connection to use
+        :param fetch: how many records to fetch, either a positive integer or 'all'
+        :param stream: return a RowStream that fetches this many records at a time (optional)
+        :param columnar: return a ColumnarResult, fetching this many records at a time (optional)
+        :param dataframe: return a pandas DataFrame, fetching this many records at a time (optional)
+        :param downcast: store DataFrame integer columns in the smallest type that fits
+        :param categorize: the ratio of distinct values under which DataFrame strings are categorical (optional)
+        :param persist: write the records to disk under this name as they are fetched, then map them back (optional)
+        :param arraysize: how many records to fetch with each round trip, instead of the sizes above (optional)
+        :param adaptive: change the number of records per round trip based on the measured throughput
+        :param progress: a function called with the number of records fetched so far (optional)
+        :param arrow: return a pyarrow Table (or an ArrowStream), fetching this many records at a time (optional)
+        :param timeout: cancel the fetch if it runs for more than this many seconds (optional)
+
+        """
+
+        logging.debug(" -- Working with connection '%s' of type '%s'", connection_alias, connection_type)
+
+        logging.debug(" --- Fetching '%s' records from '%s'", fetch, connection_alias)
+
+        if arrow is not None and pyarrow is None:
+            raise Exception(stack()[0][3], "Arrow results need pyarrow, which is not installed.")
+
+        if not self.is_connected(connection_alias):
+            logging.debug(" ---- The alias '%s' is not connected", connection_alias)
+            return
+
+        entry = self._registry[connection_alias]
+        driver = entry.driver
+
+        try:
+
+            cursor = entry.cursor
+            sizer = AdaptiveBatchSizer(arraysize or stream or arrow or columnar or dataframe or DEFAULT_STREAM_BATCH, \
+                    adaptive=adaptive)
+
+            # the cursor is in flight until the results are fetched (or handed to a stream)
+            with Watchdog(entry, timeout), entry.use(cursor):
+                if fetch is not None and not isinstance(fetch, basestring) and long(fetch) < 0:
+                    logging.debug(" ---- '%s' is an invalid number of rows to fetch", fetch)
+                elif stream is not None:
+                    logging.debug(" ---- Streaming in batches of %s", sizer.size())
+                    return self.open_stream(connection_alias, stream, sizer, arrow=arrow is not None)
+                elif persist is not None:
+                    # the batches go straight to disk, so the result never has to fit in memory
+                    self.persist(entry, persist, sizer, self.fetch_limit(fetch), progress)
+                    return self._result_store.load(persist, dataframe=dataframe is not None, \
+                            downcast=downcast, categorize=categorize)
+                elif arrow is not None:
+                    # drivers that can build Arrow data skip the rows entirely
+                    logging.debug(" ---- Building an Arrow table in batches of %s", sizer.size())
+                    table = driver.fetch_arrow(cursor, sizer, self.fetch_limit(fetch))
+                    return table.to_pandas() if dataframe is not None else table
+                elif columnar is not None:
+                    logging.debug(" ---- Building columns in batches of %s", sizer.size())
+                    return ColumnarResult.from_cursor(cursor, max_rows=self.fetch_limit(fetch), \
+                            progress=progress, sizer=sizer, batches=driver.fetch_batches)
+                elif dataframe is not None:
+                    # build the columns straight from the batches, there is never a list of rows
+                    logging.debug(" ---- Building a DataFrame in batches of %s", sizer.size())
+                    columns = ColumnarResult.from_cursor(cursor, max_rows=self.fetch_limit(fetch), \
+                            progress=progress, sizer=sizer, batches=driver.fetch_batches)
+                    return columns.to_pandas(downcast=downcast, categorize=categorize)
+                else:
+                    # every fetch goes through the batched loop, so the round trips can be tuned
+                    logging.debug(" ---- Fetching up to %s records in batches of %s", self.fetch_limit(fetch), sizer.size())
+                    results = []
+                    for batch in driver.fetch_batches(cursor, sizer, self.fetch_limit(fetch)):
+                        results.extend(batch)
+                        if progress is not None:
+                            progress(len(results))
+                    logging.debug(" ---- Fetched %s", sizer)
+                    return results
+
+        except driver.no_results_errors, err:
+            logging.warning(err)
+            pass
+        except driver.errors, err:
+            logging.error(err)
+            raise err
+
+    def persist(self, entry, name, sizer, max_rows=None, progress=None):
+        """
+        Writes a pending result set to the result store batch by batch.
+
+        :param entry: the ConnectionEntry with a pending result set
+        :param name: the name to persist the result as
+        :param sizer: the AdaptiveBatchSizer that picks the size of each round trip
+        :param max_rows: stop after this many records (optional)
+        :param progress: a function called with the number of records fetched so far (optional)
+        :returns: the number of records written
+
+        """
+
+        if entry.cursor.description is None:
+            raise Exception(stack()[0][3], "There is no result set to persist.")
+
+        writer = self._result_store.writer(name, entry.cursor.description)
+
+        try:
+            for batch in entry.driver.fetch_batches(entry.cursor, sizer, max_rows):
+                writer.write(batch)
+
+                if progress is not None:
+                    progress(writer.rows)
+        except:
+            writer.abort()
+            raise
+
+        path = writer.close()
+        logging.debug(" ---- Persisted %s records as '%s' in %s", writer.rows, name, path)
+
+        return writer.rows
+
+    def dialect(self, connection_alias):
+        """
+        Works out the SQL dialect of a connection from its driver, and remembers it.
+
+        For ODBC the driver comes from the source catalog for a DSN, or from the DRIVER= part
+        of a connection string, and only if neither is known is the connection itself asked.
+
+        :param connection_alias: the plain english name to associate with this connection
+        :returns: the name of the dialect, see detect_dialect()
+
+        """
+
+        entry = self._registry[connection_alias]
+
+        if entry.dialect is not None:
+            return entry.dialect
+
+        source = entry.source or ''
+        driver = None
+
+        if entry.driver.name == 'odbc':
+            if source in self._source_catalog:
+                driver = self._source_catalog.driver(source)
+            else:
+                match = re.search(r'DRIVER=\{?([^};]*)', source, re.IGNORECASE)
+                if match is not None:
+                    driver = match.group(1)
+
+        if detect_dialect(driver) == 'ansi':
+            try:
+                driver = entry.driver.driver_name(entry.connection)
+            except entry.driver.errors, err:
+                logging.warning(err)
+
+        entry.dialect = detect_dialect(driver)
+        logging.debug(" --- Using the %s dialect for '%s' (driver %s)", entry.dialect, connection_alias, driver)
+
+        return entry.dialect
+
+    def fetch_limit(self, fetch):
+        """
+        :param fetch: how many records to fetch, either a positive integer or 'all'
+        :returns: the number of records to stop after, or None for all of them
+        """
+
+        if fetch is None or ((isinstance(fetch, str) or isinstance(fetch, unicode)) and 'all' in fetch):
+            return None
+        elif long(fetch) > 0:
+            return long(fetch)
+        else:
+            return None
+
+    def open_stream(self, connection_alias, batch_size, sizer=None, arrow=False):
+        """
+        Ties a RowStream to the cursor of an alias until it is exhausted or closed.
+
+        :param connection_alias: the plain english name to associate with this connection
+        :param batch_size: how many records to fetch with each round trip
+        :param sizer: an AdaptiveBatchSizer that picks the size of each round trip instead (optional)
+        :param arrow: stream Arrow record batches instead of rows
+        :returns: a RowStream (or an ArrowStream)
+
+        """
+
+        return self._registry[connection_alias].open_stream(batch_size, sizer, arrow)
+
+    def commit(self, connection_alias, connection_type):
+        """
+        commit the results from a previous command.  This is always used in conjunction
+        with the execute_command() function, either implicitly or explicitly.
+
+        :param connection_alias: the plain english name to associate with this connection
+        :param connection_type: the type of connection to use
+
+        """
+
+        logging.debug(" -- Working with connection '%s' of type '%s'", connection_alias, connection_type)
+        logging.debug(" --- commiting cursor '%s'", connection_alias)
+
+        if not self.is_connected(connection_alias):
+            logging.debug(" ---- The alias '%s' is not connected", connection_alias)
+            return
+
+        entry = self._registry[connection_alias]
+
+        try:
+            entry.driver.commit(entry.connection)
+        except entry.driver.errors, err:
+            logging.error(err)
+            raise err
+
+    def rollback(self, connection_alias, connection_type):
+        """
+        roll back the changes from previous commands that haven't been committed.
+
+        :param connection_alias: the plain english name to associate with this connection
+        :param connection_type: the type of connection to use
+
+        """
+
+        logging.debug(" -- Working with connection '%s' of type '%s'", connection_alias, connection_type)
+        logging.debug(" --- rolling back '%s'", connection_alias)
+
+        if not self.is_connected(connection_alias):
+            logging.debug(" ---- The alias '%s' is not connected", connection_alias)
+            return
+
+        entry = self._registry[connection_alias]
+
+        try:
+            entry.driver.rollback(entry.connection)
+        except entry.driver.errors, err:
+            logging.error(err)
+            raise err
+
+    def list_values(self, connection_alias, connection_type,list_value, pattern=None, refresh=False):
+        """
+        commit the results from a previous command.  This is always used in conjunction
+        with the execute_command() function, either implicitly or explicitly.
+
+        Tables, procedures and columns come from the catalog cache, see CatalogCache.
+
+        :param connection_alias: the plain english name to associate with this connection
+        :param connection_type: the type of connection to use
+        :param list_value: the thing inside the database to list
+        :param pattern: only list the objects whose [[catalog.]schema.]name matches this (optional)
+        :param refresh: list the objects from the database even if they are cached
+
+        """
+
+        logging.debug(" -- Working with connection '%s' of type '%s'", connection_alias, connection_type)
+
+        if list_value == 'sources':
+            logging.debug(" --- Listing sources")
+            results = self._source_catalog.names()
+            logging.debug(" --- Listing %s", ResultSummary(results))
+            return results
+
+        if not self.is_connected(connection_alias):
+            logging.debug(" --- The alias '%s' is not connected", connection_alias)
+            return
+
+        entry = self._registry[connection_alias]
+
+        listing = catalog_loader(entry, list_value)
+
+        try:
+            logging.debug(" --- Listing %s in '%s'", list_value, connection_alias)
+
+            if list_value in CATALOG_KINDS:
+                results = self._catalog_cache.get(self.catalog_source(connection_alias), list_value, listing, \
+                        pattern=pattern, refresh=refresh)
+            else:
+                results = listing()[1]
+
+            logging.debug(" --- Listing %s", ResultSummary(results))
+            return results
 
-        ##############################################################################
-        # make it so that if there is a command it will be executed, regardless of interpretation.
-        ##############################################################################
-        if len(connection_cmd) > 1:
-            logging.debug(" --- Command is %s, setting execute to True" % connection_cmd)
-            self._args.execute = True
+        except entry.driver.errors, err:
+            logging.error(err)
+            raise err
 
+    def catalog_source(self, connection_alias):
+        """
+        :param connection_alias: the plain english name to associate with this connection
+        :returns: the name the catalog of the connection is cached under, see catalog_key()
+        """
 
-        ##############################################################################
-        # set up logging for this particular run
-        ##############################################################################
-        if self._args.debug is None or \
-                self._args.debug.lower() == 'debug' or \
-                self._args.verbose:
-            logging.getLogger().setLevel(logging.DEBUG)
-        elif self._args.debug.lower() == 'warning':
-            logging.getLogger().setLevel(logging.WARNING)
-        elif self._args.debug.lower() == 'info':
-            logging.getLogger().setLevel(logging.INFO)
-        elif self._args.debug.lower() == 'error':
-            logging.getLogger().setLevel(logging.ERROR)
-        elif self._args.debug.lower() == 'critical':
-            logging.getLogger().setLevel(logging.CRITICAL)
+        return catalog_key(self._registry[connection_alias])
+
+    @line_magic('db')
+    def lmagic(self, line, cell=None):
+        """
+        A magic to allow access to data stores using native syntax (such as SQL).
+
+            ARGUMENT  OPTIONS
+            --------  --------------------------------------------------------------------------
+            'source', type=str, help='The identifier of the data source (optional)',default='', nargs='?'
+            'cmd', type=str, help='A command to be executed (optional)',default='', nargs='*'
+            '-src', '--source', help='The data source to use (optional).', action="store"
+            '-a', '--alias', help='The key to refer to this connection with', action="store"
+            '-def', '--default', help='The key to refer to this connection with', action="store"
+            '-c', '--connect', '--conn', help='Connect to this database', action="store_true"
+            '-d', '--disconnect', '--dis', help='Disconnect from this datbase', action="store_true"
+            '-t', '--type', help='Connection type (ODBC is the default)', action="store", default="odbc"
+            '-l', '--list', help='List things about the database.', action="store", nargs='?'
+            '-e', '--execute', '--exec', help='Some SQL to execute', action="store_true"
+            '-m', '--commit', help='Commit this transaction.', action="store_true"
+            '-r', '--rollback', help='Rollback this transaction.', action="store_true"
+            '-n', '--naked', help='Run a naked query (same as --connect --execute --fetch --disconnect)', action="store_true"
+            '--unsourced', help='Run an unsourced query (same as --connect --execute --fetch --disconnect)', action="store_true"
+            '-f', '--fetch', help='Fetch one or more records (default is all)', action="store", default=0,nargs='?'
+            '--stream', help='Return a lazy iterator that fetches N records at a time (default is 1000)', action="store", type=int, const=1000, nargs='?'
+            '--columnar', help='Return typed column arrays, fetching N records at a time (default is 1000)', action="store", type=int, const=1000, nargs='?'
+            '--df', help='Return a pandas DataFrame, fetching N records at a time (default is 1000)', action="store", type=int, const=1000, nargs='?'
+            '--arrow', help='Return a pyarrow Table (or record batches with --stream), fetching N records at a time (default is 1000)', action="store", type=int, const=1000, nargs='?'
+            '--downcast', help='Store DataFrame integer columns in the smallest type that fits', action="store_true"
+            '--categorize', help='Make DataFrame string columns with at most this ratio of distinct values categorical (default is 0.5)', action="store", type=float, const=0.5, nargs='?'
+            '-u', '--uid', '--username', help='The user name to use (optional).', action="store", default=''
+            '-p', '--pwd', '--password', help='The password to use (optional).', action="store", default=''
+            '-h', '--help', help='Display help.', action="store_true"
+            '-v', '--verbose', help='Display debugging verbosely (same as --debug=DEBUG', action="store_true"
+            '--debug', help='Output debugging info', action="store", default='WARNING',nargs='?'
+            '-y', '--dry_run', '--dry', help='Make this a dry run', action="store_true"
+            '--explain', help='Give an explanation on exac', action="store_true"
+            '--note', help='Add a note for help with debugging', action="store", nargs="*"
+            '--cleanup', help='Clean up all the connections and shut down', action="store_true"
+            '--refresh', help='Refresh cached values (like sources) before using them', action="store_true"
+            '--async', dest='async_query', help='Run the command in the background and return a handle', action="store_true"
+            '--wait', help='Wait for the async query with this id and return its results', action="store", type=int
+            '--status', help='Show the progress of the async queries', action="store_true"
+            '--aliases', help='Run the command on each of these comma-separated aliases', action="store"
+            '--all-aliases', dest='all_aliases', help='Run the command on every registered alias', action="store_true"
+            '--workers', help='How many aliases to run at once with --aliases (default is 8)', action="store", type=int, default=8
+            '--continue', dest='continue_on_error', help='Keep running the statements of a cell after one fails', action="store_true"
+            '--insert', help='Insert the records from --from into this table', action="store"
+            '--from', dest='from_var', help='The variable (a DataFrame or a list of rows) to insert from', action="store"
+            '--batch-size', dest='batch_size', help='How many records to send with each --insert round trip (default is 10000)', action="store", type=int, default=10000
+            '--stats', help='Show the timings of recent calls, with percentiles per alias', action="store_true"
+            '--cache', help='Cache the results for N seconds, or use the cached results (default is 300)', action="store", type=float, const=300, nargs='?'
+            '--no-cache', dest='no_cache', help='Run the command even if its results are cached (with --cache, replace them)', action="store_true"
+            '--cache-clear', dest='cache_clear', help='Forget all of the cached results', action="store_true"
+            '--persist', help='Write the results to disk under this name as they are fetched', action="store"
+            '--load', help='Load the results persisted under this name, without running anything', action="store"
+            '--preview', help='Have the database return only the first N records of the query', action="store", type=int
+            '--sample', help='Have the database return a random N percent of the records of the query', action="store", type=float
+            '--arraysize', help='How many records to fetch with each round trip (default is 1000)', action="store", type=int
+            '--adaptive', help='Grow or shrink the records per round trip based on the measured throughput', action="store_true"
+            '--timeout', help='Cancel the command if it runs for more than this many seconds', action="store", type=float
+            '--cancel', help='Cancel whatever is running on this alias and clean up its connection', action="store"
+            '--like', help='With --list, only list the objects whose [[catalog.]schema.]name matches this pattern', action="store"
+            '--catalog-file', dest='catalog_file', help='Keep the catalog cache in this SQLite file (default is ~/.db_magic/catalog.sqlite)', action="store", const=DEFAULT_CATALOG_FILE, nargs='?'
+        """
+        results = None
+
+        logging.info(' - Starting parsing process')
+        alias, key, cmd, fetch, args = self.parse_args(line, cell)
+
+        if args.explain or args.dry_run:
+            self.explain(alias, key, cmd, fetch, args,line)
+
+            if args.dry_run:
+                return
+
+        if args.catalog_file is not None:
+            self._catalog_cache.attach(args.catalog_file)
+
+        if args.status:
+            return self.async_status()
+
+        if args.stats:
+            summary = self._stats.summary()
+            summary['cache'] = self._result_cache.stats()
+            summary['connections'] = self._registry.stats()
+            summary['catalog'] = self._catalog_cache.stats()
+            return summary
+
+        if args.cache_clear:
+            logging.info(' - Clearing the result cache')
+            self._result_cache.clear()
+            return
+
+        if args.load is not None:
+            logging.info(' - Loading the persisted results %s', args.load)
+            return self._result_store.load(args.load, dataframe=args.df is not None, \
+                    downcast=args.downcast, categorize=args.categorize)
+
+        if args.wait is not None:
+            return self.wait_for(args.wait)
+
+        if args.cancel is not None:
+            logging.info(' - Cancelling whatever is running on %s', args.cancel)
+            return self.cancel(args.cancel)
+
+        if args.aliases is not None or args.all_aliases:
+            if args.all_aliases:
+                aliases = self._registry.aliases(pooled=False)
+            else:
+                aliases = [name.strip() for name in args.aliases.split(',') if len(name.strip()) > 0]
+
+            logging.info(' - Starting fan out process on %s aliases', len(aliases))
+            return self.fan_out(aliases, cmd, fetch, args.workers)
+
+        if args.insert is not None:
+            if args.from_var is None or args.from_var not in self.shell.user_ns:
+                raise Exception(stack()[0][3], "--insert needs --from with the name of a variable to insert")
+
+            if self.is_busy(alias):
+                raise Exception(stack()[0][3], \
+                        "The alias '%s' is running an async query, use --wait to get its results first" % alias)
+
+            logging.info(' - Starting insert process')
+            return self.load(alias, args.insert, self.shell.user_ns[args.from_var], batch_size=args.batch_size, \
+                    timeout=args.timeout)
+
+        cache_key = self.cache_key(alias, key, cmd, fetch, args)
+
+        if cache_key is not None and not args.no_cache:
+            cached = self._result_cache.get(cache_key)
+            if cached is not None:
+                logging.info(' - Returning cached results')
+                return cached
+
+        if args.stream is not None and args.persist is not None:
+            raise Exception(stack()[0][3], "A stream can't be persisted, use --persist without --stream.")
+
+        if args.async_query:
+            if args.stream is not None:
+                raise Exception(stack()[0][3], "A stream can't be returned from an async query.")
+
+            logging.info(' - Starting async process')
+            results = self.submit_async(alias, cmd, \
+                    lambda query: self.cache_results(cache_key, args.cache, \
+                        self.run_steps(alias, key, cmd, fetch, args, query)))
         else:
-            logging.getLogger().setLevel(logging.INFO)
-            logging.debug(" --- The debug level '%s' is not valid, using INFO." % self._args.debug)
+            if self.is_busy(alias):
+                raise Exception(stack()[0][3], \
+                        "The alias '%s' is running an async query, use --wait to get its results first" % alias)
 
-        return connection_alias, connection_key, connection_cmd, connection_fetch, self._args
+            results = self.cache_results(cache_key, args.cache, self.run_steps(alias, key, cmd, fetch, args))
 
-    def explain(self, alias, key, cmd, fetch, args, line):
+        if (not args.naked or args.unsourced) and alias in self._registry:
+            self._registry.most_recent_alias = alias
+
+        if  args.cleanup:
+            self.cleanup()
+
+        if results is not None:
+            logging.debug(' - Returning resultset')
+            return results
+        else:
+            logging.debug(' - Returning nothing')
+            return
+
+        return line
+
+    def cache_key(self, alias, key, cmd, fetch, args):
         """
-        Explains the operations that are going to be done as part of the command line invocation
+        Builds the result cache key for a parsed call.
 
         :param alias: the plain english name to associate with this connection
-        :param type: the type of connection to use
         :param key: the key that will be used to find the correct connection.
-        :param cmd: the command that will be executed 
+        :param cmd: the command that will be executed
         :param fetch: the argument for fetching data or not
         :param args: all the arguments passed to the class
-        :param line: the command line used to call the class
+        :returns: the key, or None if this call shouldn't be cached
 
         """
 
-        print("Command Line called : %%db %s" % line)
-        print("-------------------")
-        print("Args Parsed: %s" % args)
-        print("-------------------")
-        print("Data Source to Use: %s" % args.source)
-        print("Data Source Type: %s" % args.type)
-        print("Data Source Alias: %s" % alias)
-        print("Command to Execute: %s" % cmd)
-        print("Execution Notes: %s" % str(args.note))
-        print("-------------------")
-        print("Open Connections: %s" % self._conn_info)
-        print("-------------------")
-        print("Is this a Naked Query?: %s" % args.naked)
-        print("Is this a Unsourced Query?: %s" % args.unsourced)
-        print("-------------------")
-        print("Are we Connecting to DB?: %s" % (args.connect or args.naked))
-        print("Are we Commiting Transaction?: %s" % (args.commit))
-        print("Are we Fetching records?: %s" % fetch)
-        print("Are we Listing values?: %s" % args.list)
-        print("Are we Disconnecting from DB?: %s" % (args.disconnect or args.naked))
-        print("=========================================================")
+        if args.cache is None or len(cmd) == 0 or args.stream is not None or args.list is not None or \
+                args.persist is not None:
+            return None
 
-        return
+        if self.is_registered(alias):
+            source = self._registry[alias].source
+        else:
+            source = key
+
+        # the same command gives different objects depending on how it was fetched
+        shape = (str(fetch), args.columnar, args.df, args.arrow, args.downcast, args.categorize, args.preview, args.sample)
+
+        return (alias, source, normalize_command(cmd), shape)
+
+    def cache_results(self, cache_key, ttl, results):
+        """
+        :param cache_key: the key from cache_key(), or None to skip caching
+        :param ttl: how many seconds the results stay valid
+        :param results: the results to cache
+        :returns: the results
+
+        """
+
+        if cache_key is not None and results is not None:
+            logging.debug(" --- Caching results for %s seconds", ttl)
+            self._result_cache.put(cache_key, results, ttl)
+
+        return results
+
+    def run_steps(self, alias, key, cmd, fetch, args, query=None):
+        """
+        Runs the connect, execute, list, fetch, commit and disconnect steps of a parsed call.
+
+        :param alias: the plain english name to associate with this connection
+        :param key: the key that will be used to find the correct connection.
+        :param cmd: the command that will be executed
+        :param fetch: the argument for fetching data or not
+        :param args: all the arguments passed to the class
+        :param query: the AsyncQuery handle when this runs on a worker thread (optional)
+        :returns: the results of the list or fetch step, if any
+
+        """
+
+        timing = QueryTiming(alias, cmd)
+
+        try:
+            results = self.timed_steps(alias, key, cmd, fetch, args, query, timing)
+        except Exception, err:
+            timing.error = err
+            raise
+        finally:
+            self._stats.add(timing)
+            self.record_metrics(alias, timing)
+
+        return results
+
+    def record_metrics(self, alias, timing):
+        """
+        :param alias: the alias the call ran on
+        :param timing: the QueryTiming of the call
+        """
+
+        # a naked query has already given its connection back, so there is nothing to add to
+        entry = self._registry.get(alias)
+
+        if entry is not None:
+            entry.record(timing)
+
+    def timed_steps(self, alias, key, cmd, fetch, args, query, timing):
+        """
+        The steps of run_steps(), recording how long each phase takes.
+
+        :param alias: the plain english name to associate with this connection
+        :param key: the key that will be used to find the correct connection.
+        :param cmd: the command that will be executed
+        :param fetch: the argument for fetching data or not
+        :param args: all the arguments passed to the class
+        :param query: the AsyncQuery handle when this runs on a worker thread (or None)
+        :param timing: the QueryTiming to record the phases in
+        :returns: the results of the list or fetch step, if any
+
+        """
+
+        ##############################################################################
+        # The order of these commands are VERY important, as when a command is run
+        # "naked" or "unsourced" it will scroll through these in order.  It is
+        # critically imporant that you keep them in a logical order for database connections.
+        ##############################################################################
+
+        if args.connect or args.naked:
+            logging.info(' - Starting connection process')
+            started = time.time()
+            self.connect_to_source(alias,args.type, key, args.uid, args.pwd,args,pooled=args.naked)
+            timing.record('connect', started)
+
+        if query is not None and self.is_connected(alias):
+            query.watch(self._registry[alias].cancel)
+
+        results = None
+
+        # the timeout covers the execute and fetch steps together
+        deadline = time.time() + args.timeout if args.timeout else None
+
+        try:
+
+            if (args.execute or \
+                    args.naked or \
+                    args.unsourced) and \
+                    (len(cmd) > 0):
+
+                if args.preview is not None or args.sample is not None:
+                    limited = limit_command(cmd, self.dialect(alias), args.preview, args.sample)
+
+                    # a query the database can't wrap runs as it is, and only the preview is fetched
+                    if limited is None:
+                        logging.info(' - Previewing %s rows on the client', args.preview)
+                        fetch = args.preview
+                    else:
+                        cmd = limited
+
+                logging.info(' - Starting execution process with "%s"', cmd)
+                started = time.time()
+                self.execute_command(alias, args.type, cmd, fetch, timeout=args.timeout)
+                timing.record('execute', started)
+
+            if args.list is not None:
+                logging.info(' - Starting list process')
+                results = self.list_values(alias, args.type, args.list, pattern=args.like, refresh=args.refresh)
+
+            if args.fetch == 'all' or args.fetch > 0 or args.naked or args.unsourced or \
+                    args.stream is not None or args.columnar is not None or args.df is not None or \
+                    args.arrow is not None or args.persist is not None or args.preview is not None or args.sample is not None:
+
+                logging.info('Starting fetch process')
+                started = time.time()
+                results = self.fetch(alias, args.type, fetch, \
+                        stream=args.stream, \
+                        columnar=args.columnar, \
+                        dataframe=args.df, \
+                        downcast=args.downcast, \
+                        categorize=args.categorize, \
+                        persist=args.persist, \
+                        arraysize=args.arraysize, \
+                        adaptive=args.adaptive, \
+                        progress=query.update if query is not None else None, \
+                        arrow=args.arrow, \
+                        timeout=max(deadline - time.time(), 0.001) if deadline else None)
+                timing.record('fetch', started)
+                timing.measure(results)
+                logging.info(' - Fetched %s', ResultSummary(results))
+
+            # a naked stream keeps its pooled connection until it is exhausted or closed, under
+            # an alias of its own so the source can be used for the next naked query meanwhile
+            streaming = args.naked and isinstance(results, RowStream)
+
+            if streaming:
+                stream_alias = self._registry.rename(alias, "%s (stream %s)" % (alias, next(self._stream_ids)))
+                logging.debug(" --- Keeping the pooled connection of the stream as '%s'", stream_alias)
+                results.on_close(lambda closed_stream: self.finish_naked_stream(stream_alias, args.type, closed_stream))
+
+            if args.rollback and not streaming:
+                logging.info(' - Starting rollback process')
+                started = time.time()
+                self.rollback(alias, args.type)
+                timing.record('rollback', started)
+            elif (args.commit or args.naked) and not streaming:
+                logging.info(' - Starting commit process')
+                started = time.time()
+                self.commit(alias, args.type)
+                timing.record('commit', started)
+
+        except:
+            # a naked query owns its pooled connection, so don't hand a broken one back
+            if args.naked and self.is_registered(alias):
+                logging.info(' - Discarding the pooled connection after an error')
+                self.disconnect_from_source(alias, args.type, discard=True)
+            raise
+
+        if (args.disconnect or args.naked) and not streaming:
+            logging.info(' - Starting disconnect process')
+            started = time.time()
+            self.disconnect_from_source(alias, args.type)
+            timing.record('disconnect', started)
+
+        return results
+
+    def submit_async(self, alias, cmd, job):
+        """
+        Queues a job on the worker thread of an alias.
+
+        :param alias: the plain english name to associate with this connection
+        :param cmd: the command that will be executed
+        :param job: a function that takes the AsyncQuery handle and returns the results
+        :returns: an AsyncQuery handle
+
+        """
+
+        query = AsyncQuery(next(self._async_ids), alias, cmd)
+
+        with self._conn_lock:
+            worker = self._workers.get(alias)
+            if worker is None or not worker.is_alive():
+                logging.debug(" --- Starting a worker thread for '%s'", alias)
+                worker = AliasWorker(alias)
+                worker.start()
+                self._workers[alias] = worker
+
+            self._async_queries[query.id] = query
+
+        worker.submit(query, job)
+
+        return query
+
+    def load(self, connection_alias, table, data, columns=None, batch_size=DEFAULT_INSERT_BATCH, fast=True, commit=True, timeout=None):
+        """
+        Inserts Python data into a table with bound parameters and cursor.executemany().
+
+        From Python, use the registered magics:
+
+            get_ipython().magics_manager.registry['DbMagic'].load('my_alias', 'my_table', df)
+
+        :param connection_alias: the plain english name to associate with this connection
+        :param table: the table to insert into
+        :param data: a pandas DataFrame, or a list of tuples or dictionaries
+        :param columns: the column names to insert into (optional, taken from the data if possible)
+        :param batch_size: how many records to send with each executemany()
+        :param fast: use pyodbc's fast_executemany, which sends each batch as one round trip
+        :param commit: commit once all the records are inserted
+        :param timeout: cancel the insert if it runs for more than this many seconds (optional)
+        :returns: the number of records inserted
+
+        """
+
+        if not self.is_connected(connection_alias):
+            raise Exception(stack()[0][3], "There is no connection with the alias %s" % connection_alias)
+
+        if batch_size <= 0:
+            raise Exception(stack()[0][3], "'%s' is an invalid batch size" % batch_size)
+
+        entry = self._registry[connection_alias]
+        timing = QueryTiming(connection_alias, "INSERT INTO %s" % table)
+
+        inserted = 0
+        command = None
+
+        # the timeout covers all of the batches together
+        deadline = time.time() + timeout if timeout else None
+
+        try:
+            try:
+                started = time.time()
+
+                for batch_columns, batch in self.insert_batches(data, columns, batch_size):
+
+                    if command is None:
+                        markers = entry.driver.markers(len(batch[0]))
+                        if batch_columns:
+                            command = "INSERT INTO %s (%s) VALUES (%s)" % (table, ', '.join(batch_columns), markers)
+                        else:
+                            command = "INSERT INTO %s VALUES (%s)" % (table, markers)
+                        logging.debug(" --- Inserting with '%s'", command)
+                        timing.command = command
+
+                    entry.execute_many(command, batch, fast, \
+                            timeout=max(deadline - time.time(), 0.001) if deadline else None)
+                    inserted += len(batch)
+                    timing.rows = inserted
+                    logging.debug(" ---- Inserted %s records into '%s'", inserted, table)
+
+                timing.record('execute', started)
+
+            except entry.driver.errors, err:
+                logging.error(err)
+                raise err
+
+            if commit and inserted > 0:
+                started = time.time()
+                self.commit(connection_alias, entry.type)
+                timing.record('commit', started)
+
+        except Exception, err:
+            timing.error = err
+            raise
+        finally:
+            self._stats.add(timing)
+            entry.record(timing)
+
+        return inserted
+
+    def insert_batches(self, data, columns, batch_size):
+        """
+        Slices data for load() into batches of plain Python rows.
+
+        :param data: a pandas DataFrame, or a list of tuples or dictionaries
+        :param columns: the column names to insert into (optional)
+        :param batch_size: how many records go in each batch
+        :returns: an iterator of (columns, list of row tuples)
+
+        """
+
+        if hasattr(data, 'iloc') and hasattr(data, 'columns'):
+            # a DataFrame, convert one slice at a time so NumPy values become plain Python values
+            import pandas
+            columns = columns or [str(name) for name in data.columns]
+            for start in range(0, len(data), batch_size):
+                chunk = data.iloc[start:start + batch_size].astype(object)
+                chunk = chunk.where(pandas.notnull(chunk), None)
+                yield columns, [tuple(row) for row in chunk.values.tolist()]
+            return
+
+        batch = []
+
+        for row in data:
+            if isinstance(row, dict):
+                if columns is None:
+                    columns = sorted(row.keys())
+                row = tuple([row.get(name) for name in columns])
+            else:
+                row = tuple(row)
+
+            batch.append(row)
+
+            if len(batch) >= batch_size:
+                yield columns, batch
+                batch = []
+
+        if batch:
+            yield columns, batch
+
+    def fan_out(self, aliases, command, fetch='all', workers=DEFAULT_FAN_OUT_WORKERS):
+        """
+        Runs one command on several aliases at once, on a bounded number of threads.
+
+        :param aliases: the aliases to run the command on
+        :param command: the command to execute on each alias
+        :param fetch: how many records to fetch from each alias, either a positive integer or 'all'
+        :param workers: the most aliases to run at the same time
+        :returns: a FanOutResult
+
+        """
+
+        # an alias given twice would have two threads sharing its connection
+        aliases = list(OrderedDict.fromkeys(aliases))
+
+        pending = Queue.Queue()
+        outcomes = {}
+
+        for alias in aliases:
+            pending.put(alias)
+
+        def work():
+            while True:
+                try:
+                    alias = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                outcomes[alias] = self.fan_out_one(alias, command, fetch)
+
+        threads = [threading.Thread(target=work, name="db_magic-fan-out-%s" % i) \
+                for i in range(min(max(workers, 1), len(aliases)))]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # put everything back together in the order the aliases were given
+        columns = None
+        rows = []
+        errors = OrderedDict()
+        timings = OrderedDict()
+
+        for alias in aliases:
+            description, results, error, elapsed = outcomes[alias]
+            timings[alias] = elapsed
+
+            if error is not None:
+                errors[alias] = error
+                continue
+
+            if columns is None and description is not None:
+                columns = ['alias'] + [column[0] for column in description]
+
+            for row in results or []:
+                rows.append((alias,) + tuple(row))
+
+        return FanOutResult(columns or ['alias'], rows, errors, timings)
+
+    def fan_out_one(self, alias, command, fetch):
+        """
+        Runs the command for fan_out() on one alias, catching any error.
+
+        :param alias: the alias to run the command on
+        :param command: the command to execute
+        :param fetch: how many records to fetch, either a positive integer or 'all'
+        :returns: a tuple of (description, results, error, elapsed seconds)
 
-    def is_registered(self, alias):
         """
-        
-        :param alias: the alias to verify as existing
-        :returns: boolean
 
+        started = time.time()
+
+        try:
+            if not self.is_connected(alias):
+                raise Exception(stack()[0][3], "There is no connection with the alias %s" % alias)
+
+            if self.is_busy(alias):
+                raise Exception(stack()[0][3], "The alias '%s' is running an async query" % alias)
+
+            connection_type = self._registry[alias].type
+
+            self.execute_command(alias, connection_type, command, fetch)
+            description = self._registry[alias].cursor.description
+            results = self.fetch(alias, connection_type, fetch)
+
+            return description, results, None, time.time() - started
+
+        except Exception, err:
+            logging.warning(" - The command failed on '%s': %s", alias, err)
+            return None, None, err, time.time() - started
+
+    def is_busy(self, alias):
+        """
+        :param alias: the alias to check
+        :returns: boolean, True while the alias has async queries waiting or running
         """
 
-        return alias in self._conn_info.keys()
+        worker = self._workers.get(alias)
 
-    def is_connected(self, alias):
+        return worker is not None and worker.is_busy()
+
+    def wait_for(self, query_id):
         """
-        validates that an alias exists and has a connection
-        
-        :param alias: the alias to verify as a valid connection
-        :returns: boolean
+        :param query_id: the id of an async query
+        :returns: the results of the query, once it is finished
 
         """
 
-        return self.is_registered(alias) and not (self._conn_info[alias]['connection'] is None)
+        if query_id not in self._async_queries:
+            raise Exception(stack()[0][3], "There is no async query with the id %s" % query_id)
+
+        query = self._async_queries[query_id]
+        results = query.result()
+
+        # the results have been handed over, so the handle doesn't need to hold them
+        self._async_queries.pop(query_id, None)
+
+        return results
 
-    def connect_to_source(self, connection_alias, connection_type, connection_source,username,password,args):
+    def cancel(self, connection_alias):
         """
-        Establishes a connection to a data source and removes the alias.
+        Stops whatever is running on an alias: its queued and running async queries, a statement
+        running on another thread and an open stream.
+
+        A cancelled statement leaves its connection to be cleaned up (which rolls back the
+        transaction), right away if it has stopped, otherwise by the thread running it before
+        the next command.  If nothing was running, the connection and its transaction are left
+        alone.
 
         :param connection_alias: the plain english name to associate with this connection
-        :param connection_type: the type of connection to use
-        :param connection_source: the name of an an ODBC DSN or connection string
-        :param username: the username to use for a connection (optional)
-        :param password: connection_source: the password to use for a connection (optional)
-        :returns: formatted string
+        :returns: boolean, True if something was cancelled
 
         """
 
-        logging.debug(" -- Working with connection '%s' of type '%s'" % (connection_alias, connection_type))
+        if connection_alias not in self._registry:
+            raise Exception(stack()[0][3], "There is no connection with the alias %s" % connection_alias)
 
-        if self.is_registered(connection_alias):
-            raise Exception(stack()[0][3], \
-                " --- There is already a connection with the alias %s" % connection_alias)
+        entry = self._registry[connection_alias]
+        cancelled = False
 
-        logging.debug(" --- Working with connection '%s' of type '%s'" % (connection_alias, connection_type))
+        for query in self._async_queries.values():
+            if query.alias == connection_alias and query.cancel():
+                logging.debug(" --- Cancelled async query %s on '%s'", query.id, connection_alias)
+                cancelled = True
 
-        if connection_type.lower() == 'odbc':
+        if entry.in_flight is not None and not entry.cancelled:
+            logging.debug(" --- Cancelling the running statement on '%s'", connection_alias)
+            entry.cancel()
+            cancelled = True
 
-            try:
+        # closing a stream only drops its pending rows, the transaction is left alone
+        if entry.stream is not None:
+            logging.debug(" --- Closing the open stream on '%s'", connection_alias)
+            entry.stream.close()
+            cancelled = True
 
-                logging.debug(" ---- Attempting to connect to '%s' " % (connection_alias))
+        # a cancelled statement that has already stopped is cleaned up now, which rolls back
+        if entry.cancelled and entry.in_flight is None and not self.is_busy(connection_alias):
+            entry.reset()
 
-                # connect to the ODBC source
+        return cancelled
 
-                if (len(username) > 0 and len(password) > 0):
-                    new_cnxn = pyodbc.connect(connection_source,uid=username,pwd=password)
-                else:
-                    new_cnxn = pyodbc.connect(connection_source)
+    def async_status(self):
+        """
+        :returns: a list with the progress of every async query that hasn't been waited for
 
-                new_cursor = new_cnxn.cursor()
+        """
 
-                newSource = ODBCSource(args)
+        return [query.progress() for query in self._async_queries.values()]
 
-                # store the results and make this the active connection
-                self._conn_info[connection_alias] = \
-                        {'alias' : connection_alias, \
-                        'object' : newSource, \
-                        'cursor' : new_cursor, \
-                        'connection' :new_cnxn, \
-                        'type' : connection_type }
+    def finish_naked_stream(self, connection_alias, connection_type, closed_stream):
+        """
+        Commits and gives back the pooled connection of a naked query once its stream is closed.
 
-            except pyodbc.Error, err:
-                logging.error("The connection is '%s' the available connections are " % connection_alias)
-                logging.error(self._conn_info)
-                logging.error(err[1])
-                raise err
+        :param connection_alias: the plain english name to associate with this connection
+        :param connection_type: the type of connection to use
+        :param closed_stream: the RowStream that was closed
 
+        """
 
-            self._default_conn_alias = connection_alias
+        # the alias is already gone if the stream was closed by a disconnect
+        if not self.is_registered(connection_alias):
+            return
 
-            logging.debug(" --- Connected data source '%s' as type '%s'"  % (connection_alias,connection_type))
+        if closed_stream.failed:
+            logging.info(' - Discarding the pooled connection after an error')
+            self.disconnect_from_source(connection_alias, connection_type, discard=True)
         else:
-            raise Exception(stack()[0][3], \
-                    "The type provided ('%s') is not valid.  No connection made" % connection_type)
+            logging.info(' - Starting commit process')
+            self.commit(connection_alias, connection_type)
+            logging.info(' - Starting disconnect process')
+            self.disconnect_from_source(connection_alias, connection_type)
 
-    def disconnect_from_source(self, connection_alias, connection_type):
-        """
-        Disconnects a particular connection to a data source and removes the alias.
+    @cell_magic('db')
+    def cmagic(self, line, cell):
+        "my cell magic"
 
-        :param connection_alias: the plain english name to associate with this connection
-        :param connection_type: the type of connection to use
+        statements = split_statements(''.join(cell))
 
+        if len(statements) > 1:
+            return self.run_batch(line, statements)
+
+        line = self.lmagic(line, ' '.join(statements))
+        return line
+
+    def run_batch(self, line, statements):
         """
+        Runs the statements of a cell in order, on one cursor, with one pass of argument parsing.
 
-        logging.debug(" -- Working with connection '%s' of type '%s'" % (connection_alias, connection_type))
+        :param line: the line of the cell magic
+        :param statements: the statements from split_statements()
+        :returns: a list of StatementResult, one per statement that was run
 
-        if connection_type.lower() == 'odbc':
+        """
 
-            if not self.is_registered(connection_alias):
-                raise Exception(stack()[0][3], "There is no connection with the alias %s" % connection_alias)
-            try:
-                logging.debug(" --- Attempting to disconnect from %s " % (connection_alias))
-                cursor = self._conn_info[connection_alias]['cursor']
-                cnxn = self._conn_info[connection_alias]['connection']
-            except pyodbc.Error, err:
-                logging.error(err[1])
-                raise err
+        # the first statement decides the alias and whether this is naked or unsourced
+        alias, key, cmd, fetch, args = self.parse_args(line, statements[0])
 
-            # disconnect everything and remove the entry from the master list
-            cursor.close()
-            cnxn.close()
-            self._conn_info.pop(connection_alias,"None")
+        if args.explain or args.dry_run:
+            self.explain(alias, key, cmd, fetch, args, line)
 
-            logging.debug(" --- Disconnected data source '%s'"  % connection_alias)
+            if args.dry_run:
+                return
 
-            # set the active connection to the last one created
-            if len(self._conn_info.keys()) > 0:
-                self._active_conn_key = self._conn_info.keys()[0]
-                logging.debug(" --- Setting active key to '%s'"  % self._active_conn_key)
-            else:
-                self._active_conn_key = None
-        else:
+        if self.is_busy(alias):
             raise Exception(stack()[0][3], \
-                    "The type provided ('%s') is not valid.  No connection made" % connection_type)
+                    "The alias '%s' is running an async query, use --wait to get its results first" % alias)
 
-    def execute_command(self, connection_alias, connection_type, command, fetch):
-        """
-        Execute a command on a remote data source
+        timing = QueryTiming(alias, '; '.join(statements))
 
-        NOTE: this will not return a value, just execute the command.  Use fetch() 
+        if args.connect or args.naked:
+            logging.info(' - Starting connection process')
+            started = time.time()
+            try:
+                self.connect_to_source(alias, args.type, key, args.uid, args.pwd, args, pooled=args.naked)
+            except Exception, err:
+                timing.error = err
+                self._stats.add(timing)
+                raise
+            timing.record('connect', started)
 
-        :param connection_alias: the plain english name to associate with this connection
-        :param connection_type: the type of connection to use
-        :param command:  the command to execute at the connection
+        results = []
+        failed = False
 
-        """
+        try:
+            for statement in statements:
+
+                logging.info(' - Starting execution process with "%s"', statement)
+                started = time.time()
+
+                try:
+                    self.execute_command(alias, args.type, statement.replace('\n', ' '), fetch, timeout=args.timeout)
+                    timing.record('execute', started)
+                    cursor = self._registry[alias].cursor
+                    rows = None
+                    if cursor.description is not None:
+                        fetch_started = time.time()
+                        rows = self.fetch(alias, args.type, fetch, timeout=args.timeout)
+                        timing.record('fetch', fetch_started)
+                        timing.rows += len(rows or [])
+                    results.append(StatementResult(statement, rows, cursor.rowcount, time.time() - started))
+                except Exception, err:
+                    failed = True
+                    timing.error = err
+                    results.append(StatementResult(statement, elapsed=time.time() - started, error=err))
+                    if not args.continue_on_error:
+                        logging.warning(' - Stopping after a failed statement: %s', err)
+                        break
+
+            if args.rollback:
+                logging.info(' - Starting rollback process')
+                started = time.time()
+                self.rollback(alias, args.type)
+                timing.record('rollback', started)
+            elif (args.commit or args.naked) and not (failed and args.naked):
+                logging.info(' - Starting commit process')
+                started = time.time()
+                self.commit(alias, args.type)
+                timing.record('commit', started)
 
-        logging.debug(" -- Working with connection '%s' of type '%s'" % (connection_alias, connection_type))
+        finally:
+            if (args.disconnect or args.naked) and self.is_registered(alias):
+                logging.info(' - Starting disconnect process')
+                started = time.time()
+                self.disconnect_from_source(alias, args.type, discard=(failed and args.naked))
+                timing.record('disconnect', started)
 
-        if connection_type.lower() == 'odbc':
+            self._stats.add(timing)
+            self.record_metrics(alias, timing)
 
-            if self.is_registered(connection_alias):
+        if (not args.naked or args.unsourced) and alias in self._registry:
+            self._registry.most_recent_alias = alias
 
-                logging.debug(" --- Executing '%s' on '%s'" % (command, connection_alias))
+        return results
 
-                if not self.is_connected(connection_alias):
-                    raise Exception(stack()[0][3], "There is no connection with the alias %s" % connection_alias)
+    def cleanup(self):
+        " shutting down all connections properly"
 
-                if len(command) > 0:
-                    try:
-                        logging.debug(" --- Attempting to execute '%s' on '%s'" % (command, connection_alias))
-                        cursor = self._conn_info[connection_alias]['cursor']
-                        cursor.execute(command)
-                    except pyodbc.Error, err:
-                        logging.error(err[1])
-                        raise err
-                else:
-                        logging.debug(" --- Skipping empty command.")
-            else:
-                raise Exception(stack()[0][3], "The connection '%s' is not registered" % connection_alias)
-        else:
-                raise Exception(stack()[0][3], "The type provided ('%s') is not valid.  No connection made" % connection_type)
+        logging.info("Closing all connections")
 
+        # async queries hold connections on their own threads, so stop them first
+        for query in self._async_queries.values():
+            query.cancel()
 
-    def fetch(self, connection_alias, connection_type, fetch):
-        """
-        Fetch the results from a previous command.  This is always used in conjunction
-        with the execute_command() function, either implicitly or explicitly.
+        with self._conn_lock:
+            workers = self._workers.values()
+            self._workers.clear()
 
-        :param connection_alias: the plain english name to associate with this connection
-        :param connection_type: the type of connection to use
-        :param fetch: how many records to fetch, either a positive integer or 'all'
+        for worker in workers:
+            logging.debug("Stopping the worker for %s", worker.alias)
+            worker.stop()
+            worker.join()
 
-        """
+        shutdown_had_problems = False
 
-        logging.debug(" -- Working with connection '%s' of type '%s'" % (connection_alias, connection_type))
+        for entry in self._registry.entries():
+            try:
+                logging.debug("Closing %s", entry.alias)
+                self.disconnect_from_source(entry.alias, entry.type)
+            except Exception, err:
+                logging.warning(" - There was a problem shutting down %s: %s", entry.alias, err)
+                shutdown_had_problems = True
 
-        if connection_type.lower() == 'odbc':
+        if shutdown_had_problems:
+            raise Exception(stack()[0][3], "Some of the connections could not be shut down.")
 
-            logging.debug(" --- Fetching '%s' records from '%s'" % (fetch, connection_alias))
+        logging.debug("Draining the connection pool")
+        self._pool.drain()
 
-            if not self.is_connected(connection_alias):
-                logging.debug(" ---- The alias '%s' is not connected" % connection_alias)
-                return
-            try:
+    def __del__(self):
+        self.cleanup()
 
-                cursor = self._conn_info[connection_alias]['cursor']
-                description = []
-
-                if (isinstance(fetch, str) or isinstance(fetch, unicode)) and 'all' in fetch:
-                    logging.debug(" ---- Running cursor.fetchall()")
-                    return cursor.fetchall()
-                elif (long(fetch) == 0):
-                    logging.debug(" ---- Running cursor.fetchall()")
-                    return cursor.fetchall()
-                elif long(fetch) > 0:
-                    logging.debug(" ---- Running cursor.fetchmany(%s)" % long(fetch))
-                    return cursor.fetchmany(long(fetch))
-                else:
-                    logging.debug(" ---- '%s' is an invalid number of rows to fetch" % fetch)
+    @line_magic
+    def unload_ext(self, module_str):
+        """Unload an IPython extension by its module name."""
+        logging.info("Unloading extension")
+        self.cleanup()
+        self.shell.extension_manager.unload_extension(module_str)
 
-            except pyodbc.ProgrammingError, err:
-                logging.warning(err)
-                pass
-            except pyodbc.Error, err:
-                logging.error(err)
-                raise err
-        else:
-            raise Exception(stack()[0][3], \
-                    "The type provided ('%s') is not valid.  No connection made" % connection_type)
+class Client(object):
 
-    def commit(self, connection_alias, connection_type):
-        """
-        commit the results from a previous command.  This is always used in conjunction
-        with the execute_command() function, either implicitly or explicitly.
+    """
+    Runs commands on the connections of the %db magics straight from Python, without
+    formatting and parsing a magic line for every call.
 
-        :param connection_alias: the plain english name to associate with this connection
-        :param connection_type: the type of connection to use
+    A Client shares the connection registry, the pool and the query stats of DbMagic, so an
+    alias connected with a Client can be used with %db, and the other way around:
+
+        client = Client()
+        client.connect('sales', 'MY_DSN')
+        client.execute('sales', "SELECT * FROM orders WHERE region = ?", ('EU',))
+        orders = client.fetch_df('sales')
+        client.close('sales')
 
+    It works outside of IPython too, so scripts and batch jobs can use the same drivers.
+    """
+
+    def __init__(self, registry=None, pool=None, stats=None):
+        """
+        :param registry: the ConnectionRegistry to use (the default is the one of DbMagic)
+        :param pool: the ConnectionPool pooled connections go back to (the default is the one of DbMagic)
+        :param stats: the QueryStats calls are recorded in (the default is the one of DbMagic)
         """
 
-        logging.debug(" -- Working with connection '%s' of type '%s'" % (connection_alias, connection_type))
+        self.registry = registry if registry is not None else DbMagic._registry
+        self.pool = pool if pool is not None else DbMagic._pool
+        self.stats = stats if stats is not None else DbMagic._stats
 
-        if connection_type.lower() == 'odbc':
+    def entry(self, alias):
+        """
+        :param alias: a registered alias
+        :returns: the ConnectionEntry of the alias
+        """
 
-            logging.debug(" --- commiting cursor '%s'" % (connection_alias))
+        entry = self.registry.get(alias)
 
-            if not self.is_connected(connection_alias):
-                logging.debug(" ---- The alias '%s' is not connected" % connection_alias)
-                return
-            try:
-                cursor = self._conn_info[connection_alias]['cursor']
-                cursor.commit()
-            except pyodbc.Error, err:
-                logging.error(err)
-                raise err
-        else:
+        if entry is None or entry.connection is None:
+            raise Exception(stack()[0][3], "There is no connection with the alias %s" % alias)
+
+        # the worker thread of an async query owns the connection until the query is done
+        if self.is_busy(alias):
             raise Exception(stack()[0][3], \
-                    "The type provided ('%s') is not valid.  No connection made" % connection_type)
+                    "The alias '%s' is running an async query, use --wait to get its results first" % alias)
 
-    def list_values(self, connection_alias, connection_type,list_value):
+        return entry
+
+    def is_busy(self, alias):
+        """
+        :param alias: the alias to check
+        :returns: boolean, True while the alias has async queries of the magics waiting or running
         """
-        commit the results from a previous command.  This is always used in conjunction
-        with the execute_command() function, either implicitly or explicitly.
 
-        :param connection_alias: the plain english name to associate with this connection
-        :param connection_type: the type of connection to use
-        :param list_value: the thing inside the database to list
+        worker = DbMagic._workers.get(alias)
+
+        return worker is not None and worker.is_busy()
 
+    def connect(self, alias, source, connection_type='odbc', username=None, password=None):
         """
+        Connects to a data source and registers it under an alias.
 
-        logging.debug(" -- Working with connection '%s' of type '%s'" % (connection_alias, connection_type))
+        :param alias: the plain english name to associate with this connection
+        :param source: the name of an ODBC DSN, a connection string, or whatever the driver expects
+        :param connection_type: the type of connection to use, see register_driver()
+        :param username: the username to use for a connection (optional)
+        :param password: the password to use for a connection (optional)
+        :returns: the ConnectionEntry of the new connection
+        """
 
-        if connection_type.lower() == 'odbc':
+        if alias in self.registry:
+            raise Exception(stack()[0][3], "There is already a connection with the alias %s" % alias)
 
-            if not self.is_connected(connection_alias) and list_value != 'sources':
-                logging.debug(" --- The alias '%s' is not connected" % connection_alias)
-                return
-            try:
-                logging.debug(" --- The list value is '%s'" % list_value)
-                results = []
-                if list_value == 'tables':
-                    logging.debug(" -- Listing tables in '%s'" % connection_alias)
-                    cursor = self._conn_info[connection_alias]['cursor']
-                    for row in cursor.tables():
-                        results.append(row)
-                elif list_value == 'procedures':
-                    logging.debug(" --- Listing procedures in '%s'" % connection_alias)
-                    cursor = self._conn_info[connection_alias]['cursor']
-                    for row in cursor.procedures():
-                        results.append(row)
-                elif list_value == 'sources':
-                    logging.debug(" --- Listing sources in '%s'" % connection_alias)
-
-                    for row in pyodbc.dataSources():
-                        results.append(row)
-                else:
-                    raise Exception(stack()[0][3], "The list value provided ('%s') is not valid.  No connection made" % list_value)
+        driver = get_driver(connection_type)
+        timing = QueryTiming(alias, None)
+        started = time.time()
 
-                logging.debug(" --- Listing '%s'" % results)
-                return results
+        logging.debug(" --- Connecting '%s' to '%s' with %s", alias, source, driver)
 
-            except pyodbc.Error, err:
-                logging.error(err)
-                raise err
+        connection = driver.connect(source, username, password)
 
-        else:
-            raise Exception(stack()[0][3], \
-                    "The type provided ('%s') is not valid.  No connection made" % connection_type)
+        try:
+            entry = ConnectionEntry(alias, connection_type, source, connection, driver.cursor(connection), driver=driver, \
+                    opener=lambda: driver.connect(source, username, password), username=username)
+            self.registry.register(entry)
+        except:
+            driver.close(connection)
+            raise
 
-    @line_magic('db')
-    def lmagic(self, line):
+        timing.record('connect', started)
+        self.stats.add(timing)
+        entry.record(timing)
+
+        return entry
+
+    def execute(self, alias, sql, params=None, timeout=None):
         """
-        A magic to allow access to data stores using native syntax (such as SQL).
+        Executes a command on a connection.  Its results are read with fetch_iter() or fetch_df().
 
-            ARGUMENT  OPTIONS
-            --------  --------------------------------------------------------------------------
-            'source', type=str, help='The identifier of the data source (optional)',default='', nargs='?'
-            'cmd', type=str, help='A command to be executed (optional)',default='', nargs='*'
-            '-src', '--source', help='The data source to use (optional).', action="store"
-            '-a', '--alias', help='The key to refer to this connection with', action="store"
-            '-def', '--default', help='The key to refer to this connection with', action="store"
-            '-c', '--connect', '--conn', help='Connect to this database', action="store_true"
-            '-d', '--disconnect', '--dis', help='Disconnect from this datbase', action="store_true"
-            '-t', '--type', help='Connection type (ODBC is the default)', action="store", default="odbc"
-            '-l', '--list', help='List things about the database.', action="store", nargs='?'
-            '-e', '--execute', '--exec', help='Some SQL to execute', action="store_true"
-            '-m', '--commit', help='Commit this transaction.', action="store_true"
-            '-r', '--rollback', help='Rollback this transaction.', action="store_true"
-            '-n', '--naked', help='Run a naked query (same as --connect --execute --fetch --disconnect)', action="store_true"
-            '--unsourced', help='Run an unsourced query (same as --connect --execute --fetch --disconnect)', action="store_true"
-            '-f', '--fetch', help='Fetch one or more records (default is all)', action="store", default=0,nargs='?'
-            '-u', '--uid', '--username', help='The user name to use (optional).', action="store", default=''
-            '-p', '--pwd', '--password', help='The password to use (optional).', action="store", default=''
-            '-h', '--help', help='Display help.', action="store_true"
-            '-v', '--verbose', help='Display debugging verbosely (same as --debug=DEBUG', action="store_true"
-            '--debug', help='Output debugging info', action="store", default='WARNING',nargs='?'
-            '-y', '--dry_run', '--dry', help='Make this a dry run', action="store_true"
-            '--explain', help='Give an explanation on exac', action="store_true"
-            '--note', help='Add a note for help with debugging', action="store", nargs="*"
-            '--cleanup', help='Clean up all the connections and shut down', action="store_true"
+        :param alias: a registered alias
+        :param sql: the command to execute
+        :param params: the values for the parameter markers in the command (optional)
+        :param timeout: cancel the command if it runs for more than this many seconds (optional)
+        :returns: the number of records the command changed, or -1 if the driver doesn't know
         """
-        results = None
 
-        logging.info(' - Starting parsing process')
-        alias, key, cmd, fetch, args = self.parse_args(line)
+        def execute(entry):
+            entry.execute(sql, params, timeout)
+            return entry.cursor.rowcount
 
-        if args.explain or args.dry_run:
-            self.explain(alias, key, cmd, fetch, args,line)
+        return self.timed(alias, sql, 'execute', execute)
 
-            if args.dry_run:
-                return
+    def fetch_iter(self, alias, batch_size=DEFAULT_STREAM_BATCH, adaptive=False):
+        """
+        :param alias: a registered alias with a pending result set
+        :param batch_size: how many records to fetch with each round trip
+        :param adaptive: change the number of records per round trip based on the measured throughput
+        :returns: a RowStream over the records, which is tied to the alias until it is exhausted or closed
+        """
 
-        ##############################################################################
-        # The order of these commands are VERY important, as when a command is run
-        # "naked" or "unsourced" it will scroll through these in order.  It is
-        # critically imporant that you keep them in a logical order for database connections.
-        ##############################################################################
+        entry = self.entry(alias)
+        timing = QueryTiming(alias, None)
+        started = time.time()
 
-        if args.connect or args.naked:
-            logging.info(' - Starting connection process')
-            self.connect_to_source(alias,args.type, key, args.uid, args.pwd,args)
+        stream = entry.open_stream(batch_size, AdaptiveBatchSizer(batch_size, adaptive=adaptive))
 
-        if (args.execute or \
-                args.naked or \
-                args.unsourced) and \
-                (len(cmd) > 0):
+        # the records are only fetched as the stream is read, so the call is recorded when it closes
+        def record(closed_stream):
+            timing.record('fetch', started)
+            timing.rows = closed_stream.rows_fetched
+            self.stats.add(timing)
+            entry.record(timing)
 
-            logging.info(' - Starting execution process with "%s"' %cmd)
-            self.execute_command(alias, args.type, cmd, fetch)
+        stream.on_close(record)
 
-        if args.list is not None:
-            logging.info(' - Starting list process')
-            results = self.list_values(alias, args.type, args.list)
+        return stream
 
-        if args.fetch == 'all' or args.fetch > 0 or args.naked or args.unsourced:
+    def fetch_df(self, alias, max_rows=None, batch_size=DEFAULT_STREAM_BATCH, downcast=False, categorize=None, adaptive=False):
+        """
+        :param alias: a registered alias with a pending result set
+        :param max_rows: stop after this many records (optional)
+        :param batch_size: how many records to fetch with each round trip
+        :param downcast: store integer columns in the smallest type that fits
+        :param categorize: the ratio of distinct values under which strings are categorical (optional)
+        :param adaptive: change the number of records per round trip based on the measured throughput
+        :returns: a pandas DataFrame, or None if the command didn't return a result set
+        """
 
-            logging.info('Starting fetch process')
-            results = self.fetch(alias, args.type, fetch)
-            logging.info(results)
+        def fetch(entry):
+            sizer = AdaptiveBatchSizer(batch_size, adaptive=adaptive)
 
-        if args.commit or args.naked:
-            logging.info(' - Starting commit process')
-            self.commit(alias, args.type)
+            try:
+                with entry.use():
+                    columns = ColumnarResult.from_cursor(entry.cursor, max_rows=max_rows, sizer=sizer, \
+                            batches=entry.driver.fetch_batches)
+            except entry.driver.no_results_errors, err:
+                logging.warning(err)
+                return None
 
-        if args.disconnect or args.naked:
-            logging.info(' - Starting disconnect process')
-            self.disconnect_from_source(alias, args.type)
+            return columns.to_pandas(downcast=downcast, categorize=categorize)
 
-        if not args.naked or args.unsourced:
-            self._most_recent_conn_alias = alias
+        return self.timed(alias, None, 'fetch', fetch)
 
-        if  args.cleanup:
-            self.cleanup()
+    def commit(self, alias):
+        """
+        :param alias: a registered alias
+        """
 
-        if results is not None:
-            logging.debug(' - Returning resultset')
-            return results
-        else:
-            logging.debug(' - Returning nothing')
-            return
+        self.timed(alias, None, 'commit', lambda entry: entry.driver.commit(entry.connection))
 
-        return line
+    def rollback(self, alias):
+        """
+        :param alias: a registered alias
+        """
 
-    @cell_magic('db')
-    def cmagic(self, line, cell):
-        "my cell magic"
-        line = self.lmagic(line + ' ' + ''.join(cell).replace('\n', ' '))
-        return line
+        self.timed(alias, None, 'rollback', lambda entry: entry.driver.rollback(entry.connection))
 
-    def cleanup(self):
-        " shutting down all connections properly"
+    def close(self, alias):
+        """
+        Closes a connection and removes its alias, for the magics too.
 
-        logging.info("Closing all connections")
+        :param alias: a registered alias
+        """
 
-        shutdown_had_problems = False
+        self.entry(alias)
+        entry = self.registry.pop(alias)
 
-        for alias in self._conn_info.keys():
-            try:
-                logging.debug("Closing %s" % alias)
-                self.disconnect_from_source(alias,self._conn_info[alias]['type'])
-            except err:
-                logging.warning(" - There was a problem shutting down %s" % alias)
-                shutdown_had_problems = True
+        if entry is None:
+            raise Exception(stack()[0][3], "There is no connection with the alias %s" % alias)
 
-            if shutdown_had_problems:
-                raise Exception(stack()[0][3], \
-                        "The list value provided ('%s') is not valid.  No connection made" % list_value)
+        entry.close(self.pool)
 
-            
-    def __del__(self):
-        self.cleanup()
+    def timed(self, alias, command, phase, call):
+        """
+        Runs a call on a connection and records it in the stats, like the %db magics do.
+
+        :param alias: a registered alias
+        :param command: the command the call runs (optional)
+        :param phase: the QueryTiming phase the call is recorded as
+        :param call: a function called with the ConnectionEntry
+        :returns: whatever the call returns
+        """
+
+        entry = self.entry(alias)
+        timing = QueryTiming(alias, command)
+        started = time.time()
+
+        try:
+            results = call(entry)
+            if phase == 'fetch':
+                timing.measure(results)
+        except Exception, err:
+            timing.error = err
+            raise
+        finally:
+            timing.record(phase, started)
+            self.stats.add(timing)
+            entry.record(timing)
+
+        return results
 
-    @line_magic
-    def unload_ext(self, module_str):
-        """Unload an IPython extension by its module name."""
-        logging.info("Unloading extension")
-        self.cleanup()
-        self.shell.extension_manager.unload_extension(module_str)
 
 # In order to actually use these magics, you must register them with a
 # running IPython.  This code must be placed in a file that is loaded once
-# IPython is up and running:
-ip = get_ipython()
+# IPython is up and running (outside of IPython only the Client can be used):
+try:
+    ip = get_ipython()
+except NameError:
+    ip = None
 # You can register the class itself without instantiating it.  IPython will
 # call the default constructor on it.
-ip.register_magics(DbMagic)
+if ip is not None:
+    ip.register_magics(DbMagic)
 
 def load_ipython_extension(ip):
     """Load the extension in IPython."""
     ip.register_magics(DbMagic)
+
+    # tab completion for both the line and the cell magic
+    completer = SqlCompleter(DbMagic)
+    ip.set_hook('complete_command', completer, str_key='%db')
+    ip.set_hook('complete_command', completer, str_key='%%db')
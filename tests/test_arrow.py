@@ -0,0 +1,77 @@
+"""
+Tests for the Arrow results of the sqlite backend.
+
+Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import db
+
+
+def null_first_cursor():
+    """
+    :returns: a sqlite cursor over a table whose first row is all NULL, and whose last
+              column is always NULL
+    """
+
+    connection = sqlite3.connect(':memory:')
+    connection.execute("CREATE TABLE t (a INTEGER, b TEXT, c REAL, d INTEGER)")
+    connection.executemany("INSERT INTO t VALUES (?, ?, ?, ?)", \
+            [(None, None, None, None), (2, u'x', 1.5, None), (3, None, 2.5, None)])
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT * FROM t")
+
+    return cursor
+
+
+@unittest.skipIf(db.pyarrow is None, "pyarrow is not installed")
+class ArrowNullColumnTest(unittest.TestCase):
+
+    def setUp(self):
+        self.driver = db.get_driver('sqlite')
+        self.expected = {'a' : [None, 2, 3], 'b' : [None, u'x', None], 'c' : [None, 1.5, 2.5], 'd' : [None, None, None]}
+
+    def test_fetch_arrow(self):
+        table = self.driver.fetch_arrow(null_first_cursor(), db.AdaptiveBatchSizer(1))
+
+        self.assertEqual(dict(table.to_pydict()), self.expected)
+        self.assertEqual(str(table.schema.field('a').type), 'int64')
+
+    def test_stream(self):
+        stream = db.ArrowStream(null_first_cursor(), 1, batches=self.driver.arrow_batches)
+
+        self.assertEqual(dict(stream.read_all().to_pydict()), self.expected)
+
+    def test_all_null_column_past_the_hold(self):
+        batches = list(db.arrow_batches(null_first_cursor(), db.AdaptiveBatchSizer(1), hold_rows=1))
+
+        self.assertEqual(len(set([str(batch.schema) for batch in batches])), 1)
+        self.assertEqual([batch.to_pydict()['a'] for batch in batches], [[None], [u'2'], [u'3']])
+
+    def test_persist(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = db.ResultStore(directory, 'arrow')
+            cursor = null_first_cursor()
+            writer = store.writer('nulls', cursor.description)
+            for batch in db.fetch_batches(cursor, db.AdaptiveBatchSizer(1)):
+                writer.write(batch)
+            writer.close()
+
+            self.assertEqual(dict(store.load('nulls').to_pydict()), self.expected)
+        finally:
+            shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    unittest.main()
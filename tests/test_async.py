@@ -0,0 +1,132 @@
+"""
+Tests for --async, --status and --wait, against the sqlite backend.
+
+Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from test_magics import MagicTestCase
+
+import db
+
+
+class AsyncTest(MagicTestCase):
+
+    def setUp(self):
+        MagicTestCase.setUp(self)
+        self.blocked = []
+
+    def tearDown(self):
+
+        for query, release in self.blocked:
+            release.set()
+            query.result(10)
+
+        MagicTestCase.tearDown(self)
+        db.DbMagic._async_queries.clear()
+
+    def block(self, alias='t'):
+        """
+        :param alias: the alias to keep busy
+        :returns: the AsyncQuery that keeps it busy, and an event that lets it go on once it is set
+        """
+
+        release = threading.Event()
+        started = threading.Event()
+
+        def job(query):
+            started.set()
+            release.wait(10)
+            return 'released'
+
+        query = self.magics.submit_async(alias, 'blocking', job)
+        started.wait(10)
+        self.blocked.append((query, release))
+
+        return query, release
+
+    def test_wait_returns_the_results(self):
+
+        self.connect()
+        query = self.line('-t sqlite -a t SELECT n FROM numbers WHERE n < 3 --fetch all --async')
+
+        self.assertIsInstance(query, db.AsyncQuery)
+        self.assertEqual(self.line('--wait %s' % query.id), [(0,), (1,), (2,)])
+        self.assertEqual(query.state, 'done')
+
+        # the handle is dropped once its results are handed over
+        self.assertEqual(self.line('--status'), [])
+        self.assertRaises(Exception, self.line, '--wait %s' % query.id)
+
+    def test_queries_on_an_alias_run_in_order(self):
+
+        self.connect()
+        blocking, release = self.block()
+
+        insert = self.line('-t sqlite -a t INSERT INTO numbers VALUES (10, NULL) --async')
+        count = self.line('-t sqlite -a t SELECT COUNT(*) FROM numbers --fetch all --async')
+
+        self.assertEqual([(status['id'], status['state']) for status in self.line('--status')], \
+                [(blocking.id, 'running'), (insert.id, 'pending'), (count.id, 'pending')])
+
+        release.set()
+
+        self.assertEqual(self.line('--wait %s' % count.id), [(11,)])
+        self.assertEqual(self.line('--wait %s' % blocking.id), 'released')
+
+    def test_busy_alias_refuses_a_synchronous_call(self):
+
+        self.connect()
+        blocking, release = self.block()
+
+        try:
+            self.assertTrue(self.magics.is_busy('t'))
+            self.assertRaises(Exception, self.line, '-t sqlite -a t SELECT 1 --fetch all')
+        finally:
+            release.set()
+
+        self.line('--wait %s' % blocking.id)
+
+        self.assertFalse(self.magics.is_busy('t'))
+        self.assertEqual(self.line('-t sqlite -a t SELECT COUNT(*) FROM numbers --fetch all'), [(10,)])
+
+    def test_cancel_drops_a_pending_query(self):
+
+        self.connect()
+        blocking, release = self.block()
+
+        pending = self.line('-t sqlite -a t DELETE FROM numbers --async')
+        self.assertTrue(pending.cancel())
+        release.set()
+
+        self.line('--wait %s' % blocking.id)
+
+        self.assertEqual(pending.state, 'cancelled')
+        self.assertRaises(Exception, self.line, '--wait %s' % pending.id)
+        self.assertEqual(self.line('-t sqlite -a t SELECT COUNT(*) FROM numbers --fetch all'), [(10,)])
+
+    def test_failed_query_raises_on_wait(self):
+
+        self.connect()
+        query = self.line('-t sqlite -a t SELECT * FROM missing --fetch all --async')
+
+        self.assertRaises(Exception, self.line, '--wait %s' % query.id)
+        self.assertEqual(query.state, 'failed')
+
+    def test_no_async_stream(self):
+
+        self.connect()
+
+        self.assertRaises(Exception, self.line, '-t sqlite -a t SELECT n FROM numbers --stream 2 --async')
+
+
+if __name__ == '__main__':
+    unittest.main()
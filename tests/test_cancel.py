@@ -0,0 +1,94 @@
+"""
+Tests for --cancel and the Watchdog behind --timeout, against the sqlite backend.
+
+Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from IPython.core.interactiveshell import InteractiveShell
+
+import db
+
+
+class CancelTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.shell = InteractiveShell.instance()
+        self.shell.register_magics(db.DbMagic)
+
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.db')
+
+        connection = sqlite3.connect(self.path)
+        connection.execute("CREATE TABLE numbers (n INTEGER)")
+        connection.executemany("INSERT INTO numbers VALUES (?)", [(i,) for i in range(10)])
+        connection.commit()
+        connection.close()
+
+        self.line('-t sqlite %s -a t --connect' % self.path)
+        self.entry = db.DbMagic._registry['t']
+
+    def tearDown(self):
+
+        self.line('--cleanup')
+        shutil.rmtree(self.directory)
+
+    def line(self, line):
+        return self.shell.run_line_magic('db', line)
+
+    def count(self):
+        return self.line('-t sqlite -a t SELECT COUNT(*) FROM numbers --fetch all')[0][0]
+
+    def test_cancel_on_an_idle_alias_keeps_the_open_transaction(self):
+
+        self.line('-t sqlite -a t INSERT INTO numbers VALUES (10)')
+
+        self.assertFalse(self.line('--cancel t'))
+        self.assertFalse(self.entry.cancelled)
+        self.assertEqual(self.count(), 11)
+
+    def test_cancel_closes_an_open_stream_without_a_rollback(self):
+
+        self.line('-t sqlite -a t INSERT INTO numbers VALUES (10)')
+        stream = self.line('-t sqlite -a t SELECT n FROM numbers --stream 2')
+
+        self.assertTrue(self.line('--cancel t'))
+        self.assertTrue(stream.closed)
+        self.assertEqual(self.count(), 11)
+
+    def test_timer_firing_after_the_statement_returns_does_not_raise(self):
+
+        watchdog = db.Watchdog(self.entry, 60)
+
+        # the timer goes off once the statement is done, but before the watchdog is stopped
+        with watchdog:
+            self.entry.cursor.execute("INSERT INTO numbers VALUES (10)")
+            watchdog.fire()
+
+        # and once it is stopped
+        watchdog.fire()
+
+        self.assertFalse(self.entry.cancelled)
+        self.assertEqual(self.count(), 11)
+
+    def test_timer_firing_during_the_statement_raises(self):
+
+        endless = "WITH RECURSIVE r(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM r) SELECT COUNT(*) FROM r"
+
+        self.assertRaises(Exception, self.line, '-t sqlite -a t %s --fetch all --timeout 0.2' % endless)
+        self.assertEqual(self.count(), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
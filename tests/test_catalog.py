@@ -0,0 +1,177 @@
+"""
+Tests for the catalog cache behind --list, against the sqlite backend.
+
+Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from test_magics import MagicTestCase
+
+import db
+
+
+TABLES = (['TABLE_CAT', 'TABLE_SCHEM', 'TABLE_NAME', 'TABLE_TYPE'], \
+          [('sales', 'dbo', 'orders', 'TABLE'), \
+           ('sales', 'dbo', 'order_lines', 'TABLE'), \
+           ('sales', 'staging', 'orders', 'TABLE'), \
+           ('sales', 'dbo', 'customers', 'VIEW')])
+
+
+class Loader(object):
+
+    """ Lists the same tables every time, and counts how often it is asked """
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return TABLES
+
+
+class CatalogCacheTest(unittest.TestCase):
+
+    def test_listed_once_per_ttl(self):
+
+        cache = db.CatalogCache(ttl=60)
+        loader = Loader()
+
+        self.assertEqual(len(cache.get('odbc:SALES', 'tables', loader)), 4)
+        self.assertEqual(len(cache.get('odbc:SALES', 'tables', loader)), 4)
+        self.assertEqual(loader.calls, 1)
+
+        cache.listing('odbc:SALES', 'tables').loaded_at -= 61
+
+        cache.get('odbc:SALES', 'tables', loader)
+        self.assertEqual(loader.calls, 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_no_ttl_never_expires(self):
+
+        cache = db.CatalogCache(ttl=None)
+        loader = Loader()
+
+        cache.get('odbc:SALES', 'tables', loader)
+        cache.listing('odbc:SALES', 'tables').loaded_at -= 10 ** 9
+        cache.get('odbc:SALES', 'tables', loader)
+
+        self.assertEqual(loader.calls, 1)
+
+    def test_refresh(self):
+
+        cache = db.CatalogCache()
+        loader = Loader()
+
+        cache.get('odbc:SALES', 'tables', loader)
+        cache.get('odbc:SALES', 'tables', loader, refresh=True)
+        cache.get('odbc:SALES', 'tables', loader)
+
+        self.assertEqual(loader.calls, 2)
+
+    def test_sources_and_kinds_are_kept_apart(self):
+
+        cache = db.CatalogCache()
+        loader = Loader()
+
+        cache.get('odbc:SALES', 'tables', loader)
+        cache.get('odbc:SALES', 'procedures', loader)
+        cache.get('odbc:HR', 'tables', loader)
+        self.assertEqual(loader.calls, 3)
+
+        cache.invalidate('odbc:HR')
+        cache.get('odbc:SALES', 'tables', loader)
+        cache.get('odbc:HR', 'tables', loader)
+        self.assertEqual(loader.calls, 4)
+
+    def test_like(self):
+
+        cache = db.CatalogCache()
+        loader = Loader()
+
+        names = lambda pattern: [(row.table_schem, row.table_name) \
+                for row in cache.get('odbc:SALES', 'tables', loader, pattern=pattern)]
+
+        self.assertEqual(names('ORDER%'), [('dbo', 'orders'), ('dbo', 'order_lines'), ('staging', 'orders')])
+        self.assertEqual(names('staging.*'), [('staging', 'orders')])
+        self.assertEqual(names('sales.dbo.c%'), [('dbo', 'customers')])
+        self.assertEqual(names('order?'), [('dbo', 'orders'), ('staging', 'orders')])
+        self.assertEqual(names('other.%'), [])
+        self.assertEqual(loader.calls, 1)
+
+    def test_kept_in_a_file(self):
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'catalog', 'cache.db')
+            loader = Loader()
+
+            db.CatalogCache(path=path).get('odbc:SALES', 'tables', loader)
+
+            # a new cache, like a new kernel, reads the listing instead of asking the database
+            cache = db.CatalogCache(path=path)
+            rows = cache.get('odbc:SALES', 'tables', loader, pattern='customers')
+
+            self.assertEqual(loader.calls, 1)
+            self.assertEqual([row.table_type for row in rows], ['VIEW'])
+
+            cache.invalidate()
+            db.CatalogCache(path=path).get('odbc:SALES', 'tables', loader)
+            self.assertEqual(loader.calls, 2)
+        finally:
+            shutil.rmtree(directory)
+
+
+class CatalogTest(MagicTestCase):
+
+    def setUp(self):
+        MagicTestCase.setUp(self)
+        db.DbMagic._catalog_cache.invalidate()
+
+    def test_logins_dont_share_a_listing(self):
+
+        self.line('-t sqlite %s -a low -u reader --connect' % self.path)
+        self.line('-t sqlite %s -a high -u owner --connect' % self.path)
+        self.line('-t sqlite %s -a other -u owner --connect' % self.path)
+
+        self.assertNotEqual(self.magics.catalog_source('low'), self.magics.catalog_source('high'))
+        self.assertEqual(self.magics.catalog_source('high'), self.magics.catalog_source('other'))
+
+        misses = db.DbMagic._catalog_cache.stats()['misses']
+        self.line('-t sqlite -a high --list tables')
+        self.line('-t sqlite -a other --list tables')
+
+        self.assertEqual(db.DbMagic._catalog_cache.stats()['misses'], misses + 1)
+
+    def test_list_like_and_refresh(self):
+
+        self.connect()
+
+        connection = sqlite3.connect(self.path)
+        connection.execute("CREATE TABLE letters (c TEXT)")
+        connection.commit()
+
+        self.assertEqual([row.name for row in self.line('-t sqlite -a t --list tables')], ['letters', 'numbers'])
+        self.assertEqual([row.name for row in self.line('-t sqlite -a t --list tables --like NUM%')], ['numbers'])
+
+        connection.execute("CREATE TABLE names (name TEXT)")
+        connection.commit()
+        connection.close()
+
+        # the listing is cached until it is refreshed
+        self.assertEqual([row.name for row in self.line('-t sqlite -a t --list tables --like n%')], ['numbers'])
+        self.assertEqual([row.name for row in self.line('-t sqlite -a t --list tables --like n% --refresh')], \
+                ['names', 'numbers'])
+
+
+if __name__ == '__main__':
+    unittest.main()
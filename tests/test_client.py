@@ -0,0 +1,68 @@
+"""
+Tests for db.Client against the sqlite backend.
+
+Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from test_magics import MagicTestCase
+
+import db
+
+
+class ClientTest(MagicTestCase):
+
+    def setUp(self):
+        MagicTestCase.setUp(self)
+        self.client = db.Client()
+
+    def test_shares_the_registry_with_the_magics(self):
+
+        self.client.connect('c', self.path, 'sqlite')
+        self.client.execute('c', "SELECT n FROM numbers WHERE n < ?", (3,))
+
+        self.assertEqual(list(self.client.fetch_iter('c')), [(0,), (1,), (2,)])
+        self.assertEqual(self.line('-t sqlite -a c SELECT COUNT(*) FROM numbers --fetch all'), [(10,)])
+
+        self.client.close('c')
+        self.assertNotIn('c', db.DbMagic._registry)
+
+    def test_fetch_iter_is_recorded_when_the_stream_closes(self):
+
+        self.client.connect('c', self.path, 'sqlite')
+        entry = db.DbMagic._registry['c']
+
+        self.client.execute('c', "SELECT n FROM numbers")
+        stream = self.client.fetch_iter('c', batch_size=4)
+        stream.next()
+        self.assertEqual(entry.metrics['fetches'], 0)
+
+        stream.close()
+        self.assertEqual((entry.metrics['fetches'], entry.metrics['rows']), (1, 4))
+
+        self.client.execute('c', "SELECT n FROM numbers")
+        self.assertEqual(len(list(self.client.fetch_iter('c'))), 10)
+        self.assertEqual((entry.metrics['fetches'], entry.metrics['rows']), (2, 14))
+
+    def test_refuses_an_alias_with_a_running_async_query(self):
+
+        self.connect()
+        query = self.line("-t sqlite -a t WITH RECURSIVE r(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM r " \
+                "WHERE i < 2000000) SELECT COUNT(*) FROM r --fetch all --async")
+
+        self.assertRaises(Exception, self.client.execute, 't', 'SELECT 1')
+        self.assertEqual(self.line('--wait %s' % query.id), [(2000000,)])
+
+        self.client.execute('t', 'SELECT 1')
+        self.assertEqual(list(self.client.fetch_iter('t')), [(1,)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+Tests for the completion of %db lines and the prefix indexes behind it.
+
+Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import time
+import unittest
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from test_magics import MagicTestCase
+
+import db
+
+
+Event = namedtuple('Event', ['line', 'symbol', 'text_until_cursor'])
+
+
+class PrefixIndexTest(unittest.TestCase):
+
+    def test_complete(self):
+
+        index = db.PrefixIndex(['orders', 'Order_Lines', 'customers', 'ord', 'orders', None, ''])
+
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.complete('ORD'), ['ord', 'Order_Lines', 'orders'])
+        self.assertEqual(index.complete('order'), ['Order_Lines', 'orders'])
+        self.assertEqual(index.complete('ord', limit=2), ['ord', 'Order_Lines'])
+        self.assertEqual(index.complete('x'), [])
+        self.assertEqual(index.complete(''), ['customers', 'ord', 'Order_Lines', 'orders'])
+
+    def test_unicode(self):
+
+        index = db.PrefixIndex([u'caf\xe9', u'cafe', u'cab'])
+
+        self.assertEqual(index.complete(u'CAF'), [u'cafe', u'caf\xe9'])
+        self.assertEqual(index.complete(u'caf\xc9'), [u'caf\xe9'])
+
+
+class CatalogIndexTest(unittest.TestCase):
+
+    def test_complete(self):
+
+        tables = db.CatalogListing(['TABLE_CAT', 'TABLE_SCHEM', 'TABLE_NAME'], \
+                [('sales', 'dbo', 'orders'), ('sales', 'staging', 'order_lines')])
+        columns = db.CatalogListing(['TABLE_CAT', 'TABLE_SCHEM', 'TABLE_NAME', 'COLUMN_NAME'], \
+                [('sales', 'dbo', 'orders', 'order_id'), ('sales', 'dbo', 'orders', 'amount'), \
+                 ('sales', 'staging', 'order_lines', 'line_id')])
+
+        index = db.CatalogIndex(tables, columns)
+
+        self.assertEqual(index.complete('ord'), ['order_lines', 'orders', 'order_id'])
+        self.assertEqual(index.complete('staging.'), ['staging.order_lines'])
+        self.assertEqual(index.complete('orders.'), ['orders.amount', 'orders.order_id'])
+        self.assertEqual(index.complete('dbo.orders.a'), ['dbo.orders.amount'])
+        self.assertEqual(index.complete('l'), ['line_id'])
+
+        # without the columns, only the schemas and tables are completed
+        self.assertEqual(db.CatalogIndex(tables).complete('ord'), ['order_lines', 'orders'])
+
+
+class SqlCompleterTest(MagicTestCase):
+
+    def setUp(self):
+        MagicTestCase.setUp(self)
+        db.DbMagic._catalog_cache.invalidate()
+        self.completer = db.SqlCompleter(db.DbMagic)
+
+    def tearDown(self):
+
+        # the catalog connection of a background build has to be closed before the file goes
+        deadline = time.time() + 10
+        while self.completer._building and time.time() < deadline:
+            time.sleep(0.01)
+
+        MagicTestCase.tearDown(self)
+
+    def complete(self, line):
+        symbol = '' if line.endswith(' ') else line.split()[-1]
+        return self.completer(self.shell, Event(line, symbol, line))
+
+    def test_options_types_and_aliases(self):
+
+        self.connect('t')
+
+        self.assertIn('--preview', self.complete('%db --pre'))
+        self.assertIn('sqlite', self.complete('%db -t '))
+        self.assertEqual(self.complete('%db -a '), ['t'])
+        self.assertEqual(self.complete('%db --list '), ['sources', 'tables', 'procedures', 'columns'])
+        self.assertIn('t', self.complete('%db '))
+        self.assertIn('SELECT', self.complete('%db -a t SEL'))
+
+    def test_catalog_of_the_alias(self):
+
+        self.connect('t')
+
+        # the first completion starts indexing the catalog in the background
+        self.complete('%db -a t SELECT * FROM num')
+
+        deadline = time.time() + 10
+        while self.completer.index('t') is None and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(self.complete('%db -a t SELECT * FROM num'), ['numbers'])
+        self.assertEqual(self.complete('%db -a t SELECT na'), ['name'])
+        self.assertEqual(self.complete('%db -a t SELECT numbers.'), ['numbers.n', 'numbers.name'])
+
+    def test_alias_of_a_line(self):
+
+        self.connect('t')
+
+        self.assertEqual(self.completer.alias('%db -a t SELECT 1'), 't')
+        self.assertEqual(self.completer.alias('%db t SELECT 1'), 't')
+        self.assertEqual(self.completer.alias('%%db --alias t\nSELECT 1'), 't')
+        self.assertEqual(self.completer.alias('%db -a u SELECT 1'), 'u')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+"""
+Tests for the SQL dialects behind --preview and --sample, and the SQL they generate.
+
+Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from test_magics import MagicTestCase
+
+import db
+
+
+class DetectDialectTest(unittest.TestCase):
+
+    def test_driver_names(self):
+
+        for driver, dialect in [('Teradata Database ODBC Driver 16.20', 'teradata'), \
+                                ('ODBC Driver 17 for SQL Server', 'tsql'), \
+                                ('libtdsodbc.so', 'tsql'), \
+                                ('Oracle 19 ODBC driver', 'oracle'), \
+                                ('IBM DB2 ODBC DRIVER', 'db2'), \
+                                ('MariaDB ODBC 3.1 Driver', 'mysql'), \
+                                ('SnowflakeDSIIDriver', 'snowflake'), \
+                                ('Simba Spark ODBC Driver', 'hive'), \
+                                ('PostgreSQL Unicode', 'ansi'), \
+                                (None, 'ansi')]:
+            self.assertEqual(db.detect_dialect(driver), dialect, driver)
+
+
+class LimitCommandTest(unittest.TestCase):
+
+    def test_preview_per_dialect(self):
+
+        command = "SELECT n FROM t"
+
+        self.assertEqual(db.limit_command(command, 'ansi', rows=5), \
+                "SELECT * FROM (SELECT n FROM t) preview_query LIMIT 5")
+        self.assertEqual(db.limit_command(command, 'tsql', rows=5), \
+                "SELECT TOP 5 * FROM (SELECT n FROM t) preview_query")
+        self.assertEqual(db.limit_command(command, 'teradata', rows=5), \
+                "SELECT TOP 5 * FROM (SELECT n FROM t) preview_query")
+        self.assertEqual(db.limit_command(command, 'oracle', rows=5), \
+                "SELECT * FROM (SELECT n FROM t) preview_query FETCH FIRST 5 ROWS ONLY")
+        self.assertEqual(db.limit_command(command, 'db2', rows=5), \
+                "SELECT * FROM (SELECT n FROM t) preview_query FETCH FIRST 5 ROWS ONLY")
+
+        # a dialect without an entry is treated as ANSI
+        self.assertEqual(db.limit_command(command, 'unknown', rows=5), db.limit_command(command, 'ansi', rows=5))
+
+    def test_sample_per_dialect(self):
+
+        command = "SELECT n FROM t;"
+
+        self.assertEqual(db.limit_command(command, 'ansi', percent=10), \
+                "SELECT * FROM (SELECT n FROM t) sample_query WHERE RANDOM() < 0.1")
+        self.assertEqual(db.limit_command(command, 'teradata', percent=10), \
+                "SELECT * FROM (SELECT n FROM t) sample_query SAMPLE 0.1")
+        self.assertEqual(db.limit_command(command, 'tsql', percent=10), \
+                "SELECT * FROM (SELECT n FROM t) sample_query WHERE RAND(CHECKSUM(NEWID())) < 0.1")
+        self.assertEqual(db.limit_command(command, 'oracle', percent=10), \
+                "SELECT * FROM (SELECT n FROM t) sample_query WHERE DBMS_RANDOM.VALUE < 0.1")
+        self.assertEqual(db.limit_command(command, 'snowflake', percent=10), \
+                "SELECT * FROM (SELECT n FROM t) sample_query SAMPLE (10)")
+        self.assertEqual(db.limit_command(command, 'sqlite', percent=10), \
+                "SELECT * FROM (SELECT n FROM t) sample_query WHERE ABS(RANDOM() % 1000000) < 0.1 * 1000000")
+
+    def test_sample_and_preview(self):
+
+        self.assertEqual(db.limit_command("SELECT n FROM t", 'tsql', rows=5, percent=10), \
+                "SELECT TOP 5 * FROM (SELECT * FROM (SELECT n FROM t) sample_query " \
+                "WHERE RAND(CHECKSUM(NEWID())) < 0.1) preview_query")
+
+    def test_invalid_commands(self):
+
+        self.assertRaises(Exception, db.limit_command, "DELETE FROM t", 'ansi', rows=5)
+        self.assertRaises(Exception, db.limit_command, "SELECT n FROM t", 'ansi', rows=0)
+        self.assertRaises(Exception, db.limit_command, "SELECT n FROM t", 'ansi', percent=0)
+        self.assertRaises(Exception, db.limit_command, "SELECT n FROM t", 'ansi', percent=101)
+
+
+class DerivedTableTest(unittest.TestCase):
+
+    def test_queries_that_can_be_wrapped(self):
+
+        for command in ["SELECT a.id, b.id AS b_id FROM a JOIN b ON a.k = b.k", \
+                        "SELECT * FROM a WHERE x IN (SELECT y FROM b JOIN c ON b.k = c.k)", \
+                        "SELECT COUNT(*), MAX(n) FROM t", \
+                        "SELECT 'a, a' AS s, f(a, a) AS t FROM t", \
+                        "WITH x AS (SELECT 1 AS a, 2 AS a) SELECT a FROM x", \
+                        "SELECT n FROM t ORDER BY n"]:
+            self.assertIsNone(db.derived_table_problem(command, 'ansi'), command)
+
+        self.assertIsNone(db.derived_table_problem("SELECT TOP 10 n FROM t ORDER BY n", 'tsql'))
+
+    def test_duplicate_column_names(self):
+
+        for command in ["SELECT a.id, b.id FROM a JOIN b ON a.k = b.k", \
+                        "SELECT n AS x, [x] FROM t", \
+                        "SELECT * FROM a JOIN b ON a.k = b.k", \
+                        "SELECT a.*, b.* FROM a, b"]:
+            self.assertIsNotNone(db.derived_table_problem(command, 'ansi'), command)
+
+    def test_tsql_derived_tables(self):
+
+        self.assertIsNotNone(db.derived_table_problem("SELECT n FROM t ORDER BY n", 'tsql'))
+        self.assertIsNotNone(db.derived_table_problem("WITH x AS (SELECT 1 AS a) SELECT a FROM x", 'tsql'))
+
+    def test_fall_back_to_the_client(self):
+
+        command = "SELECT n FROM t ORDER BY n"
+
+        self.assertIsNone(db.limit_command(command, 'tsql', rows=5))
+        self.assertRaises(Exception, db.limit_command, command, 'tsql', percent=10)
+        self.assertEqual(db.limit_command(command, 'ansi', rows=5), \
+                "SELECT * FROM (SELECT n FROM t ORDER BY n) preview_query LIMIT 5")
+
+
+class PreviewTest(MagicTestCase):
+
+    def test_preview_of_duplicate_column_names(self):
+
+        self.connect()
+        rows = self.line('-t sqlite -a t SELECT a.n, b.n FROM numbers a JOIN numbers b ON a.n = b.n --preview 3')
+
+        self.assertEqual(rows, [(0, 0), (1, 1), (2, 2)])
+
+    def test_preview_and_sample(self):
+
+        self.connect()
+
+        self.assertEqual(self.line('-t sqlite -a t SELECT n FROM numbers ORDER BY n --preview 3'), [(0,), (1,), (2,)])
+        self.assertEqual(len(self.line('-t sqlite -a t SELECT n FROM numbers --sample 100 --fetch all')), 10)
+        self.assertEqual(self.magics.dialect('t'), 'sqlite')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+"""
+Tests for the batched fetch loop behind --arraysize and the adaptive batch sizer.
+
+Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from test_magics import MagicTestCase
+
+import db
+
+
+def rows(count):
+    return [(i,) for i in range(count)]
+
+
+class AdaptiveBatchSizerTest(unittest.TestCase):
+
+    def test_fixed_size(self):
+
+        sizer = db.AdaptiveBatchSizer(100)
+        sizer.record(rows(100), 1.0)
+        sizer.record(rows(100), 0.01)
+
+        self.assertEqual(sizer.size(), 100)
+        self.assertEqual((sizer.rows, sizer.batches), (200, 2))
+
+    def test_grows_while_the_throughput_gets_better(self):
+
+        sizer = db.AdaptiveBatchSizer(100, adaptive=True)
+
+        sizer.record(rows(100), 0.1)
+        self.assertEqual(sizer.size(), 200)
+
+        sizer.record(rows(200), 0.1)
+        self.assertEqual(sizer.size(), 400)
+
+    def test_shrinks_when_the_throughput_gets_worse(self):
+
+        sizer = db.AdaptiveBatchSizer(100, adaptive=True)
+
+        sizer.record(rows(100), 0.1)
+        sizer.record(rows(200), 0.4)
+        self.assertEqual(sizer.size(), 100)
+
+        # and keeps going that way while it gets better, but not below the minimum
+        sizer.record(rows(100), 0.05)
+        self.assertEqual(sizer.size(), 100)
+
+        sizer = db.AdaptiveBatchSizer(400, adaptive=True, minimum=100)
+        sizer.record(rows(400), 0.1)
+        sizer.record(rows(800), 1.0)
+        sizer.record(rows(400), 0.05)
+        self.assertEqual(sizer.size(), 200)
+
+    def test_holds_when_the_throughput_stops_changing(self):
+
+        sizer = db.AdaptiveBatchSizer(100, adaptive=True)
+
+        sizer.record(rows(100), 0.1)
+        sizer.record(rows(200), 0.2)
+        sizer.record(rows(200), 0.21)
+
+        self.assertEqual(sizer.size(), 200)
+
+    def test_short_batches_say_nothing(self):
+
+        sizer = db.AdaptiveBatchSizer(100, adaptive=True)
+        sizer.record(rows(50), 0.1)
+        sizer.record(rows(100), 0.0)
+
+        self.assertEqual(sizer.size(), 100)
+        self.assertEqual(sizer.rows, 150)
+
+    def test_limits(self):
+
+        sizer = db.AdaptiveBatchSizer(100, adaptive=True, maximum=150)
+        sizer.record(rows(100), 0.1)
+        self.assertEqual(sizer.size(), 150)
+
+        # no more rows than fit in max_bytes at the measured width
+        sizer = db.AdaptiveBatchSizer(100, adaptive=True, max_bytes=1)
+        sizer.record(rows(100), 0.1)
+        self.assertEqual(sizer.size(), 100)
+
+        self.assertRaises(Exception, db.AdaptiveBatchSizer, 0)
+
+
+class Cursor(object):
+
+    """ Hands out a list of rows with fetchmany() """
+
+    def __init__(self, count):
+        self.rows = rows(count)
+        self.arraysize = 1
+        self.sizes = []
+
+    def fetchmany(self, size):
+        self.sizes.append(self.arraysize)
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+
+class FetchBatchesTest(unittest.TestCase):
+
+    def test_batches(self):
+
+        cursor = Cursor(25)
+        batches = list(db.fetch_batches(cursor, db.AdaptiveBatchSizer(10)))
+
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        self.assertEqual(cursor.sizes, [10, 10, 10, 10])
+
+    def test_max_rows(self):
+
+        cursor = Cursor(25)
+        batches = list(db.fetch_batches(cursor, db.AdaptiveBatchSizer(10), max_rows=15))
+
+        self.assertEqual([len(batch) for batch in batches], [10, 5])
+        self.assertEqual(cursor.sizes, [10, 5])
+
+
+class ArraysizeTest(MagicTestCase):
+
+    def test_arraysize(self):
+
+        self.connect()
+
+        for options in ['--fetch all --arraysize 3', '--fetch all --arraysize 3 --adaptive']:
+            self.assertEqual(self.line('-t sqlite -a t SELECT n FROM numbers %s' % options), rows(10), options)
+
+        self.assertEqual(self.line('-t sqlite -a t SELECT n FROM numbers --fetch 7 --arraysize 3'), rows(7))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,291 @@
+"""
+Tests for the %db and %%db magics against the sqlite backend, so they run without a DSN.
+
+Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from IPython.core.interactiveshell import InteractiveShell
+from IPython.core.magic_arguments import parse_argstring
+
+import db
+
+
+class MagicTestCase(unittest.TestCase):
+
+    """ Runs the magics in an IPython shell, on a sqlite file with a table of ten numbers """
+
+    def setUp(self):
+
+        self.shell = InteractiveShell.instance()
+        self.shell.register_magics(db.DbMagic)
+        self.magics = self.shell.magics_manager.registry['DbMagic']
+
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.db')
+
+        connection = sqlite3.connect(self.path)
+        connection.execute("CREATE TABLE numbers (n INTEGER, name TEXT)")
+        connection.executemany("INSERT INTO numbers VALUES (?, ?)", [(i, u'n%s' % i) for i in range(10)])
+        connection.commit()
+        connection.close()
+
+        self.result_store = db.DbMagic._result_store
+        db.DbMagic._result_store = db.ResultStore(os.path.join(self.directory, 'persist'))
+
+    def tearDown(self):
+
+        self.line('--cleanup')
+        db.DbMagic._result_cache.clear()
+        db.DbMagic._result_store = self.result_store
+
+        shutil.rmtree(self.directory)
+
+    def line(self, line):
+        return self.shell.run_line_magic('db', line)
+
+    def cell(self, line, cell):
+        return self.shell.run_cell_magic('db', line, cell)
+
+    def connect(self, alias='t'):
+        self.line('-t sqlite %s -a %s --connect' % (self.path, alias))
+
+
+class ParseTest(MagicTestCase):
+
+    def test_fast_path_matches_argparse(self):
+
+        for line in ['SELECT 1', 'MY_DSN SELECT * FROM t', "SELECT 'a' FROM t", 'x', 'SELECT a-b FROM t ']:
+            fast = self.magics.fast_args(line)
+            self.assertIsNotNone(fast, line)
+            self.assertEqual(vars(fast), vars(parse_argstring(self.magics.parse_args, line)), line)
+
+    def test_lines_that_need_argparse(self):
+
+        for line in ['', '-a x SELECT 1', 'SELECT 1 --fetch all', "SELECT 'a b'", 'SELECT  1', 'SELECT\t1']:
+            self.assertIsNone(self.magics.fast_args(line), line)
+
+    def test_same_result_on_both_paths(self):
+
+        self.connect()
+        try:
+            db.DbMagic._fast_parse = False
+            slow = self.magics.parse_args('t SELECT n FROM numbers')
+        finally:
+            db.DbMagic._fast_parse = True
+        fast = self.magics.parse_args('t SELECT n FROM numbers')
+
+        self.assertEqual(slow[:4], fast[:4])
+        self.assertEqual(vars(slow[4]), vars(fast[4]))
+
+    def test_naked_query(self):
+
+        alias, key, cmd, fetch, args = self.magics.parse_args('-t sqlite %s SELECT 1' % self.path)
+
+        self.assertTrue(args.naked)
+        self.assertEqual((alias, key, cmd, fetch), (self.path, self.path, 'SELECT 1', 'all'))
+
+    def test_sql_keyword_is_not_a_sqlite_source(self):
+
+        self.connect()
+        cwd = os.getcwd()
+        os.chdir(self.directory)
+        try:
+            self.assertEqual(self.line('-t sqlite SELECT 1'), [(1,)])
+        finally:
+            os.chdir(cwd)
+
+        self.assertEqual(os.listdir(self.directory), ['test.db'])
+
+    def test_sources_only_for_their_driver(self):
+
+        self.assertTrue(db.get_driver('sqlite').is_source(':memory:'))
+        self.assertTrue(db.get_driver('sqlite').is_source(self.path))
+        self.assertTrue(db.get_driver('sqlite').is_source('new.sqlite3'))
+        self.assertFalse(db.get_driver('sqlite').is_source('SELECT'))
+
+        self.assertTrue(db.get_driver('dbapi:sqlite3').is_source('dbname=sales'))
+        self.assertTrue(db.get_driver('dbapi:sqlite3').is_source('postgresql://warehouse/sales'))
+        self.assertFalse(db.get_driver('dbapi:sqlite3').is_source('SELECT'))
+
+    def test_quoted_source(self):
+
+        alias, key, cmd, fetch, args = \
+                self.magics.parse_args('-t dbapi:sqlite3 "dbname=sales host=warehouse" SELECT 1')
+
+        self.assertTrue(args.naked)
+        self.assertEqual((key, cmd), ('dbname=sales host=warehouse', 'SELECT 1'))
+
+        path = os.path.join(self.directory, 'with space.db')
+        self.assertEqual(self.line("-t sqlite '%s' SELECT 1" % path), [(1,)])
+        self.assertTrue(os.path.exists(path))
+
+    def test_cell_line_with_options_before_the_source(self):
+
+        alias, key, cmd, fetch, args = self.magics.parse_args('-t sqlite %s --fetch' % self.path, 'SELECT 1')
+
+        self.assertEqual((key, cmd), (self.path, 'SELECT 1'))
+        self.assertEqual(self.cell('-t sqlite %s' % self.path, 'SELECT 1'), [(1,)])
+
+
+class DriverTest(unittest.TestCase):
+
+    def test_a_driver_has_to_implement_connect(self):
+
+        class NoConnect(db.DBMagicSource):
+            name = 'none'
+
+        class Connect(NoConnect):
+            def connect(self, source, username=None, password=None):
+                return source
+
+        self.assertRaises(TypeError, db.DBMagicSource)
+        self.assertRaises(TypeError, NoConnect)
+        self.assertEqual(Connect().connect('x'), 'x')
+
+
+class QueryTest(MagicTestCase):
+
+    def test_naked_query_gives_the_connection_back(self):
+
+        self.assertEqual(self.line('-t sqlite %s SELECT COUNT(*) FROM numbers' % self.path), [(10,)])
+        self.assertEqual(len(db.DbMagic._registry), 0)
+
+    def test_aliased_query(self):
+
+        self.connect()
+
+        self.assertEqual(self.line('-t sqlite -a t SELECT n FROM numbers WHERE n < 3 --fetch all'), [(0,), (1,), (2,)])
+        self.assertEqual(self.line('-t sqlite -a t SELECT n FROM numbers --fetch 2'), [(0,), (1,)])
+
+    def test_stream(self):
+
+        self.connect()
+        stream = self.line('-t sqlite -a t SELECT n FROM numbers --stream 3')
+
+        self.assertEqual([row[0] for row in stream], range(10))
+        self.assertIsNone(db.DbMagic._registry['t'].stream)
+
+    def test_naked_stream_leaves_the_source_free(self):
+
+        stream = self.line('-t sqlite %s SELECT n FROM numbers --stream 2' % self.path)
+        self.assertEqual(stream.next(), (0,))
+
+        self.assertEqual(self.line('-t sqlite %s SELECT COUNT(*) FROM numbers' % self.path), [(10,)])
+        self.assertEqual(len(list(stream)), 9)
+        self.assertEqual(len(db.DbMagic._registry), 0)
+
+    def test_cell_with_several_statements(self):
+
+        self.connect()
+        results = self.cell('-t sqlite -a t --fetch all', \
+                "INSERT INTO numbers VALUES (10, 'n10');\nSELECT COUNT(*) FROM numbers")
+
+        self.assertEqual([result.statement for result in results], \
+                ["INSERT INTO numbers VALUES (10, 'n10')", 'SELECT COUNT(*) FROM numbers'])
+        self.assertEqual(results[1].results, [(11,)])
+
+    def test_fan_out_runs_each_alias_once(self):
+
+        self.connect('t')
+        self.connect('u')
+        result = self.line('--aliases t,u,t SELECT COUNT(*) FROM numbers')
+
+        self.assertEqual(list(result.timings.keys()), ['t', 'u'])
+        self.assertEqual(len(result), 2)
+
+    def test_insert(self):
+
+        self.connect()
+        self.shell.user_ns['rows'] = [(20 + i, u'm%s' % i) for i in range(25)]
+
+        self.assertEqual(self.line('-t sqlite -a t --insert numbers --from rows --batch-size 10'), 25)
+        self.assertEqual(self.line('-t sqlite -a t SELECT COUNT(*) FROM numbers --fetch all'), [(35,)])
+
+    def test_insert_runs_like_any_other_command(self):
+
+        self.connect()
+        entry = db.DbMagic._registry['t']
+        self.shell.user_ns['rows'] = [(20, u'm0')]
+
+        stream = self.line('-t sqlite -a t SELECT n FROM numbers --stream 2')
+        commands = entry.metrics['commands']
+
+        self.assertEqual(self.line('-t sqlite -a t --insert numbers --from rows'), 1)
+
+        self.assertTrue(stream.closed)
+        self.assertIs(entry.cursor, entry.base_cursor)
+        self.assertEqual(entry.metrics['commands'], commands + 1)
+
+    def test_cache(self):
+
+        self.connect()
+        query = '-t sqlite -a t SELECT COUNT(*) FROM numbers --fetch all --cache 60'
+
+        self.assertEqual(self.line(query), [(10,)])
+        self.line('-t sqlite -a t DELETE FROM numbers')
+
+        self.assertEqual(self.line(query), [(10,)])
+        self.assertEqual(self.line(query + ' --no-cache'), [(0,)])
+
+    def test_cache_hands_out_copies(self):
+
+        self.connect()
+        query = '-t sqlite -a t SELECT n FROM numbers WHERE n < 2 --fetch all --cache 60'
+
+        self.line(query).append((2,))
+        self.line(query).pop()
+
+        self.assertEqual(self.line(query), [(0,), (1,)])
+
+    def test_cancel_keeps_uncommitted_work(self):
+
+        self.connect()
+        self.line('-t sqlite -a t INSERT INTO numbers VALUES (99, NULL)')
+
+        self.assertFalse(self.line('--cancel t'))
+        self.line('-t sqlite -a t --commit')
+
+        self.assertEqual(self.line('-t sqlite -a t SELECT COUNT(*) FROM numbers WHERE n = 99 --fetch all'), [(1,)])
+
+    def test_timeout(self):
+
+        self.connect()
+        endless = "WITH RECURSIVE r(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM r) SELECT COUNT(*) FROM r"
+
+        self.assertRaises(Exception, self.line, '-t sqlite -a t %s --fetch all --timeout 0.2' % endless)
+
+        # the connection is cleaned up and can be used again
+        self.assertEqual(self.line('-t sqlite -a t SELECT COUNT(*) FROM numbers --fetch all'), [(10,)])
+
+    def test_persist_and_load(self):
+
+        self.connect()
+        self.line('-t sqlite -a t SELECT n, name FROM numbers --fetch all --persist numbers --arraysize 3')
+
+        loaded = self.line('--load numbers --df')
+
+        self.assertEqual(list(loaded['n']), range(10))
+        self.assertEqual(loaded['name'][9], u'n9')
+
+    @unittest.skipIf(db.numpy is None, "NumPy is not installed")
+    def test_dataframe_types(self):
+
+        self.connect()
+        frame = self.line('-t sqlite -a t SELECT n, name, n * 0.5 AS half FROM numbers --df --fetch all')
+
+        self.assertEqual([str(dtype) for dtype in frame.dtypes], ['int64', 'object', 'float64'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+Tests for db.ConnectionPool with sqlite connections.
+
+Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sqlite3
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import db
+
+
+class Connection(object):
+
+    """ A sqlite connection that remembers the commands run on its cursors """
+
+    def __init__(self):
+        self.connection = sqlite3.connect(':memory:')
+        self.commands = []
+        self.on_execute = None
+
+    def cursor(self):
+        cursor = self.connection.cursor()
+        connection = self
+
+        class Cursor(object):
+
+            def execute(self, command):
+                connection.commands.append(command)
+                if connection.on_execute is not None:
+                    connection.on_execute()
+                return cursor.execute(command)
+
+            def __getattr__(self, name):
+                return getattr(cursor, name)
+
+        return Cursor()
+
+    def close(self):
+        self.connection.close()
+
+
+class PoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = db.ConnectionPool()
+        self.key = self.pool.make_key(':memory:', None, 'sqlite')
+
+    def test_health_check_makes_a_round_trip(self):
+
+        cnxn = self.pool.checkout(self.key, Connection)
+        self.pool.checkin(self.key, cnxn)
+
+        self.assertIs(self.pool.checkout(self.key, Connection), cnxn)
+        self.assertEqual(cnxn.commands, ['SELECT 1'])
+
+    def test_broken_connection_is_replaced(self):
+
+        cnxn = self.pool.checkout(self.key, Connection)
+        self.pool.checkin(self.key, cnxn)
+        cnxn.close()
+
+        self.assertIsNot(self.pool.checkout(self.key, Connection), cnxn)
+        self.assertEqual(self.pool.stats()['evictions'], 1)
+        self.assertEqual(self.pool.stats()['in_use'], 1)
+
+    def test_connection_being_checked_counts_as_in_use(self):
+
+        cnxn = self.pool.checkout(self.key, Connection)
+        self.pool.checkin(self.key, cnxn)
+
+        seen = []
+        cnxn.on_execute = lambda: seen.append(self.pool.stats())
+        self.pool.checkout(self.key, Connection)
+
+        self.assertEqual([(stats['in_use'], stats['idle']) for stats in seen], [(1, 0)])
+
+    def test_password_is_part_of_the_key(self):
+
+        right = self.pool.make_key('warehouse', 'me', 'odbc', 'right')
+
+        self.assertEqual(right, self.pool.make_key('warehouse', 'me', 'ODBC', u'right'))
+        self.assertNotEqual(right, self.pool.make_key('warehouse', 'me', 'odbc', 'wrong'))
+        self.assertNotIn('right', right)
+
+        cnxn = self.pool.checkout(right, Connection)
+        self.pool.checkin(right, cnxn)
+
+        self.assertIsNot(self.pool.checkout(self.pool.make_key('warehouse', 'me', 'odbc', 'wrong'), Connection), cnxn)
+
+
+if __name__ == '__main__':
+    unittest.main()
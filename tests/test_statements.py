@@ -0,0 +1,167 @@
+"""
+Tests for the statement cache that keeps parameterized commands prepared, one cursor each.
+
+Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import sqlite3
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import db
+
+
+class StatementCacheTest(unittest.TestCase):
+
+    def test_least_recently_used_is_evicted(self):
+
+        cache = db.StatementCache(2)
+
+        self.assertEqual(cache.add('a', 'cursor a'), [])
+        self.assertEqual(cache.add('b', 'cursor b'), [])
+        self.assertEqual(cache.get('a'), 'cursor a')
+
+        self.assertEqual(cache.add('c', 'cursor c'), ['cursor b'])
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(len(cache), 2)
+
+        stats = cache.stats()
+        self.assertEqual((stats['statement_hits'], stats['statement_misses']), (1, 1))
+        self.assertEqual(stats['statement_hit_rate'], 0.5)
+
+    def test_no_cache(self):
+
+        cache = db.StatementCache(0)
+
+        self.assertEqual(cache.add('a', 'cursor a'), ['cursor a'])
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNone(db.StatementCache(0).stats()['statement_hit_rate'])
+
+    def test_clear(self):
+
+        cache = db.StatementCache(2)
+        cache.add('a', 'cursor a')
+        cache.add('b', 'cursor b')
+
+        self.assertEqual(sorted(cache.clear()), ['cursor a', 'cursor b'])
+        self.assertEqual(len(cache), 0)
+
+
+class RecordingSource(db.SQLiteSource):
+
+    """ The sqlite driver, remembering the cursors whose results it drops """
+
+    def __init__(self):
+        self.dropped = []
+
+    def close_results(self, cursor):
+        self.dropped.append(cursor)
+        db.SQLiteSource.close_results(self, cursor)
+
+
+class EntryTest(unittest.TestCase):
+
+    def setUp(self):
+
+        connection = sqlite3.connect(':memory:')
+        connection.execute("CREATE TABLE numbers (n INTEGER)")
+        connection.executemany("INSERT INTO numbers VALUES (?)", [(i,) for i in range(10)])
+
+        self.driver = RecordingSource()
+        self.entry = db.ConnectionEntry('s', 'sqlite', ':memory:', connection, connection.cursor(), \
+                driver=self.driver, statement_cache=2)
+
+    def tearDown(self):
+        self.entry.close(None)
+
+    def test_a_command_stays_on_its_cursor(self):
+
+        entry = self.entry
+
+        entry.execute("SELECT n FROM numbers WHERE n = ?", (1,))
+        cursor = entry.cursor
+        self.assertEqual(cursor.fetchall(), [(1,)])
+
+        entry.execute("SELECT COUNT(*) FROM numbers")
+        self.assertIs(entry.cursor, entry.base_cursor)
+
+        entry.execute("SELECT n FROM numbers WHERE n = ?", (2,))
+        self.assertIs(entry.cursor, cursor)
+        self.assertEqual(cursor.fetchall(), [(2,)])
+
+        self.assertEqual((entry.statements.hits, entry.statements.misses), (1, 1))
+
+    def test_evicted_cursors_are_closed(self):
+
+        entry = self.entry
+
+        entry.execute("SELECT n FROM numbers WHERE n = ?", (1,))
+        first = entry.cursor
+        entry.execute("SELECT n FROM numbers WHERE n > ?", (1,))
+        entry.execute("SELECT n FROM numbers WHERE n < ?", (1,))
+
+        self.assertEqual(len(entry.statements), 2)
+        self.assertRaises(sqlite3.ProgrammingError, first.execute, "SELECT 1")
+
+    def test_switching_cursors_drops_the_pending_results(self):
+
+        entry = self.entry
+
+        entry.execute("SELECT n FROM numbers WHERE n > ?", (1,))
+        prepared = entry.cursor
+        entry.execute("SELECT COUNT(*) FROM numbers")
+        entry.execute("SELECT COUNT(*) FROM numbers")
+
+        self.assertEqual(self.driver.dropped, [entry.base_cursor, prepared])
+
+
+class Cursor(object):
+
+    """ A cursor with a number of result sets left """
+
+    def __init__(self, sets, error=None):
+        self.description = [('n', int, None, None, None, None, True)]
+        self.sets = sets
+        self.error = error
+        self.calls = 0
+
+    def nextset(self):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        self.sets -= 1
+        return self.sets > 0 or None
+
+
+class CloseResultsTest(unittest.TestCase):
+
+    def test_every_result_set_is_dropped(self):
+
+        cursor = Cursor(3)
+        db.get_driver('sqlite').close_results(cursor)
+
+        self.assertEqual(cursor.calls, 3)
+
+    def test_nothing_pending(self):
+
+        cursor = Cursor(3)
+        cursor.description = None
+        db.get_driver('sqlite').close_results(cursor)
+
+        self.assertEqual(cursor.calls, 0)
+
+    def test_drivers_without_nextset(self):
+
+        cursor = Cursor(3, sqlite3.NotSupportedError('nextset is not supported'))
+        db.get_driver('sqlite').close_results(cursor)
+
+        self.assertEqual(cursor.calls, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+"""
+Tests for the per-call timings behind --stats and their exporters.
+
+Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from test_magics import MagicTestCase
+
+import db
+
+
+def timing(alias, execute, rows=0, error=None):
+    """
+    :param alias: the alias of the call
+    :param execute: the seconds the execute phase took
+    :param rows: how many rows the call fetched
+    :param error: the error the call raised (optional)
+    :returns: a finished QueryTiming
+    """
+
+    record = db.QueryTiming(alias, 'SELECT 1')
+    record.timings['execute'] = execute
+    record.rows = rows
+    record.error = error
+
+    return record
+
+
+class PercentileTest(unittest.TestCase):
+
+    def test_nearest_rank(self):
+
+        values = range(1, 101)
+
+        self.assertEqual(db.QueryStats.percentile(values, 50), 50)
+        self.assertEqual(db.QueryStats.percentile(values, 90), 90)
+        self.assertEqual(db.QueryStats.percentile(values, 99), 99)
+        self.assertEqual(db.QueryStats.percentile(values, 100), 100)
+        self.assertEqual(db.QueryStats.percentile(values, 0), 1)
+
+    def test_few_values(self):
+
+        self.assertIsNone(db.QueryStats.percentile([], 50))
+        self.assertEqual(db.QueryStats.percentile([7], 99), 7)
+        self.assertEqual(db.QueryStats.percentile([1, 2], 50), 1)
+        self.assertEqual(db.QueryStats.percentile([1, 2], 51), 2)
+
+
+class QueryStatsTest(unittest.TestCase):
+
+    def test_summary_by_alias(self):
+
+        stats = db.QueryStats()
+        for i in range(1, 11):
+            stats.add(timing('a', i * 0.1, rows=i))
+        stats.add(timing('b', 2.0, error=Exception('failed')))
+
+        summary = stats.summary(recent=3)
+        a = summary['aliases']['a']
+
+        self.assertEqual(list(summary['aliases'].keys()), ['a', 'b'])
+        self.assertEqual((a['count'], a['errors'], a['rows']), (10, 0, 55))
+        self.assertAlmostEqual(a['p50'], 0.5)
+        self.assertAlmostEqual(a['p90'], 0.9)
+        self.assertAlmostEqual(a['p99'], 1.0)
+        self.assertAlmostEqual(a['execute_p50'], 0.5)
+        self.assertNotIn('fetch_p50', a)
+
+        self.assertEqual(summary['aliases']['b']['errors'], 1)
+        self.assertEqual([record.alias for record in summary['recent']], ['a', 'a', 'b'])
+
+    def test_only_the_most_recent_records_are_kept(self):
+
+        stats = db.QueryStats(max_records=3)
+        for i in range(5):
+            stats.add(timing('a', i))
+
+        self.assertEqual([record.total() for record in stats.records], [2, 3, 4])
+
+        stats.clear()
+        self.assertEqual(stats.summary()['aliases'], {})
+
+    def test_exporters(self):
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'stats.jsonl')
+            exported = []
+
+            def broken(record):
+                raise Exception('broken')
+
+            stats = db.QueryStats()
+            stats.add_exporter(broken)
+            stats.add_exporter(db.QueryStats.file_exporter(path))
+            stats.add_exporter(exported.append)
+
+            stats.add(timing('a', 0.5, rows=3))
+            stats.add(timing('b', 0.25, error=Exception('failed')))
+
+            # a failing exporter doesn't stop the record or the other exporters
+            self.assertEqual(len(stats.records), 2)
+            self.assertEqual([record.alias for record in exported], ['a', 'b'])
+
+            with open(path) as lines:
+                records = [json.loads(line) for line in lines]
+
+            self.assertEqual([(record['alias'], record['execute'], record['rows'], record['error']) \
+                    for record in records], [('a', 0.5, 3, None), ('b', 0.25, 0, 'failed')])
+            self.assertIsNone(records[0]['fetch'])
+        finally:
+            shutil.rmtree(directory)
+
+
+class StatsMagicTest(MagicTestCase):
+
+    def setUp(self):
+        MagicTestCase.setUp(self)
+        db.DbMagic._stats.clear()
+
+    def test_stats(self):
+
+        self.connect()
+        self.line('-t sqlite -a t SELECT n FROM numbers --fetch all')
+        self.line('-t sqlite -a t SELECT n FROM numbers WHERE n < 4 --fetch all')
+
+        stats = self.line('--stats')['aliases']['t']
+
+        # the --connect is a call of its own
+        self.assertEqual(stats['count'], 3)
+        self.assertEqual(stats['rows'], 14)
+        self.assertIn('execute_p50', stats)
+        self.assertIn('fetch_p50', stats)
+
+
+if __name__ == '__main__':
+    unittest.main()